@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the models, likelihoods, data loading and end-to-end sampling.
+
+Each benchmark is timed with timeit (the number of calls per repeat is chosen so a repeat takes at
+least MIN_TIME) and recorded as the median and best time per call, in seconds. Results are written
+as JSON with the versions and machine they were measured on, and compare checks a run against a
+stored baseline: benchmarks more than --threshold slower are flagged as regressions and make the
+command exit with status 1.
+
+    python benchmark.py run                                  models, likelihoods and data suites to latest.json
+    python benchmark.py run --suite sampling                 fixed-seed mock runs of every installed sampler
+    python benchmark.py run --output baseline.json           store a baseline
+    python benchmark.py compare baseline.json latest.json    flag regressions against the baseline
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import os
+import sys
+import json
+import time
+import timeit
+import shutil
+import argparse
+import platform
+import tempfile
+import warnings
+import subprocess
+import importlib.util
+import numpy as np
+
+
+####################################################
+###################### PATH ########################
+####################################################
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))           # Directory of benchmark.py (should be ~/21sampler/bench)
+BASE_DIR = os.path.dirname(PROJECT_ROOT)                            # Parent directory of PROJECT_ROOT (should be ~/21sampler)
+sys.path[:0] = [os.path.join(BASE_DIR, 'lib'), os.path.join(BASE_DIR, 'bin')]
+
+import models
+import kernels
+import edges
+import sampler
+
+
+####################################################
+#################### CONTROLS ######################
+####################################################
+SUITES = ('models', 'likelihoods', 'data', 'sampling')
+DEFAULT_SUITES = ('models', 'likelihoods', 'data')      # sampling takes minutes, so it is run on request
+GRID_SIZES = (50, 123, 1000, 10000)                     # Frequency channels (123 is the EDGES band)
+BATCH_SIZE = 1000                                       # Parameter points per batched call
+JOINT_SPECTRA = 64                                      # Spectra of the joint likelihoods
+MIN_TIME = 0.1                                          # Minimum duration of one timing repeat [s]
+REPEAT = 5                                              # Timing repeats per benchmark
+THRESHOLD = 0.25                                        # Relative slow-down flagged as a regression
+
+# Samplers of the sampling suite and the module each needs
+SAMPLERS = {'pymultinest': 'pymultinest', 'dynesty': 'dynesty', 'cpnest': 'cpnest', 'ultranest': 'ultranest',
+            'nestle': 'nestle', 'nessai': 'nessai', 'pypolychord': 'pypolychord'}
+SAMPLING_CASES = ('systematic_model',)                 # linearised_model mock runs take tens of minutes at low livepoints
+SAMPLING_LIVEPOINTS = 50
+SAMPLING_SEED = 1
+
+
+####################################################
+###################### TIMING ######################
+####################################################
+def measure(func, repeat=REPEAT, min_time=MIN_TIME):
+    """
+    Median and best time per call of func() [s], over repeat repeats of at least min_time each.
+    """
+
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        if timer.timeit(number) >= min_time:
+            break
+        number *= 10 if number < 1000 else 2
+    times = np.array(timer.repeat(repeat=repeat, number=number)) / number
+
+    return {'time': float(np.median(times)), 'best': float(times.min()), 'number': number, 'repeat': repeat}
+
+
+def _cases():
+    """
+    (case, model, signal, basis, foreground_keys, injection parameters) of the analytic models.
+    """
+
+    for case in ('linearised_model', 'systematic_model'):
+        model, signal, basis, foreground_keys, model_priors, theta = sampler.select_model(case)
+        theta = {k: v for k, v in theta.items() if k != 'sigma'}
+        yield case, model, signal, basis, foreground_keys, theta
+
+
+def _batch(theta, n, seed=0):
+    """
+    n parameter points scattered by 0.1% around theta, as arrays of shape (n,).
+    """
+
+    rng = np.random.default_rng(seed)
+    return {k: v * (1.0 + 1e-3 * rng.standard_normal(n)) for k, v in theta.items()}
+
+
+####################################################
+###################### SUITES ######################
+####################################################
+def suite_models():
+    """
+    Every model function per call across frequency-grid sizes, and batched over BATCH_SIZE points.
+    """
+
+    results = {}
+    for case, model, signal, basis, foreground_keys, theta in _cases():
+        functions = {case: (model, theta),
+                     signal.__name__: (signal, {k: v for k, v in theta.items() if k not in foreground_keys}),
+                     'foreground_' + case: (basis, None)}
+
+        for name, (function, params) in functions.items():
+            coeffs = [theta[k] for k in foreground_keys]
+            for n in GRID_SIZES:
+                nu = np.linspace(50.0, 100.0, n)
+                call = (lambda: function(nu, *coeffs)) if params is None else (lambda: function(nu, **params))
+                results['models/{}/n={}'.format(name, n)] = measure(call)
+
+        # Batched evaluation on the EDGES grid
+        nu = np.linspace(50.0, 100.0, 123)
+        points = _batch(theta, BATCH_SIZE)
+        result = measure(lambda: model(nu, **points))
+        result['time'] /= BATCH_SIZE
+        result['best'] /= BATCH_SIZE
+        results['models/{}/batch={}'.format(case, BATCH_SIZE)] = result
+
+    return results
+
+
+def suite_likelihoods():
+    """
+    Likelihood calls on the EDGES data (as in sampler.run), per call and per point of a batch, of the joint
+    likelihoods on JOINT_SPECTRA copies of it, and of the correlated-noise chi^2 across frequency-grid sizes.
+    """
+
+    import likelihoods
+
+    nu, Tsky, err, weight = sampler.load_data('edges', None, None)
+    results = {}
+
+    for case, model, signal, basis, foreground_keys, theta in _cases():
+        signal_theta = {k: v for k, v in theta.items() if k not in foreground_keys}
+        setups = {'spectrum': (likelihoods.SpectrumLikelihood(nu, Tsky, model, err, weight=weight), theta),
+                  'marginalised': (likelihoods.MarginalisedForegroundLikelihood(nu, Tsky, signal, basis, err, weight=weight,
+                                                                                foreground_keys=foreground_keys), signal_theta)}
+
+        for name, (likelihood, params) in setups.items():
+            result = measure(lambda: likelihood.log_likelihood(params))
+            result['calls_per_second'] = 1.0 / result['time']
+            results['likelihoods/{}/{}'.format(case, name)] = result
+
+            points = _batch(params, BATCH_SIZE)
+            result = measure(lambda: likelihood.log_likelihood(points))
+            result['time'] /= BATCH_SIZE
+            result['best'] /= BATCH_SIZE
+            result['calls_per_second'] = 1.0 / result['time']
+            results['likelihoods/{}/{}/batch={}'.format(case, name, BATCH_SIZE)] = result
+
+        stack = np.tile(Tsky, (JOINT_SPECTRA, 1))
+        coefficients = {likelihoods.spectrum_key(k, i): theta[k] for i in range(JOINT_SPECTRA) for k in foreground_keys}
+        joint = {'joint_spectrum': (likelihoods.JointSpectrumLikelihood(nu, stack, signal, basis, err, foreground_keys,
+                                                                         weight=weight), dict(signal_theta, **coefficients)),
+                 'joint_marginalised': (likelihoods.JointMarginalisedLikelihood(nu, stack, signal, basis, err, foreground_keys,
+                                                                                weight=weight), signal_theta)}
+
+        for name, (likelihood, params) in joint.items():
+            result = measure(lambda: likelihood.log_likelihood(params))
+            result['calls_per_second'] = 1.0 / result['time']
+            results['likelihoods/{}/{}/spectra={}'.format(case, name, JOINT_SPECTRA)] = result
+
+    # Correlated-noise chi^2 across frequency-grid sizes, for exponentially correlated noise over 5 channels
+    import covariance
+    for n in GRID_SIZES:
+        column = 1e-4 * np.exp(- np.arange(n) / 5.0)
+        r = np.random.default_rng(0).normal(0.0, 0.01, n)
+        solvers = {'banded': covariance.BandedCovariance(covariance.stationary_bands(column[:51], n)),
+                   'toeplitz': covariance.ToeplitzCovariance(column),
+                   'low_rank': covariance.LowRankCovariance(1e-4, 1e-3 * np.cos(np.outer(np.arange(n) / n, np.arange(8)) * np.pi))}
+        if n <= 1000:
+            solvers['dense'] = covariance.DenseCovariance(solvers['toeplitz'].matrix())
+        for name, solver in solvers.items():
+            results['likelihoods/correlated_noise/{}/n={}'.format(name, n)] = measure(lambda: solver.chi2(r))
+
+    return results
+
+
+def suite_data():
+    """
+    EDGES data loading from the binary cache, and from the text release (cache rebuilt in a temporary directory).
+    """
+
+    results = {'data/read_edges': measure(edges.read_edges)}
+
+    directory = tempfile.mkdtemp()
+    cache_dir = edges.CACHE_DIR
+    try:
+        def cold():
+            edges.CACHE_DIR = tempfile.mkdtemp(dir=directory)
+            edges.read_edges()
+        results['data/read_edges_uncached'] = measure(cold, min_time=MIN_TIME / 4)
+    finally:
+        edges.CACHE_DIR = cache_dir
+        shutil.rmtree(directory)
+
+    results['data/load_mock'] = measure(lambda: sampler.load_data('mock', models.linearised_model,
+                                                                  next(_cases())[5], seed=SAMPLING_SEED))
+
+    return results
+
+
+def available_samplers():
+    return [name for name, module in SAMPLERS.items() if importlib.util.find_spec(module) is not None]
+
+
+def suite_sampling(livepoints=SAMPLING_LIVEPOINTS):
+    """
+    Fixed-seed end-to-end runs (sampler.run) of every installed sampler on mock data, written to a
+    temporary directory. Each is timed once: wall time of the whole run and of the sampling phase.
+    The foreground is marginalised, so each run takes seconds at small livepoint counts.
+    """
+
+    import bilby
+    bilby.core.utils.logger.setLevel('WARNING')
+
+    results = {}
+    directory, sampler.directory = sampler.directory, tempfile.mkdtemp()
+    try:
+        for name in available_samplers():
+            for case in SAMPLING_CASES:
+                key = 'sampling/{}/{}/nlive={}'.format(name, case, livepoints)
+                start = time.perf_counter()
+                try:
+                    with warnings.catch_warnings():
+                        warnings.simplefilter('ignore')
+                        result = sampler.run(sampler=name, case=case, data='mock', livepoints=livepoints,
+                                             marginalise=True, seed=SAMPLING_SEED, timing=True)
+                except Exception as e:
+                    results[key] = {'error': '{}: {}'.format(type(e).__name__, e)}
+                    continue
+
+                label, outdir = sampler.output_label(case, 'mock', name, livepoints, marginalise=True, seed=SAMPLING_SEED)
+                with open('{}/{}_timing.json'.format(outdir, label)) as f:
+                    timing = json.load(f)
+                results[key] = {'time': time.perf_counter() - start,
+                                'sampling_time': timing['phases']['sampling']['wall_time'],
+                                'likelihood_calls': timing['counters']['likelihood']['calls'],
+                                'log_evidence': result.log_evidence,
+                                'log_evidence_err': result.log_evidence_err}
+    finally:
+        shutil.rmtree(sampler.directory)
+        sampler.directory = directory
+
+    return results
+
+
+####################################################
+####################### RUN ########################
+####################################################
+def environment():
+    """
+    Versions and machine the benchmarks ran on.
+    """
+
+    import scipy
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    try:
+        import bilby
+        bilby_version = bilby.__version__
+    except ImportError:
+        bilby_version = None
+    try:
+        import numba
+        numba_version = numba.__version__
+    except ImportError:
+        numba_version = None
+
+    return {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__, 'bilby': bilby_version,
+            'numba': numba_version, 'kernels': 'numba' if kernels.enabled() else 'numpy', 'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'system': platform.platform()}
+
+
+def run(suites=DEFAULT_SUITES, livepoints=SAMPLING_LIVEPOINTS):
+    """
+    {'environment': ..., 'results': {benchmark: {'time': ..., ...}}} for the chosen suites.
+    """
+
+    functions = {'models': suite_models, 'likelihoods': suite_likelihoods, 'data': suite_data,
+                 'sampling': lambda: suite_sampling(livepoints)}
+
+    results = {}
+    for suite in suites:
+        print('Running the {} suite'.format(suite))
+        results.update(functions[suite]())
+
+    return {'environment': environment(), 'results': results}
+
+
+####################################################
+##################### COMPARE ######################
+####################################################
+def compare(baseline, current, threshold=THRESHOLD):
+    """
+    (benchmark, baseline time, current time, ratio, status) for every benchmark in both runs.
+    status is 'regression' if current is more than threshold slower, 'improvement' if more than
+    threshold faster, 'failed' if the current run failed it, and 'ok' otherwise.
+    """
+
+    rows = []
+    for name in sorted(set(baseline['results']) & set(current['results'])):
+        old, new = baseline['results'][name], current['results'][name]
+        if 'error' in new:
+            rows.append((name, old.get('time'), None, None, 'failed'))
+            continue
+        if 'error' in old:
+            rows.append((name, None, new['time'], None, 'ok'))
+            continue
+
+        ratio = new['time'] / old['time']
+        if ratio > 1.0 + threshold:
+            status = 'regression'
+        elif ratio < 1.0 / (1.0 + threshold):
+            status = 'improvement'
+        else:
+            status = 'ok'
+        rows.append((name, old['time'], new['time'], ratio, status))
+
+    return rows
+
+
+def _format_time(t):
+    if t is None:
+        return '-'
+    for unit, scale in (('s', 1.0), ('ms', 1e-3), ('us', 1e-6)):
+        if t >= scale:
+            return '{:.3g} {}'.format(t / scale, unit)
+    return '{:.3g} ns'.format(t / 1e-9)
+
+
+def print_comparison(rows):
+    width = max(len(row[0]) for row in rows)
+    print('{:{w}}  {:>10}  {:>10}  {:>7}  {}'.format('benchmark', 'baseline', 'current', 'ratio', 'status', w=width))
+    for name, old, new, ratio, status in rows:
+        print('{:{w}}  {:>10}  {:>10}  {:>7}  {}'.format(name, _format_time(old), _format_time(new),
+                                                         '-' if ratio is None else '{:.2f}'.format(ratio),
+                                                         status.upper() if status != 'ok' else status, w=width))
+
+
+####################################################
+####################### MAIN #######################
+####################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of 21sampler.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_run = commands.add_parser('run', help='Run benchmark suites and write the results as JSON')
+    parser_run.add_argument('--suite', nargs='+', choices=SUITES + ('all',), default=list(DEFAULT_SUITES))
+    parser_run.add_argument('--livepoints', type=int, default=SAMPLING_LIVEPOINTS, help='Livepoints of the sampling suite')
+    parser_run.add_argument('--output', default=os.path.join(PROJECT_ROOT, 'latest.json'))
+
+    parser_compare = commands.add_parser('compare', help='Compare results against a baseline')
+    parser_compare.add_argument('baseline')
+    parser_compare.add_argument('current', nargs='?', default=os.path.join(PROJECT_ROOT, 'latest.json'))
+    parser_compare.add_argument('--threshold', type=float, default=THRESHOLD, help='Relative slow-down flagged as a regression')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        suites = SUITES if 'all' in args.suite else args.suite
+        report = run(suites, args.livepoints)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        for name, result in report['results'].items():
+            print('{:55} {}'.format(name, result['error'] if 'error' in result else _format_time(result['time'])))
+        print('Wrote {}'.format(args.output))
+
+    elif args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        rows = compare(baseline, current, args.threshold)
+        print_comparison(rows)
+        regressions = [row for row in rows if row[4] in ('regression', 'failed')]
+        print('{} benchmarks, {} regressions'.format(len(rows), len(regressions)))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Efficiency comparison of the samplers on one case and data set.
+
+Every sampler (installed or not) is run through sampler.run with the same livepoints, seed,
+priors and likelihood, each in its own process so that a crash, an exception or a run past
+--timeout is recorded as a result instead of ending the comparison. For each sampler the report
+gives the wall time, likelihood evaluations, effective posterior samples (Kish's estimate from the
+nested sample weights) and evaluations per effective sample, effective samples per CPU-hour,
+log Z and its error, and how far its parameter medians are from the consensus (the median over
+samplers), in units of each sampler's own 1-sigma error.
+
+    python efficiency.py                                         systematic model on the EDGES data
+    python efficiency.py --case linearised_model --data mock --marginalise
+    python efficiency.py --samplers dynesty pymultinest --livepoints 500 --timeout 3600
+
+The runs are written to samples/efficiency/<case>_<data>/ and the report to
+samples/efficiency/efficiency_<case>_<data>_<livepoints>.json.
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import os
+import sys
+import json
+import time
+import argparse
+import warnings
+import traceback
+import multiprocessing
+import numpy as np
+from benchmark import BASE_DIR, SAMPLERS, available_samplers     # also puts lib and bin on the path
+
+import sampler
+import summary
+import result_store
+
+
+####################################################
+#################### CONTROLS ######################
+####################################################
+directory = '{}/samples/efficiency'.format(BASE_DIR)   # Directory the runs and reports are written to
+case = 'systematic_model'
+data = 'edges'
+livepoints = 500
+seed = 1
+marginalise = False
+timeout = None                                          # Seconds before a run is stopped (None for no limit)
+
+
+####################################################
+####################### RUN ########################
+####################################################
+def effective_samples(weights):
+    """
+    Kish's effective sample size (sum w)^2 / sum w^2 of weighted samples.
+    """
+
+    w = np.asarray(weights, dtype=float)
+    return float(np.sum(w)**2 / np.sum(w**2))
+
+
+def _measure(job):
+    """
+    Run one sampler and return its metrics (in the child process).
+    """
+
+    sampler.directory = job.pop('directory')
+    start = time.perf_counter()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        result = sampler.run(timing=True, npool=1, **job)
+    wall_time = time.perf_counter() - start
+
+    label, outdir = sampler.output_label(job['case'], job['data'], job['sampler'], job['livepoints'],
+                                         marginalise=job['marginalise'], seed=job['seed'])
+    with open('{}/{}_timing.json'.format(outdir, label)) as f:
+        timing = json.load(f)
+    sampling = timing['phases']['sampling']
+
+    # Likelihood calls counted in this process, or as reported by the sampler if it evaluated them elsewhere
+    calls = timing['counters'].get('likelihood', {}).get('calls')
+    if not calls:
+        try:
+            calls = result.num_likelihood_evaluations
+        except ValueError:
+            calls = None
+
+    with result_store.ResultStore.open(outdir, label) as store:
+        nested = store.nested_samples()
+        keys = store.search_parameter_keys
+        stats = summary.summarise(store, keys)
+        n_posterior = len(store[keys[0]])
+    ess = effective_samples(nested['weights']) if 'weights' in nested else float(n_posterior)
+    cpu_hours = (sampling['cpu_time'] + sampling['children_cpu_time']) / 3600.0
+
+    return {'status': 'completed',
+            'wall_time': wall_time,
+            'sampling_time': sampling['wall_time'],
+            'cpu_time': sampling['cpu_time'] + sampling['children_cpu_time'],
+            'likelihood_calls': calls,
+            'posterior_samples': n_posterior,
+            'effective_samples': ess,
+            'calls_per_effective_sample': calls / ess if calls else None,
+            'effective_samples_per_cpu_hour': ess / cpu_hours if cpu_hours > 0 else None,
+            'log_evidence': result.log_evidence,
+            'log_evidence_err': result.log_evidence_err,
+            'parameters': {k: {s: stats[k][s] for s in ('median', 'minus', 'plus')} for k in keys}}
+
+
+def _child(connection, job):
+    try:
+        outcome = _measure(job)
+    except BaseException as e:
+        outcome = {'status': 'failed', 'error_type': type(e).__name__, 'message': str(e),
+                   'traceback': traceback.format_exc()}
+    connection.send(outcome)
+    connection.close()
+
+
+def run_sampler(name, case=case, data=data, livepoints=livepoints, seed=seed, marginalise=marginalise,
+                directory=directory, timeout=timeout):
+    """
+    Metrics of one sampler run in a separate process, or its failure: {'status': 'failed', 'crashed',
+    'timeout' or 'unavailable', 'error_type', 'message', ...}.
+    """
+
+    if name not in available_samplers():
+        return {'sampler': name, 'status': 'unavailable', 'error_type': 'ImportError',
+                'message': 'No module named {}'.format(SAMPLERS.get(name, name))}
+
+    job = dict(sampler=name, case=case, data=data, livepoints=livepoints, seed=seed, marginalise=marginalise,
+               directory=directory)
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_child, args=(sender, job))
+
+    start = time.perf_counter()
+    process.start()
+    sender.close()
+
+    outcome = None
+    if receiver.poll(timeout):
+        try:
+            outcome = receiver.recv()
+        except EOFError:
+            pass
+    process.join(1.0 if outcome is None and process.is_alive() else None)
+
+    if outcome is None and process.is_alive():
+        process.terminate()
+        process.join()
+        outcome = {'status': 'timeout', 'error_type': 'TimeoutError',
+                   'message': 'Stopped after {} s'.format(timeout)}
+    elif outcome is None:
+        outcome = {'status': 'crashed', 'error_type': 'ProcessError',
+                   'message': 'Exited with code {} without a result'.format(process.exitcode)}
+
+    outcome.setdefault('wall_time', time.perf_counter() - start)
+    return dict(sampler=name, **outcome)
+
+
+####################################################
+##################### COMPARE ######################
+####################################################
+def agreement(outcomes):
+    """
+    Add to each completed outcome the deviation of its parameter medians from the consensus median
+    (the median over completed samplers), in units of its own 1-sigma error, and the largest of them.
+    """
+
+    completed = [o for o in outcomes if o['status'] == 'completed']
+    if not completed:
+        return outcomes
+
+    keys = completed[0]['parameters']
+    consensus = {k: float(np.median([o['parameters'][k]['median'] for o in completed])) for k in keys}
+
+    for o in completed:
+        deviation = {}
+        for k in keys:
+            p = o['parameters'][k]
+            error = (p['minus'] + p['plus']) / 2.0
+            deviation[k] = (p['median'] - consensus[k]) / error if error > 0 else float('inf')
+        o['median_deviation'] = deviation
+        o['max_median_deviation'] = max(abs(d) for d in deviation.values())
+
+    return outcomes
+
+
+def compare(samplers=None, case=case, data=data, livepoints=livepoints, seed=seed, marginalise=marginalise,
+            directory=directory, timeout=timeout):
+    """
+    Run every sampler (all of SAMPLERS by default) with matched settings and return the report.
+    """
+
+    samplers = samplers or list(SAMPLERS)
+    settings = dict(case=case, data=data, livepoints=livepoints, seed=seed, marginalise=marginalise)
+    outdir = os.path.join(directory, '{}_{}'.format(case, data))
+
+    outcomes = []
+    for name in samplers:
+        print('Running {}'.format(name))
+        outcomes.append(run_sampler(name, directory=directory, timeout=timeout, **settings))
+        print('  {}'.format(outcomes[-1]['status']))
+
+    return {'settings': settings, 'directory': outdir, 'results': agreement(outcomes)}
+
+
+def print_report(report):
+    header = '{:12} {:>10} {:>10} {:>9} {:>10} {:>12} {:>18} {:>10}'
+    row = '{:12} {:>10.1f} {:>10} {:>9.0f} {:>10} {:>12} {:>18} {:>10.2f}'
+    print(header.format('sampler', 'wall [s]', 'calls', 'ESS', 'calls/ESS', 'ESS/CPU-h', 'log Z', 'max dev'))
+    for o in report['results']:
+        if o['status'] != 'completed':
+            print('{:12} {}: {}: {}'.format(o['sampler'], o['status'].upper(), o['error_type'], o['message'].splitlines()[0] if o['message'] else ''))
+            continue
+        print(row.format(o['sampler'], o['wall_time'], o['likelihood_calls'] or '-', o['effective_samples'],
+                         '-' if o['calls_per_effective_sample'] is None else '{:.1f}'.format(o['calls_per_effective_sample']),
+                         '-' if o['effective_samples_per_cpu_hour'] is None else '{:.3g}'.format(o['effective_samples_per_cpu_hour']),
+                         '{:.2f} +/- {:.2f}'.format(o['log_evidence'], o['log_evidence_err']), o['max_median_deviation']))
+
+
+####################################################
+####################### MAIN #######################
+####################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the efficiency of the samplers with matched settings.')
+    parser.add_argument('--samplers', nargs='+', default=list(SAMPLERS))
+    parser.add_argument('--case', default=case)
+    parser.add_argument('--data', default=data)
+    parser.add_argument('--livepoints', type=int, default=livepoints)
+    parser.add_argument('--seed', type=int, default=seed)
+    parser.add_argument('--marginalise', action='store_true', help='Marginalise the foreground coefficients')
+    parser.add_argument('--timeout', type=float, default=timeout, help='Seconds before a run is stopped')
+    parser.add_argument('--directory', default=directory)
+    args = parser.parse_args()
+
+    report = compare(args.samplers, args.case, args.data, args.livepoints, args.seed, args.marginalise,
+                     args.directory, args.timeout)
+
+    os.makedirs(args.directory, exist_ok=True)
+    path = os.path.join(args.directory, 'efficiency_{}_{}_{}.json'.format(args.case, args.data, args.livepoints))
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print_report(report)
+    print('Wrote {}'.format(path))
+    sys.exit(0 if any(o['status'] == 'completed' for o in report['results']) else 1)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Campaign runner for sweeps over sampler/model/data/livepoint combinations.
+
+A campaign is a JSON file in which each key is an argument of sampler.run. A list is expanded as
+an axis of the job matrix, anything else is held fixed for every job, e.g.
+
+    {"case": ["linearised_model", "systematic_model"], "data": "edges",
+     "sampler": ["pymultinest", "dynesty"], "livepoints": [50, 500], "seed": [1, 2],
+     "marginalise": false}
+
+Jobs whose configuration hash already has a completed result in samples/<case>_<data>/<label> are skipped.
+
+    python campaign.py sweep.json                            run the pending jobs on local processes
+    python campaign.py sweep.json --dry-run                  list the jobs and whether they are done
+    python campaign.py sweep.json --manifest jobs.txt        write an HPC array-job manifest (and jobs.txt.slurm)
+    python campaign.py sweep.json --manifest jobs.txt --task-id $SLURM_ARRAY_TASK_ID    run one job of it
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import os
+import sys
+import json
+import hashlib
+import argparse
+import itertools
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+import sampler                     # sampler.run and the output layout
+
+MARKER = 'campaign_job.json'       # Written in the output directory of each completed job
+
+# Arguments that change how a job runs but not its result, so neither its output directory nor its hash
+EXECUTION_KEYS = ('npool', 'timing', 'mpi')
+
+
+####################################################
+####################### JOBS #######################
+####################################################
+def expand(config):
+    """
+    List of jobs (dicts of sampler.run arguments) from the matrix in config.
+    """
+
+    swept = [k for k in EXECUTION_KEYS if isinstance(config.get(k), list)]
+    if swept:
+        raise ValueError('{} cannot be swept, as jobs differing only in it would share an output directory'.format(
+                         ', '.join(swept)))
+
+    axes = {k: (v if isinstance(v, list) else [v]) for k, v in config.items()}
+    keys = sorted(axes)
+
+    return [dict(zip(keys, values)) for values in itertools.product(*(axes[k] for k in keys))]
+
+
+def job_hash(job):
+    """
+    Hash of the job configuration, used to recognise completed jobs. The execution keys are left out,
+    so a job rerun with another npool is still complete.
+    """
+
+    config = {k: v for k, v in job.items() if k not in EXECUTION_KEYS}
+
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def job_outdir(job):
+    """
+    (label, outdir) of the job, as used by sampler.run.
+    """
+
+    args = {k: job[k] for k in ('ares_mode', 'marginalise', 'seed', 'warm_start', 'tighten', 'n_spectra') if k in job}
+    return sampler.output_label(job.get('case', sampler.case), job.get('data', sampler.data),
+                                job.get('sampler', sampler.sampler), job.get('livepoints', sampler.livepoints), **args)
+
+
+def is_complete(job):
+    """
+    True if the job's output directory has a result and a marker with the same configuration hash.
+    """
+
+    label, outdir = job_outdir(job)
+    try:
+        with open(os.path.join(outdir, MARKER)) as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    results = ['{}_result.json'.format(label), '{}_result.npz'.format(label)]
+    return marker.get('hash') == job_hash(job) and any(os.path.exists(os.path.join(outdir, r)) for r in results)
+
+
+def run_job(job):
+    """
+    Run one job and mark it complete. Failures are returned rather than raised, so a sweep carries on.
+    """
+
+    try:
+        result = sampler.run(**job)
+    except Exception:
+        return dict(job=job, status='failed', error=traceback.format_exc())
+
+    label, outdir = job_outdir(job)
+    marker = dict(job=job, hash=job_hash(job), status='completed', log_evidence=result.log_evidence)
+    with open(os.path.join(outdir, MARKER), 'w') as f:
+        json.dump(marker, f, indent=2)
+
+    return marker
+
+
+####################################################
+##################### SCHEDULING ###################
+####################################################
+def _run_job(job, sender):
+    sender.send(run_job(job))
+    sender.close()
+
+
+def run_local(jobs, processes=1):
+    """
+    Run jobs on local processes, processes at a time. Each job gets a fresh process, as the samplers keep
+    global state, and the processes are not daemonic, so a job with npool > 1 can start its own pool.
+    """
+
+    pending, running = list(jobs), {}
+    while pending or running:
+        while pending and len(running) < processes:
+            job = pending.pop(0)
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_run_job, args=(job, sender))
+            process.start()
+            sender.close()
+            running[receiver] = (process, job)
+
+        # A job's pipe is ready when it sends its outcome, or at end of file if its process died
+        for receiver in wait(list(running)):
+            process, job = running.pop(receiver)
+            try:
+                outcome = receiver.recv()
+            except EOFError:
+                outcome = None
+            process.join()
+            if outcome is None:
+                outcome = dict(job=job, status='failed', error='Job process exited with code {}'.format(process.exitcode))
+
+            print('{}: {}'.format(outcome['status'], job_outdir(job)[0]))
+            if outcome['status'] == 'failed':
+                print(outcome['error'])
+
+
+def write_manifest(jobs, path, config_path):
+    """
+    Write one job per line to path and a SLURM array script that runs line $SLURM_ARRAY_TASK_ID.
+    """
+
+    with open(path, 'w') as f:
+        for job in jobs:
+            f.write(json.dumps(job, sort_keys=True) + '\n')
+
+    with open(path + '.slurm', 'w') as f:
+        f.write('#!/bin/bash\n')
+        f.write('#SBATCH --array=0-{}\n'.format(len(jobs) - 1))
+        f.write('python {} {} --manifest {} --task-id $SLURM_ARRAY_TASK_ID\n'.format(
+                os.path.abspath(__file__), os.path.abspath(config_path), os.path.abspath(path)))
+
+
+def read_manifest(path, task_id):
+    with open(path) as f:
+        return json.loads(f.readlines()[task_id])
+
+
+####################################################
+####################### MAIN #######################
+####################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a sweep of sampler.py jobs.')
+    parser.add_argument('config', help='JSON campaign file')
+    parser.add_argument('--processes', type=int, default=1, help='Jobs run at once on local processes')
+    parser.add_argument('--dry-run', action='store_true', help='List the jobs without running them')
+    parser.add_argument('--manifest', help='Array-job manifest to write (or to read with --task-id)')
+    parser.add_argument('--task-id', type=int, help='Run this line of the manifest')
+    args = parser.parse_args()
+
+    # Run a single job of an array
+    if args.task_id is not None:
+        job = read_manifest(args.manifest, args.task_id)
+        if is_complete(job):
+            print('complete: {}'.format(job_outdir(job)[0]))
+            sys.exit()
+        outcome = run_job(job)
+        print('{}: {}'.format(outcome['status'], job_outdir(job)[0]))
+        sys.exit(outcome['status'] != 'completed')
+
+    with open(args.config) as f:
+        jobs = expand(json.load(f))
+    pending = [job for job in jobs if not is_complete(job)]
+    print('{} jobs, {} already complete'.format(len(jobs), len(jobs) - len(pending)))
+
+    if args.dry_run:
+        for job in jobs:
+            print('{:9} {}'.format('pending' if job in pending else 'complete', job_outdir(job)[0]))
+    elif args.manifest and pending:
+        write_manifest(pending, args.manifest, args.config)
+        print('Wrote {} and {}.slurm'.format(args.manifest, args.manifest))
+    elif pending and not args.manifest:
+        run_local(pending, args.processes)
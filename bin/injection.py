@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+Mock injection/recovery: many seeded mock spectra of one model, inference on each across a process pool,
+and the credible-interval coverage (P-P) and bias of every parameter.
+
+Realization i is the 'mock' data of sampler.py with seed seeds[i], where the seeds are independent streams
+spawned from --seed (recorded with the output, so any one realization reruns as sampler.run(data='mock',
+seed=seeds[i])). The spectra are generated in one batch (see sampler.mock_spectra). Each realization is
+fitted with the Fisher/Laplace forecast of laplace.py (well under a second each), or sampled with one of
+the nested samplers of sampler.py (reusing finished runs). For a calibrated method, the posterior percentile
+of the true value is uniform over the realizations: the fraction of true values within the central p credible
+interval is p at every level.
+
+    python injection.py --case systematic_model -n 1000 --processes 8                 Laplace fits of 1000 mocks
+    python injection.py --case systematic_model -n 100 --method dynesty --livepoints 200 --marginalise
+    python injection.py --case linearised_model -n 1000 --from-priors                 injections drawn from the priors
+
+Writes samples/<case>_mock/coverage/<label>.json (per-realization percentiles, medians and widths, and the
+coverage, bias and Kolmogorov-Smirnov p-value of each parameter) and a P-P plot <label>.png.
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import os
+import json
+import time
+import argparse
+import traceback
+from multiprocessing import Pool
+import numpy as np
+import sampler                     # models, priors, mock data and sampler.run
+
+# Credible levels at which the coverage is tabulated (the P-P curve)
+LEVELS = np.linspace(0.0, 1.0, 101)
+
+# Credible levels printed in the summary table
+TABLE_LEVELS = (0.5, 0.68, 0.9, 0.95)
+
+
+####################################################
+#################### INJECTIONS ####################
+####################################################
+def realization_seeds(n, sequence):
+    """
+    Distinct seeds of the noise of n realizations, independent streams of the np.random.SeedSequence sequence.
+    They are 31-bit, as the samplers take them as C ints.
+    """
+
+    words = sequence.generate_state(2 * n, dtype=np.uint32) >> 1
+
+    return list(dict.fromkeys(words.tolist()))[:n]
+
+
+def injections(model_priors, theta, n, from_priors=False, rng=None):
+    """
+    True parameters {key: array of shape (n,)}: theta for every realization, or drawn uniformly from the
+    priors with the generator rng. 'sigma', the noise level of the mock data, is not drawn.
+    """
+
+    truth = {}
+    for k, v in model_priors.items():
+        if from_priors and k != 'sigma':
+            truth[k] = rng.uniform(v[0][0], v[0][1], n)
+        else:
+            truth[k] = np.full(n, float(theta[k]))
+
+    return truth
+
+
+####################################################
+##################### WORKERS ######################
+####################################################
+_setup = None       # Settings of the worker: the case, mock grid, bounds and method
+
+
+def _init_worker(setup):
+    global _setup
+    _setup = setup
+
+
+def _laplace(Tsky, seed):
+    """
+    Marginal posteriors of one realization from the Laplace forecast: for each parameter the Gaussian
+    around the best fit, truncated to the priors, as (cdf, median, std).
+    """
+
+    import laplace
+    from scipy.special import ndtr, ndtri
+
+    model = sampler.select_model(_setup['case'], _setup['ares_mode'])[0]
+    bounds = _setup['bounds']
+    report = laplace.forecast(model, _setup['nu'], Tsky, _setup['err'], bounds, weight=_setup['weight'], seed=seed)
+
+    marginals = {}
+    for k in report['parameters']:
+        mean, std = report['best_fit'][k], report['std'][k]
+        lower, upper = ndtr((bounds[k][0] - mean) / std), ndtr((bounds[k][1] - mean) / std)
+        median = mean + std * ndtri(lower + 0.5 * (upper - lower))
+        marginals[k] = (lambda x, mean=mean, std=std, lower=lower, upper=upper:
+                        float(np.clip((ndtr((x - mean) / std) - lower) / (upper - lower), 0.0, 1.0)), float(median), std)
+
+    return marginals
+
+
+def _sampled(seed):
+    """
+    Marginal posteriors of one realization from a nested-sampling run of sampler.py (reused if finished),
+    as (cdf, median, std) of the posterior samples.
+    """
+
+    s = _setup
+    setup = (s['case'], 'mock', s['method'], s['livepoints'], s['ares_mode'], s['marginalise'], seed)
+    if sampler.find_run(*setup) is None:
+        sampler.run(sampler=s['method'], case=s['case'], data='mock', livepoints=s['livepoints'], npool=1,
+                    ares_mode=s['ares_mode'], marginalise=s['marginalise'], seed=seed, timing=False,
+                    warm_start=None, tighten=None, mpi=False)
+    label, outdir = sampler.find_run(*setup)
+    posterior = sampler.read_posterior(outdir, label)
+
+    marginals = {}
+    for k in s['bounds']:
+        if k in posterior:
+            x = np.sort(posterior[k])
+            marginals[k] = (lambda t, x=x: float(np.searchsorted(x, t) / len(x)), float(np.median(x)), float(np.std(x)))
+
+    return marginals
+
+
+def _recover(task):
+    """
+    Posterior percentile of the true value, median and width of each parameter for one realization.
+    Failures are returned rather than raised, so the other realizations carry on.
+    """
+
+    index, Tsky, seed, truth = task
+    try:
+        if _setup['method'] == 'laplace':
+            marginals = _laplace(Tsky, seed)
+        else:
+            marginals = _sampled(seed)
+    except Exception:
+        return dict(index=index, seed=seed, error=traceback.format_exc())
+
+    return dict(index=index, seed=seed, truth=truth,
+                percentile={k: m[0](truth[k]) for k, m in marginals.items()},
+                median={k: m[1] for k, m in marginals.items()},
+                std={k: m[2] for k, m in marginals.items()})
+
+
+####################################################
+##################### COVERAGE #####################
+####################################################
+def coverage(percentiles, levels=LEVELS):
+    """
+    Fraction of realizations whose true value lies within the central credible interval of each level,
+    from the posterior percentiles of the true values.
+    """
+
+    p = np.asarray(percentiles, dtype=float)
+    distance = np.abs(2.0 * p - 1.0)
+
+    return np.mean(distance[:, np.newaxis] <= np.asarray(levels)[np.newaxis, :], axis=0)
+
+
+def aggregate(records, keys, levels=LEVELS):
+    """
+    Per parameter: the coverage at levels, the Kolmogorov-Smirnov p-value of the percentiles against a
+    uniform distribution, and the bias of the posterior medians (mean and standard error, also in units
+    of the posterior width), with the p-value of all parameters combined by Fisher's method.
+    """
+
+    from scipy import stats
+
+    summary = {}
+    for k in keys:
+        rows = [r for r in records if k in r['percentile']]
+        if not rows:
+            continue
+        p = np.array([r['percentile'][k] for r in rows])
+        error = np.array([r['median'][k] - r['truth'][k] for r in rows])
+        pull = error / np.array([r['std'][k] for r in rows])
+        summary[k] = dict(n=len(rows), coverage=coverage(p, levels).tolist(), ks_pvalue=float(stats.kstest(p, 'uniform').pvalue),
+                          bias=float(np.mean(error)), bias_error=float(np.std(error) / np.sqrt(len(rows))),
+                          rms_error=float(np.sqrt(np.mean(error**2))), pull_mean=float(np.mean(pull)), pull_std=float(np.std(pull)))
+
+    combined = stats.combine_pvalues([s['ks_pvalue'] for s in summary.values()], method='fisher').pvalue if summary else np.nan
+
+    return summary, float(combined)
+
+
+def print_coverage(summary, combined, levels=LEVELS, table_levels=TABLE_LEVELS):
+    """
+    Table of the coverage at table_levels, the KS p-value and the bias of each parameter.
+    """
+
+    columns = [int(np.argmin(np.abs(np.asarray(levels) - q))) for q in table_levels]
+    print('{:8} {:>6} '.format('', 'n') + ' '.join('{:>7}'.format('{:.0%}'.format(q)) for q in table_levels) +
+          ' {:>9} {:>12} {:>10} {:>10}'.format('KS p', 'bias', 'pull mean', 'pull std'))
+    for k, s in summary.items():
+        print('{:8} {:>6} '.format(k, s['n']) + ' '.join('{:>7.3f}'.format(s['coverage'][j]) for j in columns) +
+              ' {:>9.3f} {:>12.4g} {:>10.3f} {:>10.3f}'.format(s['ks_pvalue'], s['bias'], s['pull_mean'], s['pull_std']))
+    print('Combined KS p-value: {:.3f}'.format(combined))
+
+
+def plot_pp(summary, path, levels=LEVELS):
+    """
+    P-P plot: the coverage of each parameter against the credible level, within the 1, 2 and 3 sigma
+    binomial bands of a calibrated method.
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from scipy import stats
+
+    n = min(s['n'] for s in summary.values())
+    fig, ax = plt.subplots(figsize=(5, 5))
+    for q, alpha in ((0.68, 0.1), (0.95, 0.1), (0.997, 0.1)):
+        lower, upper = stats.binom.interval(q, n, levels)
+        ax.fill_between(levels, lower / n, upper / n, color='k', alpha=alpha, lw=0)
+    for k, s in summary.items():
+        ax.plot(levels, s['coverage'], label='{} ({:.3f})'.format(k, s['ks_pvalue']))
+
+    ax.set_xlim(0, 1)
+    ax.set_ylim(0, 1)
+    ax.set_xlabel('Credible level')
+    ax.set_ylabel('Fraction of injections within the credible interval')
+    ax.legend(fontsize='small', title='KS p-value')
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
+
+####################################################
+###################### RUNNER ######################
+####################################################
+def coverage_label(case, n, method='laplace', livepoints=None, marginalise=False, seed=None, from_priors=False):
+    """
+    Label and output directory of a coverage study, samples/<case>_mock/coverage/<label>.
+    """
+
+    label = '{}_mock_coverage_{}'.format(case, method)
+    if method != 'laplace':
+        label += '_{}'.format(livepoints)
+        if marginalise:
+            label += '_marginalised'
+    if from_priors:
+        label += '_priors'
+    label += '_n{}'.format(n)
+    if seed is not None:
+        label += '_seed{}'.format(seed)
+
+    return label, sampler.directory + '/{}_mock/coverage'.format(case)
+
+
+def run_coverage(case=sampler.case, n=1000, method='laplace', livepoints=100, marginalise=False, ares_mode='exact',
+                 seed=None, from_priors=False, theta=None, processes=1, plot=True):
+    """
+    Inject, recover and aggregate n mock realizations of case (see the module docstring). theta overrides
+    the injection parameters of the case. Returns the output written to the coverage JSON.
+    """
+
+    begin = time.perf_counter()
+    model, signal, basis, foreground_keys, model_priors, case_theta = sampler.select_model(case, ares_mode)
+    case_theta = dict(case_theta, **(theta or {}))
+    if method != 'laplace' and (from_priors or theta):
+        raise ValueError('Sampled realizations are reruns of sampler.py, which injects the parameters of the case')
+
+    nu, _, err, weight = sampler.load_data('mock', model, case_theta)
+    sequence = np.random.SeedSequence(seed)
+    noise, draws = sequence.spawn(2)
+    seeds = realization_seeds(n, noise)
+    truth = injections(model_priors, case_theta, n, from_priors, np.random.default_rng(draws))
+
+    # All spectra at once: one batched model evaluation and an independent noise stream per realization
+    Tsky = sampler.mock_spectra(model, nu, truth, err, seeds)
+
+    setup = dict(case=case, ares_mode=ares_mode, method=method, livepoints=livepoints, marginalise=marginalise,
+                 nu=nu, err=err, weight=weight, bounds={k: (float(v[0][0]), float(v[0][1])) for k, v in model_priors.items()})
+    tasks = [(i, Tsky[i], seeds[i], {k: float(v[i]) for k, v in truth.items()}) for i in range(n)]
+
+    # Laplace fits share warm workers; each sampler run gets a fresh process, as the samplers keep global state
+    records, failures = [], []
+    if method == 'laplace':
+        pool = Pool(processes, initializer=_init_worker, initargs=(setup,))
+        chunksize = max(1, n // (4 * processes))
+    else:
+        pool = Pool(processes, initializer=_init_worker, initargs=(setup,), maxtasksperchild=1)
+        chunksize = 1
+    with pool:
+        for record in pool.imap_unordered(_recover, tasks, chunksize=chunksize):
+            (failures if 'error' in record else records).append(record)
+    records.sort(key=lambda r: r['index'])
+    for failure in failures[:3]:
+        print('Realization {} failed:\n{}'.format(failure['index'], failure['error']))
+
+    summary, combined = aggregate(records, list(model_priors))
+    label, outdir = coverage_label(case, n, method, livepoints, marginalise, seed, from_priors)
+    output = dict(case=case, method=method, livepoints=livepoints if method != 'laplace' else None, marginalise=marginalise,
+                  ares_mode=ares_mode, n=n, seed=seed, entropy=str(sequence.entropy), from_priors=from_priors,
+                  theta=None if from_priors else {k: float(v) for k, v in case_theta.items()},
+                  levels=LEVELS.tolist(), parameters=summary, combined_ks_pvalue=combined,
+                  failures=[dict(index=f['index'], seed=f['seed']) for f in failures],
+                  realizations=records, time=time.perf_counter() - begin)
+
+    os.makedirs(outdir, exist_ok=True)
+    with open(os.path.join(outdir, label + '.json'), 'w') as f:
+        json.dump(output, f, indent=1)
+    if plot and summary:
+        plot_pp(summary, os.path.join(outdir, label + '.png'))
+
+    print('{} of {} realizations recovered in {:.1f} s'.format(len(records), n, output['time']))
+    print_coverage(summary, combined)
+
+    return output
+
+
+####################################################
+####################### MAIN #######################
+####################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Coverage and bias of the inference over seeded mock realizations.')
+    parser.add_argument('--case', default=sampler.case, help='Model of sampler.py')
+    parser.add_argument('-n', type=int, default=1000, help='Mock realizations')
+    parser.add_argument('--method', default='laplace', help="'laplace', or a sampler of sampler.py")
+    parser.add_argument('--livepoints', type=int, default=100, help='Livepoints of the sampler')
+    parser.add_argument('--marginalise', action='store_true', help='Marginalise the foreground coefficients when sampling')
+    parser.add_argument('--ares-mode', default='exact', help="'exact' or 'emulated'")
+    parser.add_argument('--seed', type=int, help='Seed the realization seeds are spawned from')
+    parser.add_argument('--from-priors', action='store_true', help='Draw the injections from the priors (Laplace only)')
+    parser.add_argument('--theta', type=json.loads, help='JSON overriding injection parameters (Laplace only)')
+    parser.add_argument('--processes', type=int, default=1, help='Worker processes')
+    args = parser.parse_args()
+
+    run_coverage(args.case, args.n, args.method, args.livepoints, args.marginalise, args.ares_mode, args.seed,
+                 args.from_priors, args.theta, args.processes)
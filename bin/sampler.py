@@ -15,18 +15,20 @@ Contact: yi.lim17@imperial.ac.uk
 #################### LIBRARIES #####################
 ####################################################
 import os
-import bilby
 import numpy as np
-import matplotlib.pyplot as plt
 from time import process_time
 
-from pandas.core.indexing import is_label_like
+# bilby and likelihoods.py are imported where they are used, so that output_label and
+# select_model (e.g. from campaign.py) do not pay for importing bilby
 import models                      # signal models
 import edges                       # edges data
 import ares_sim                    # ares simulations
+import ares_emulator               # ares emulator
+import instrument                  # call counters and timings
+import result_store                # columnar result store
+import mpi_pool                    # MPI ranks and pool
+import ares_pool                   # warm ARES worker pool
 
-# Start the stopwatch / counter  
-start = process_time()
 
 ####################################################
 ###################### PATH ########################
@@ -45,109 +47,694 @@ sampler = 'pymultinest'
 # Model (linearised_model, systematic_model, ares_model_linearised)
 case = 'systematic_model'
 
-# Data ('edges', 'mock', 'ares')
+# Data ('edges', 'mock', 'mock_joint', 'ares')
 data = 'edges'
 
+# Spectra of the 'mock_joint' data, fitted jointly with a shared 21 cm signal and a foreground per spectrum
+n_spectra = 16
+
 # Livepoints
 livepoints = 600
 
+# Number of processes for samplers that evaluate several likelihoods at once (dynesty, ultranest, nessai)
+npool = 1
+
+# ARES model ('exact' runs ARES on every call, 'emulated' interpolates the grid built by ares_emulator.py)
+ares_mode = 'exact'
+
+# Marginalise the linear foreground coefficients analytically, so only the 21 cm signal parameters are sampled
+marginalise = False
+
+# Record model/likelihood call counts and timings of each phase to <label>_timing.json
+timing = False
+
+# Seed for the mock data and the sampler (None for a random run)
+seed = None
+
+# Warm start: livepoints of an earlier run of this set-up, whose posterior narrows the priors (None to start from the full priors)
+warm_start = None
+
+# Live-point ladder, e.g. (50, 500, 5000): each rung is warm-started from the one before, stopping once log Z
+# changes by less than logz_tolerance combined errors sqrt(err_prev^2 + err_cur^2) of the two rungs and every
+# median by less than median_tolerance posterior standard deviations
+ladder = None
+logz_tolerance = 2.0
+median_tolerance = 0.2
+
+# Run across MPI ranks (also switched on when started by mpirun): pymultinest uses MPI itself, the samplers
+# that take a pool evaluate likelihoods on ranks 1..n-1. Data are loaded once and only rank 0 writes output
+mpi = False
+
+# Tighten the priors before sampling to the best fit of a multi-start least-squares pre-pass +/- tighten forecast
+# standard deviations (within the hand-set priors), warning where the hand-set priors cut off likelihood mass (None to skip)
+tighten = None
+
+# Fisher/Laplace forecast instead of sampling: best fit, covariance, marginal widths and a Gaussian log Z in
+# well under a second (see laplace.py), checked against the finished run of the controls above if there is one
+forecast = False
+
+# Standard deviations of an earlier posterior added on each side of its range when narrowing the priors
+WARM_PADDING = 5.0
+
+# Fractional scatter of the foreground of each 'mock_joint' spectrum about the injection (e.g. with LST)
+JOINT_SCATTER = 0.01
+
 
 ####################################################
 ################## OUTPUT FORMAT ###################
 ####################################################
-label = '{}_{}_{}_{}'.format(case, data, sampler, livepoints)
-outdir = directory + '/{}_{}/'.format(case, data) + label
-bilby.utils.check_directory_exists_and_if_not_mkdir(outdir)
+def output_label(case, data, sampler, livepoints, ares_mode='exact', marginalise=False, seed=None, warm_start=None,
+                 tighten=None, n_spectra=n_spectra):
+    """
+    Label and output directory of a run, samples/<case>_<data>/<label>.
+    """
+
+    label = '{}_{}_{}_{}'.format(case, data, sampler, livepoints)
+    if data == 'mock_joint':
+        label += '_spectra{}'.format(n_spectra)
+    if case == 'ares_model_linearised' and ares_mode == 'emulated':
+        label += '_emulated'
+    if marginalise:
+        label += '_marginalised'
+    if seed is not None:
+        label += '_seed{}'.format(seed)
+    if tighten is not None:
+        label += '_tight{:g}'.format(tighten)
+    if warm_start is not None:
+        label += '_warm{}'.format(warm_start)
+    outdir = directory + '/{}_{}/'.format(case, data) + label
+
+    return label, outdir
 
 
 ####################################################
 ############# MODEL & PRIOR SELECTION ##############
 ####################################################
-# Bowman (2018) and Hills (2018) Linearised Foreground with Flattened Gaussian Signal
-if case == 'linearised_model':
-    model = models.linearised_model
-    model_priors = {'A':[[0.0, 20.0], r'$A$'],
-                    'nu0':[[60.0, 90.0], r'$\nu_{0}$'], 
-                    'w':[[1.0, 40.0], r'$w$'], 
-                    'tau':[[0.0, 100.0], r'$\tau$'], 
-                    'a0':[[-11000.0, -9000.0], r'$a_{0}$'], 
-                    'a1':[[-5900.0, -5400.0], r'$a_{1}$'], 
-                    'a2':[[-1950.0, -1700.0], r'$a_{2}$'], 
-                    'a3':[[120.0, 190.0], r'$a_{3}$'], 
-                    'a4':[[11000.0, 12200.0], r'$a_{4}$'],
-                    'sigma':[[0, 1], r'$\sigma$']}
-    # Injection parameters as in Hills (2018)
-    theta = dict(A=0.553, nu0=78.31, w=18.74, tau=6.78, a0=-10111.419, a1=-5673.739, a2=-1831.621, a3=150.673, a4=11711.500, sigma=0.01)
-
-# Hills (2018) 5-term Polynomial Foreground with Sinusoidal Signal
-elif case == 'systematic_model':
-    model = models.systematic_model
-    model_priors = {'A':[[0.0, 1.0], r'$A$'],
-                    'phi':[[1.5 * np.pi, 2.5 * np.pi], r'$\phi$'], 
-                    'l':[[11.0, 14.0], r'$l$'], 
-                    'a0':[[2500, 2700], r'$a_{0}$'], 
-                    'a1':[[-4500, -3900], r'$a_{1}$'], 
-                    'a2':[[8100, 9200], r'$a_{2}$'], 
-                    'a3':[[-9400, -8500], r'$a_{3}$'], 
-                    'a4':[[4200, 4900], r'$a_{4}$'],
-                    'a5':[[-1000, -800], r'$a_{5}$']}
+def select_model(case, ares_mode='exact'):
+    """
+    Model, its signal and foreground basis, the foreground parameter names, priors and injection parameters.
+    """
+
+    # Bowman (2018) and Hills (2018) Linearised Foreground with Flattened Gaussian Signal
+    if case == 'linearised_model':
+        model = models.linearised_model
+        signal, basis = models.flattened_gaussian, models.LINEARISED_BASIS
+        foreground_keys = ['a0', 'a1', 'a2', 'a3', 'a4']
+        model_priors = {'A':[[0.0, 20.0], r'$A$'],
+                        'nu0':[[60.0, 90.0], r'$\nu_{0}$'], 
+                        'w':[[1.0, 40.0], r'$w$'], 
+                        'tau':[[0.0, 100.0], r'$\tau$'], 
+                        'a0':[[-11000.0, -9000.0], r'$a_{0}$'], 
+                        'a1':[[-5900.0, -5400.0], r'$a_{1}$'], 
+                        'a2':[[-1950.0, -1700.0], r'$a_{2}$'], 
+                        'a3':[[120.0, 190.0], r'$a_{3}$'], 
+                        'a4':[[11000.0, 12200.0], r'$a_{4}$'],
+                        'sigma':[[0, 1], r'$\sigma$']}
+        # Injection parameters as in Hills (2018)
+        theta = dict(A=0.553, nu0=78.31, w=18.74, tau=6.78, a0=-10111.419, a1=-5673.739, a2=-1831.621, a3=150.673, a4=11711.500, sigma=0.01)
+
+    # Hills (2018) 5-term Polynomial Foreground with Sinusoidal Signal
+    elif case == 'systematic_model':
+        model = models.systematic_model
+        signal, basis = models.sinusoidal, models.POLYNOMIAL_BASIS
+        foreground_keys = ['a0', 'a1', 'a2', 'a3', 'a4', 'a5']
+        model_priors = {'A':[[0.0, 1.0], r'$A$'],
+                        'phi':[[1.5 * np.pi, 2.5 * np.pi], r'$\phi$'], 
+                        'l':[[11.0, 14.0], r'$l$'], 
+                        'a0':[[2500, 2700], r'$a_{0}$'], 
+                        'a1':[[-4500, -3900], r'$a_{1}$'], 
+                        'a2':[[8100, 9200], r'$a_{2}$'], 
+                        'a3':[[-9400, -8500], r'$a_{3}$'], 
+                        'a4':[[4200, 4900], r'$a_{4}$'],
+                        'a5':[[-1000, -800], r'$a_{5}$']}
     
-    # Injection parameters as in Hills (2018)
-    theta = dict(A=0.057, phi=5.74, l=12.27, a0=2625.771, a1=-4202.081, a2=8636.317, a3=-8954.631, a4=4553.795, a5=-908.957)
-
-# Ares Simulation Model
-elif case == 'ares_model_linearised':
-    model = ares_sim.model_ares
-    model_priors = {'fX':[[0.0, 1.0], r'$f_{X}$'],
-                    'fstar':[[0.0,1.0], r'$f_{\star}$'],
-                    'a0':[[-11000.0, -9000.0], r'$a_{0}$'], 
-                    'a1':[[-5900.0, -5400.0], r'$a_{1}$'], 
-                    'a2':[[-1950.0, -1700.0], r'$a_{2}$'], 
-                    'a3':[[120.0, 190.0], r'$a_{3}$'], 
-                    'a4':[[11000.0, 12200.0], r'$a_{4}$']}
+        # Injection parameters as in Hills (2018)
+        theta = dict(A=0.057, phi=5.74, l=12.27, a0=2625.771, a1=-4202.081, a2=8636.317, a3=-8954.631, a4=4553.795, a5=-908.957)
+
+    # Ares Simulation Model
+    elif case == 'ares_model_linearised':
+        if ares_mode == 'exact':
+            model = ares_sim.model_ares
+            signal, basis = ares_sim.signal_ares, models.LINEARISED_BASIS
+        elif ares_mode == 'emulated':
+            model = ares_emulator.model_ares_emulated
+            signal, basis = ares_emulator.signal_ares_emulated, models.LINEARISED_BASIS
+        foreground_keys = ['a0', 'a1', 'a2', 'a3', 'a4']
+        model_priors = {'fX':[[0.0, 1.0], r'$f_{X}$'],
+                        'fstar':[[0.0,1.0], r'$f_{\star}$'],
+                        'a0':[[-11000.0, -9000.0], r'$a_{0}$'], 
+                        'a1':[[-5900.0, -5400.0], r'$a_{1}$'], 
+                        'a2':[[-1950.0, -1700.0], r'$a_{2}$'], 
+                        'a3':[[120.0, 190.0], r'$a_{3}$'], 
+                        'a4':[[11000.0, 12200.0], r'$a_{4}$']}
     
-    # Injection parameters: Test values
-    theta = dict(fX=0.05, fstar=0.1, a0=-10111.419, a1=-5673.739, a2=-1831.621, a3=150.673, a4=11711.500)
+        # Injection parameters: Test values
+        theta = dict(fX=0.05, fstar=0.1, a0=-10111.419, a1=-5673.739, a2=-1831.621, a3=150.673, a4=11711.500)
+
+    return model, signal, basis, foreground_keys, model_priors, theta
+
+
+def build_priors(model_priors):
+    """
+    Convert priors to required format required for bilby.
+    """
+
+    import bilby
+
+    priors = dict()
+    for k,v in model_priors.items():
+        priors[k] = bilby.core.prior.Uniform(minimum=v[0][0], maximum=v[0][1], name=k, latex_label=v[1])
+
+    return priors
 
-# Convert priors to required format required for bilby
-priors = dict()
-for k,v in model_priors.items():
-    priors[k] = bilby.core.prior.Uniform(minimum=v[0][0], maximum=v[0][1], name=k, latex_label=v[1])
+
+def joint_priors(priors, foreground_keys, n_spectra):
+    """
+    Priors of a joint fit of n_spectra spectra: the prior of each foreground coefficient repeated for every
+    spectrum i as likelihoods.spectrum_key(key, i).
+    """
+
+    import bilby
+    import likelihoods
+
+    joint = {k: v for k, v in priors.items() if k not in foreground_keys}
+    for i in range(n_spectra):
+        for k in foreground_keys:
+            name = likelihoods.spectrum_key(k, i)
+            joint[name] = bilby.core.prior.Uniform(minimum=priors[k].minimum, maximum=priors[k].maximum, name=name)
+
+    return joint
 
 
 ####################################################
 ############### IMPORT/SIMULATE DATA ############### 
 ####################################################
-# Import EDGES data
-if data == 'edges':
-    nu, weight, Tsky, Tres1, Tres2, Tmodel, T21, err = edges.read_edges()
+def mock_spectra(model, nu, theta, err, seeds):
+    """
+    Mock sky temperatures of shape (len(seeds), n_channels): model at theta (scalars, or arrays of shape
+    (len(seeds),) for one injection per spectrum, evaluated as one batch) plus Gaussian noise err drawn
+    from an independent stream np.random.default_rng(seed) for each seed.
+    """
+
+    T = model(nu, **{k: v for k, v in theta.items() if k != 'sigma'})
+    noise = np.stack([np.random.default_rng(s).normal(0.0, err, len(nu)) for s in seeds])
+
+    return T + noise
+
+
+def load_data(data, model, theta, seed=None, foreground_keys=(), n_spectra=n_spectra):
+    """
+    Frequencies, sky temperature, errors and channel weights (None for all channels) of the chosen data set.
+    For 'mock_joint' the sky temperature is (n_spectra, n_channels): the injected signal in every spectrum,
+    with the foreground_keys coefficients of each spectrum scaled by 1 + JOINT_SCATTER N(0, 1).
+    """
 
-# Simulate mock data using model + gaussian errors
-elif data == 'mock':
-    nu = np.linspace(50.0, 100.0)          
-    N = len(nu)
-    err = 0.01 * np.ones(N)           
-    Tsky = model(nu, **theta) + np.random.normal(0.0, err, N)
+    rng = np.random.default_rng(seed)
+    weight = None
 
-# Simulate mock data using ARES + lienarised foreground + gaussian errors
-elif data == 'ares':
-    nu, T21 = ares_sim.simulation_ares(theta['fX'], theta['fstar'])
-    Tfg = (10**3) * models.linearised_foreground(nu, theta['a0'], theta['a1'], theta['a2'], theta['a3'], theta['a4'])
-    N = len(nu)
-    err = 0.01 * (10**3) * np.ones(N)
-    Tsky = T21 + Tfg + np.random.normal(0.0, err, N)
+    # Import EDGES data
+    if data == 'edges':
+        nu, weight, Tsky, Tres1, Tres2, Tmodel, T21, err = edges.read_edges()
+
+    # Simulate mock data using model + gaussian errors
+    elif data == 'mock':
+        nu = np.linspace(50.0, 100.0)          
+        N = len(nu)
+        err = 0.01 * np.ones(N)           
+        Tsky = mock_spectra(model, nu, theta, err, [seed])[0]
+
+    # Simulate mock spectra with a shared signal and a foreground per spectrum, each with an independent noise stream
+    elif data == 'mock_joint':
+        nu = np.linspace(50.0, 100.0)
+        err = 0.01 * np.ones(len(nu))
+        scale = 1.0 + JOINT_SCATTER * rng.standard_normal(n_spectra)
+        injection = {k: v * scale if k in foreground_keys else v for k, v in theta.items()}
+        Tsky = mock_spectra(model, nu, injection, err, np.random.SeedSequence(seed).spawn(n_spectra))
+
+    # Simulate mock data using ARES + lienarised foreground + gaussian errors
+    elif data == 'ares':
+        nu, T21 = ares_sim.simulation_ares(theta['fX'], theta['fstar'])
+        Tfg = (10**3) * models.linearised_foreground(nu, theta['a0'], theta['a1'], theta['a2'], theta['a3'], theta['a4'])
+        N = len(nu)
+        err = 0.01 * (10**3) * np.ones(N)
+        Tsky = T21 + Tfg + rng.normal(0.0, err, N)
+
+    return nu, Tsky, err, weight
+
+
+####################################################
+################### WARM STARTS ####################
+####################################################
+def find_run(case, data, sampler, livepoints, ares_mode='exact', marginalise=False, seed=None, tighten=None,
+             n_spectra=n_spectra):
+    """
+    (label, outdir) of a finished run of this set-up: the run from the full priors if there is one,
+    else a warm-started one. None if there is neither.
+    """
+
+    label, outdir = output_label(case, data, sampler, livepoints, ares_mode, marginalise, seed, tighten=tighten,
+                                 n_spectra=n_spectra)
+    candidates = [(label, outdir)]
+    parent = os.path.dirname(outdir)
+    if os.path.isdir(parent):
+        candidates += sorted((name, os.path.join(parent, name)) for name in os.listdir(parent) if name.startswith(label + '_warm'))
+
+    for label, outdir in candidates:
+        if has_result(outdir, label):
+            return label, outdir
+
+    return None
+
+
+def has_result(outdir, label):
+    return any(os.path.exists('{}/{}_result.{}'.format(outdir, label, ext)) for ext in ('npz', 'json'))
+
+
+def read_posterior(outdir, label):
+    """
+    Posterior columns of a finished run, from its result store if it has one.
+    """
+
+    if os.path.exists(result_store.store_path(outdir, label)):
+        with result_store.ResultStore.open(outdir, label) as store:
+            return {k: np.array(v) for k, v in store.posterior().items()}
+
+    posterior = result_store.read_result(outdir, label).posterior
+    return {k: np.asarray(posterior[k]) for k in posterior.columns}
+
+
+def narrowed_priors(priors, ranges):
+    """
+    Uniform priors narrowed to ranges {key: (min, max)} (within the original priors), and the log of the
+    ratio of the narrowed to the original prior volume. Adding it to the log-evidence of a run with the
+    narrowed priors gives the evidence for the original priors, as long as the narrowed priors hold all
+    of the likelihood mass.
+    """
+
+    import bilby
+
+    narrowed, log_volume = dict(priors), 0.0
+    for k, prior in priors.items():
+        if k not in ranges:
+            continue
+        lower = float(max(prior.minimum, ranges[k][0]))
+        upper = float(min(prior.maximum, ranges[k][1]))
+        narrowed[k] = bilby.core.prior.Uniform(minimum=lower, maximum=upper, name=k, latex_label=prior.latex_label)
+        log_volume += np.log((upper - lower) / (prior.maximum - prior.minimum))
+
+    return narrowed, log_volume
+
+
+def warm_start_priors(priors, posterior, padding=WARM_PADDING):
+    """
+    Uniform priors narrowed to the range of an earlier posterior widened by padding standard deviations
+    on each side, and the log of the narrowed prior volume (see narrowed_priors).
+    """
+
+    ranges = {}
+    for k in priors:
+        if k in posterior:
+            x = np.asarray(posterior[k], dtype=float)
+            ranges[k] = (x.min() - padding * x.std(), x.max() + padding * x.std())
+
+    return narrowed_priors(priors, ranges)
+
+
+def truncated_parameters(priors, narrowed, posterior, edge=0.01):
+    """
+    Parameters with more than a fraction edge of their posterior samples within edge of the width of a
+    narrowed (not original) prior bound, where the narrowing may have cut off likelihood mass.
+    """
+
+    truncated = []
+    for k, prior in narrowed.items():
+        if prior is priors[k] or k not in posterior:
+            continue
+        x = np.asarray(posterior[k], dtype=float)
+        width = prior.maximum - prior.minimum
+        near = np.zeros(len(x), dtype=bool)
+        if prior.minimum > priors[k].minimum:
+            near |= x < prior.minimum + edge * width
+        if prior.maximum < priors[k].maximum:
+            near |= x > prior.maximum - edge * width
+        if np.mean(near) > edge:
+            truncated.append(k)
+
+    return truncated
+
+
+####################################################
+################# PRIOR TIGHTENING #################
+####################################################
+def laplace_forecast(model, nu, Tsky, err, weight, model_priors, theta, seed=None):
+    """
+    Multi-start bounded least-squares fit of model to the data within the hand-set priors, and the
+    Laplace approximation of the posterior around it (see laplace.py).
+    """
+
+    import laplace
+
+    bounds = {k: (float(v[0][0]), float(v[0][1])) for k, v in model_priors.items()}
+    return laplace.forecast(model, nu, Tsky, err, bounds, weight=weight, start=theta, seed=seed)
+
+
+def tightened_priors(priors, report, n_sigma, model_priors):
+    """
+    Priors narrowed to the best fit +/- n_sigma forecast standard deviations of report (see narrowed_priors),
+    the log of the narrowed prior volume, and the record kept with the run: the best fit, the proposed ranges
+    (before clipping to the hand-set priors), the priors used and the parameters whose hand-set priors cut
+    off likelihood mass.
+    """
+
+    import laplace
+
+    proposed = laplace.proposed_ranges(report, n_sigma)
+    narrowed, log_volume = narrowed_priors(priors, proposed)
+    bounds = {k: (float(v[0][0]), float(v[0][1])) for k, v in model_priors.items()}
+
+    record = dict(n_sigma=n_sigma, best_fit=report['best_fit'], std=report['std'],
+                  proposed={k: list(v) for k, v in proposed.items()},
+                  priors={k: [narrowed[k].minimum, narrowed[k].maximum] for k in priors},
+                  log_prior_volume=float(log_volume), cut_off=laplace.cut_off(report, bounds))
+
+    return narrowed, log_volume, record
+
+
+def print_tightening(record):
+    """
+    The tightened priors, and a warning naming the parameters whose hand-set priors cut off likelihood mass.
+    """
+
+    for k, (lower, upper) in record['priors'].items():
+        print('Prior of {}: [{:.6g}, {:.6g}]'.format(k, lower, upper))
+    if record['cut_off']:
+        print('Warning: the hand-set priors of {} cut off likelihood mass (the best fit is on a bound or the fit\'s '
+              'Gaussian reaches past them). The data prefer {}.'.format(', '.join(record['cut_off']), ', '.join(
+                  '{} in [{:.6g}, {:.6g}]'.format(k, *record['proposed'][k]) for k in record['cut_off'])))
 
 
 ####################################################
 ##################### SAMPLER ######################
 ####################################################
-# Instantiate a Gaussian likelihood         NOTE: Might refashion this as to generalise/modularise the selection of different types of likelihoods
-likelihood = bilby.likelihood.GaussianLikelihood(nu, Tsky, model, err)
+@instrument.restoring(ares_sim, 'simulation_ares')
+def run(sampler=sampler, case=case, data=data, livepoints=livepoints, npool=npool, ares_mode=ares_mode,
+        marginalise=marginalise, seed=seed, timing=timing, warm_start=warm_start, tighten=tighten, mpi=mpi,
+        n_spectra=n_spectra):
+    """
+    Run one sampling job and return the bilby result. The defaults are the controls above.
+    With warm_start, the priors are narrowed to the posterior of the finished run of this set-up with
+    warm_start livepoints, and with tighten to the best fit of a least-squares pre-pass +/- tighten standard
+    deviations. Either way the log-evidence is corrected back to the full priors.
+    'mock_joint' data are n_spectra spectra fitted with a shared signal and a foreground per spectrum.
+    Under MPI the result is returned on rank 0 and None on the other ranks.
+    """
+
+    import bilby
+    import likelihoods
+
+    # Start the stopwatch / counter  
+    start = process_time()
+
+    joint = data == 'mock_joint'
+    if joint and tighten is not None:
+        raise ValueError('The least-squares pre-pass of tighten fits a single spectrum')
+
+    label, outdir = output_label(case, data, sampler, livepoints, ares_mode, marginalise, seed, warm_start, tighten, n_spectra)
+    comm = mpi_pool.communicator() if mpi or mpi_pool.launched() else None
+    root = mpi_pool.rank(comm) == 0
+    if root:
+        os.makedirs(outdir, exist_ok=True)
+    mpi_pool.barrier(comm)
+    timer = instrument.Instrumentation(enabled=timing or comm is not None)
+
+    model, signal, basis, foreground_keys, model_priors, theta = select_model(case, ares_mode)
+    if case == 'ares_model_linearised' or data == 'ares':
+        ares_sim.simulation_ares = timer.wrap(ares_sim.simulation_ares, 'ares_simulation')     # Until run returns
+    priors = build_priors(model_priors)
+
+    # Marginalised foreground coefficients are not sampled, only their prior volume enters the likelihood
+    if marginalise:
+        prior_volume = np.prod([priors[k].maximum - priors[k].minimum for k in foreground_keys])
+        for k in foreground_keys:
+            priors.pop(k)
+
+    # Sampled foreground coefficients of a joint fit: one set per spectrum
+    elif joint:
+        priors = joint_priors(priors, foreground_keys, n_spectra)
+
+    # Narrow the priors to the posterior of an earlier, lower-livepoint run
+    full_priors, log_volume = priors, 0.0
+    if warm_start is not None:
+        earlier = find_run(case, data, sampler, warm_start, ares_mode, marginalise, seed, tighten, n_spectra)
+        if earlier is None:
+            raise FileNotFoundError('No finished {} livepoint run of this set-up to warm-start from'.format(warm_start))
+        priors, warm_volume = warm_start_priors(priors, mpi_pool.broadcast(comm, read_posterior, earlier[1], earlier[0]))
+        log_volume += warm_volume
+
+    # Loaded (or simulated) once on rank 0 and broadcast
+    with timer.phase('data'):
+        nu, Tsky, err, weight = mpi_pool.broadcast(comm, load_data, data, model, theta, seed, foreground_keys, n_spectra)
+
+    # Narrow the priors around a least-squares fit to the data
+    if tighten is not None:
+        with timer.phase('tightening'):
+            report = mpi_pool.broadcast(comm, laplace_forecast, model, nu, Tsky, err, weight, model_priors, theta, seed)
+        priors, tight_volume, tightening = tightened_priors(priors, report, tighten, model_priors)
+        log_volume += tight_volume
+        if root:
+            print_tightening(tightening)
+
+    # Instantiate a Gaussian likelihood         NOTE: Might refashion this as to generalise/modularise the selection of different types of likelihoods
+    with timer.phase('setup'):
+        if marginalise:
+            marginalised = likelihoods.JointMarginalisedLikelihood if joint else likelihoods.MarginalisedForegroundLikelihood
+            likelihood = marginalised(nu, Tsky, signal, basis, err, weight=weight, foreground_keys=foreground_keys,
+                                      prior_volume=prior_volume)
+        elif joint:
+            likelihood = likelihoods.JointSpectrumLikelihood(nu, Tsky, signal, basis, err, weight=weight,
+                                                             foreground_keys=foreground_keys)
+        else:
+            likelihood = likelihoods.SpectrumLikelihood(nu, Tsky, model, err, weight=weight)
+    timer.attach(likelihood)
+
+    # The foreground of each joint spectrum is scattered about the injection, so only the signal is a known truth
+    injection = {k: v for k, v in theta.items() if k not in foreground_keys} if joint else theta
+
+    # Seed the samplers (bilby >= 2 draws from its own generator, older versions from numpy's)
+    sampler_kwargs = dict()
+    if seed is not None:
+        sampler_kwargs['seed'] = seed
+        np.random.seed(seed)
+        if hasattr(bilby.core.utils, 'random'):
+            bilby.core.utils.random.seed(seed)
+
+    # Under MPI, pymultinest runs on every rank and the other samplers on rank 0 with ranks 1..n-1 as their pool
+    pool = None
+    if comm is not None and sampler != 'pymultinest':
+        pool = mpi_pool.MPIPool(comm)
+        sampler_kwargs['pool'] = pool
+        npool = pool.size
+        if not root:
+            mpi_pool.init_bilby_worker(likelihood, priors)
+            with timer.phase('sampling'):
+                pool.wait()
+            mpi_pool.throughput(comm, timer)
+            return None
+
+    # Exact ARES: the points proposed together are evaluated across workers that keep ARES imported
+    elif case == 'ares_model_linearised' and ares_mode == 'exact' and npool > 1 and sampler != 'pymultinest':
+        pool = ares_pool.AresPool(nu, npool, likelihood=likelihood, priors=priors)
+        sampler_kwargs['pool'] = pool
+
+    # Run sampler
+    with timer.phase('sampling'):
+        try:
+            result = bilby.run_sampler(likelihood=likelihood, injection_parameters=injection, sample='unif', priors=priors, 
+                                    sampler=sampler, nlive=livepoints, npool=npool, outdir=outdir, label=label, plot=False,
+                                    save=root, **sampler_kwargs)
+        except BaseException:
+            # The other ranks would wait for ever in the gather of throughput below
+            mpi_pool.abort(comm)
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+
+    # Likelihood calls per rank, reported by rank 0
+    if comm is not None:
+        ranks = mpi_pool.throughput(comm, timer)
+        if not root:
+            return None
+        timer.extra['ranks'] = ranks
+        for r in ranks:
+            print('Rank {rank} ({host}): {calls} likelihood calls, {busy_time:.1f} s busy of {wall_time:.1f} s'.format(**r))
+
+    # Likelihood calls in forked pool workers are not seen by this process's counters: take the total from bilby
+    if comm is None and npool > 1:
+        timer.pooled(npool, getattr(result, 'num_likelihood_evaluations', None))
+
+    # Recover the posterior of the marginalised foreground coefficients (for exact ARES, simulating the
+    # signals of the posterior across a warm ARES pool)
+    if marginalise:
+        if isinstance(pool, ares_pool.AresPool):
+            with ares_pool.AresPool(nu, npool) as posterior_pool:
+                likelihood.signal = posterior_pool.signal
+                foreground = likelihood.sample_foreground(result.posterior, rng=seed)
+        else:
+            foreground = likelihood.sample_foreground(result.posterior, rng=seed)
+        for k, v in foreground.items():
+            result.posterior[k] = v
+
+    # Evidence for the full priors: the narrowed priors hold a fraction exp(log_volume) of their volume
+    if warm_start is not None or tighten is not None:
+        result.log_evidence += log_volume
+        result.log_bayes_factor += log_volume
+        if warm_start is not None:
+            result.meta_data['warm_start'] = dict(label=earlier[0], log_prior_volume=warm_volume)
+        if tighten is not None:
+            result.meta_data['prior_tightening'] = tightening
+        truncated = truncated_parameters(full_priors, priors, result.posterior)
+        if truncated:
+            print('Warning: the posterior of {} reaches the narrowed prior bounds, so the narrowing may have cut off '
+                  'likelihood mass. Rerun with a larger warm start or tighten, or the full priors.'.format(', '.join(truncated)))
+
+    if marginalise or warm_start is not None or tighten is not None:
+        result.save_to_file(overwrite=True)
+
+    # Columnar copy of the result, for fast loading (see result_store.py)
+    result_store.write(result, outdir, label)
+
+    with timer.phase('plotting'):
+        if joint:
+            result.plot_corner(parameters=[k for k in priors if k in injection])
+        else:
+            result.plot_corner()
+
+    timer.save('{}/{}_timing.json'.format(outdir, label))
+
+    stop = process_time()
+    print("Elapsed time:", stop-start)
+
+    return result
+
+
+def converged(previous, current, logz_tolerance=logz_tolerance, median_tolerance=median_tolerance):
+    """
+    (converged, change in log Z in combined errors sqrt(err_prev^2 + err_cur^2), largest change of a median in
+    posterior standard deviations) between two results. Without log Z errors the rungs never agree on log Z.
+    """
+
+    import summary
+
+    keys = current.search_parameter_keys
+    before, after = summary.summarise(previous.posterior, keys), summary.summarise(current.posterior, keys)
+    error = np.hypot(previous.log_evidence_err, current.log_evidence_err)
+    d_logz = abs(current.log_evidence - previous.log_evidence) / error if error > 0 else np.inf
+    d_median = max(abs(after[k]['median'] - before[k]['median']) / after[k]['std'] if after[k]['std'] > 0 else 0.0
+                   for k in keys)
+
+    return d_logz <= logz_tolerance and d_median <= median_tolerance, d_logz, d_median
+
+
+def run_ladder(rungs=ladder, logz_tolerance=logz_tolerance, median_tolerance=median_tolerance, **kwargs):
+    """
+    Run at each livepoint count of rungs in turn, each warm-started from the one before (the first
+    from the full priors), and stop once consecutive rungs agree within the tolerances (see converged).
+    Rungs that have already been run are read back instead of rerun. kwargs are passed to run.
+    Returns the results of the rungs that were reached (a list of None on MPI ranks other than 0).
+    """
+
+    settings = dict(sampler=sampler, case=case, data=data, ares_mode=ares_mode, marginalise=marginalise, seed=seed,
+                    tighten=tighten, n_spectra=n_spectra)
+    settings.update(kwargs)
+    setup = {k: settings[k] for k in ('case', 'data', 'sampler', 'ares_mode', 'marginalise', 'seed', 'tighten', 'n_spectra')}
+
+    # Under MPI, rank 0 decides whether to reuse a rung and when to stop, and tells the other ranks
+    comm = mpi_pool.communicator() if settings.get('mpi', mpi) or mpi_pool.launched() else None
+    root = mpi_pool.rank(comm) == 0
+
+    def step(previous_result, result, n):
+        done, d_logz, d_median = converged(previous_result, result, logz_tolerance, median_tolerance)
+        print('{} -> {} livepoints: |d log Z| = {:.2f} sigma, largest median shift = {:.3f} sigma'.format(previous, n, d_logz, d_median))
+        return done
+
+    results, previous = [], None
+    for n in rungs:
+        label, outdir = output_label(livepoints=n, warm_start=previous, **setup)
+        if mpi_pool.broadcast(comm, has_result, outdir, label):
+            if root:
+                print('Reusing {}'.format(label))
+            result = result_store.read_result(outdir, label) if root else None
+        else:
+            result = run(livepoints=n, warm_start=previous, **settings)
+        results.append(result)
+
+        if len(results) > 1 and mpi_pool.broadcast(comm, step, results[-2], result, n):
+            if root:
+                print('Converged at {} livepoints'.format(n))
+            break
+        previous = n
+    else:
+        if root:
+            print('Not converged within {} livepoints'.format(rungs[-1]))
+
+    return results
+
+
+####################################################
+##################### FORECAST #####################
+####################################################
+def run_forecast(case=case, data=data, ares_mode=ares_mode, seed=seed, sampler=sampler, livepoints=livepoints,
+                 marginalise=marginalise):
+    """
+    Fisher/Laplace forecast of a set-up (see laplace.py), without bilby or sampling, written to
+    samples/<case>_<data>/<case>_<data>_forecast.json. If the set-up has a finished run with sampler and
+    livepoints, the forecast is compared with it. Returns the forecast.
+    """
+
+    import json
+    import laplace
+
+    if data == 'mock_joint':
+        raise ValueError('The forecast fits a single spectrum')
+
+    model, signal, basis, foreground_keys, model_priors, theta = select_model(case, ares_mode)
+    nu, Tsky, err, weight = load_data(data, model, theta, seed)
+    report = laplace_forecast(model, nu, Tsky, err, weight, model_priors, theta, seed)
+
+    # Check the finished nested-sampling run of this set-up, if there is one
+    comparison = None
+    earlier = find_run(case, data, sampler, livepoints, ares_mode, marginalise, seed)
+    if earlier is not None:
+        label, outdir = earlier
+        if os.path.exists(result_store.store_path(outdir, label)):
+            with result_store.ResultStore.open(outdir, label) as store:
+                log_evidence = store.log_evidence
+        else:
+            log_evidence = result_store.read_result(outdir, label).log_evidence
+        comparison = laplace.compare(report, read_posterior(outdir, label), log_evidence)
+        comparison['run'] = label
+        report['comparison'] = comparison
+        print('Compared with {}'.format(label))
+    laplace.print_forecast(report, comparison)
+
+    label = '{}_{}_forecast'.format(case, data)
+    if case == 'ares_model_linearised' and ares_mode == 'emulated':
+        label += '_emulated'
+    if seed is not None:
+        label += '_seed{}'.format(seed)
+    outdir = directory + '/{}_{}'.format(case, data)
+    os.makedirs(outdir, exist_ok=True)
+    with open('{}/{}.json'.format(outdir, label), 'w') as f:
+        json.dump(report, f, indent=2)
 
-# Run sampler
-result = bilby.run_sampler(likelihood=likelihood, injection_parameters=theta, sample='unif', priors=priors, 
-                        sampler=sampler, nlive=livepoints, outdir=outdir, label=label, plot=True)
+    return report
 
 
-stop = process_time()
-print("Elapsed time:", stop-start)
\ No newline at end of file
+if __name__ == '__main__':
+    if forecast:
+        run_forecast()
+    elif ladder:
+        run_ladder()
+    else:
+        run()
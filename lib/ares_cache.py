@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Persistent on-disk cache of ARES simulation outputs.
+
+Each simulation is stored as a compressed (nu, dTb) file named by a hash of the ARES parameters
+and the ARES version, so repeated runs, restarts and different samplers share results.
+The cache is bounded in size with least-recently-used eviction and is safe to use from several
+processes at once: files are written atomically and eviction is serialised with a lock file.
+A running total of the cache size is kept in a sidecar file, so a put only walks the cache directory
+when the total goes over the bound, and eviction then brings it down to EVICT_TO of the bound.
+
+Environment variables:
+ARES_CACHE=0                 disable the cache
+ARES_CACHE_DIR               cache directory (default: 21sampler/samples/ares_cache)
+ARES_CACHE_MAX_BYTES         size bound in bytes (default: 1 GB)
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import os
+import json
+import zipfile
+import hashlib
+import tempfile
+import numpy as np
+from importlib import metadata
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:                 # Not available on Windows, where eviction is not locked
+    fcntl = None
+
+####################################################
+###################### PATH ########################
+####################################################
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))   # Directory of ares_cache.py (should be lib)
+BASE_DIR = os.path.dirname(PROJECT_ROOT)                    # Parent directory of PROJECT_ROOT (should be 21sampler)
+
+ENABLED = os.environ.get('ARES_CACHE', '1') != '0'
+CACHE_DIR = os.environ.get('ARES_CACHE_DIR', '{}/samples/ares_cache'.format(BASE_DIR))
+MAX_BYTES = int(os.environ.get('ARES_CACHE_MAX_BYTES', 2**30))
+
+# Fraction of the size bound eviction brings the cache down to, so a full cache is walked once per ~10% of it
+EVICT_TO = 0.9
+
+# Statistics for this process
+stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'put_errors': 0}
+
+
+####################################################
+##################### CACHE ########################
+####################################################
+def ares_version():
+    """
+    Installed ARES version, read from the package metadata so ARES itself is not imported.
+    """
+
+    try:
+        return metadata.version('ares')
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def key(params):
+    """
+    Content hash of the ARES parameters (a dict) and the ARES version.
+    """
+
+    params = {k: (float(v) if isinstance(v, (int, float, np.number)) else v) for k, v in params.items()}
+    blob = json.dumps({'params': params, 'ares': ares_version()}, sort_keys=True)
+
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def _path(h):
+    return os.path.join(CACHE_DIR, h[:2], h + '.npz')
+
+
+def get(params):
+    """
+    Cached (nu, dTb) for params, or None.
+    """
+
+    path = _path(key(params))
+    try:
+        with np.load(path) as f:
+            nu, dTb = f['nu'], f['dTb']
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        stats['misses'] += 1
+        return None
+
+    # Mark as recently used (a read-only cache, or a file evicted since it was read, is still a hit)
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    stats['hits'] += 1
+    return nu, dTb
+
+
+def put(params, nu, dTb):
+    """
+    Store (nu, dTb) for params, then evict old entries if the cache is over MAX_BYTES.
+    """
+
+    path = _path(key(params))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        replaced = os.path.getsize(path)            # Another process stored the same point
+    except OSError:
+        replaced = 0
+
+    # Write to a temporary file and rename, so other processes never read a partial file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, nu=np.asarray(nu, dtype=float), dTb=np.asarray(dTb, dtype=float))
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+    _account(os.path.getsize(path) - replaced, MAX_BYTES)
+
+
+def cached(params, simulate):
+    """
+    (nu, dTb) for params from the cache, running simulate(**params) and storing the result on a miss.
+    A cache that cannot be written (read-only, full, no permission) does not lose the simulation.
+    """
+
+    if not ENABLED:
+        return simulate(**params)
+
+    result = get(params)
+    if result is None:
+        result = simulate(**params)
+        try:
+            put(params, *result)
+        except OSError:
+            stats['put_errors'] += 1
+
+    return result
+
+
+def _entries():
+    """
+    (mtime, size, path) of every cached file.
+    """
+
+    entries = []
+    for root, dirs, files in os.walk(CACHE_DIR):
+        for name in files:
+            if name.endswith('.npz'):
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:          # Evicted by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+
+    return entries
+
+
+@contextmanager
+def _locked():
+    """
+    Hold the cache lock for the block (serialises eviction and the running size across processes).
+    """
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(os.path.join(CACHE_DIR, '.lock'), 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _read_size():
+    try:
+        with open(os.path.join(CACHE_DIR, '.size')) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _write_size(total):
+    with open(os.path.join(CACHE_DIR, '.size'), 'w') as f:
+        f.write(str(int(total)))
+
+
+def _account(added, max_bytes=MAX_BYTES):
+    """
+    Add added bytes to the running size of the cache, evicting down to EVICT_TO * max_bytes if it goes over.
+    The running size drifts if files are removed by hand, and is made exact again whenever the cache is walked.
+    """
+
+    with _locked():
+        total = _read_size()
+        total = sum(size for mtime, size, path in _entries()) if total is None else total + added
+        if total > max_bytes:
+            total = _evict(int(EVICT_TO * max_bytes))
+        _write_size(total)
+
+
+def _evict(max_bytes):
+    """
+    Remove the least recently used files until the cache is at most max_bytes, holding the lock.
+    Returns the size of the cache left.
+    """
+
+    entries = sorted(_entries())
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            stats['evictions'] += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+
+    return total
+
+
+def evict(max_bytes=MAX_BYTES):
+    """
+    Remove the least recently used files until the cache is at most max_bytes.
+    """
+
+    with _locked():
+        _write_size(_evict(max_bytes))
+
+
+def info():
+    """
+    Number of entries and size of the cache, with the hit/miss statistics of this process.
+    """
+
+    entries = _entries()
+
+    return dict(stats, entries=len(entries), bytes=sum(size for mtime, size, path in entries),
+                max_bytes=MAX_BYTES, directory=CACHE_DIR)
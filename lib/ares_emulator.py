@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Emulator of the ARES 21 cm global signal.
+
+The ARES signal is precomputed over a grid of (fX, fstar), stored compactly on disk and new
+parameter points are served by interpolation, in place of a full ARES simulation per call.
+Run as a script to build the grid and estimate the emulator error against held-out simulations, e.g.
+
+    python ares_emulator.py --fX 0 1 21 --fstar 0 1 21 --processes 8 --validate 20
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import os
+import json
+import argparse
+import itertools
+import numpy as np
+from collections import OrderedDict
+from scipy.interpolate import RegularGridInterpolator
+import models
+import ares_pool
+
+####################################################
+###################### PATH ########################
+####################################################
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))   # Directory of ares_emulator.py (should be lib)
+BASE_DIR = os.path.dirname(PROJECT_ROOT)                    # Parent directory of PROJECT_ROOT (should be 21sampler)
+DEFAULT_GRID = '{}/samples/ares_emulator/ares_grid.npz'.format(BASE_DIR)
+
+# Frequency grid the signal is stored on [MHz] (covers the EDGES band with room for interpolation)
+NU_GRID = np.arange(40.0, 200.5, 0.5)
+
+
+####################################################
+################### GRID BUILDING ##################
+####################################################
+def simulate_points(nu, fX, fstar, processes=None):
+    """
+    ARES signal on nu for each point in the arrays fX and fstar, shape (n_points, n_channels).
+    With processes=1 the points are simulated in this process, without a pool.
+    """
+
+    if processes == 1:
+        import ares_sim
+        return np.array([ares_sim.signal_ares(nu, x, s) for x, s in zip(fX, fstar)])
+
+    with ares_pool.AresPool(nu, processes) as pool:
+        return pool.signal(nu, fX, fstar)
+
+
+def build_grid(fX, fstar, nu=NU_GRID, processes=None, path=DEFAULT_GRID):
+    """
+    Simulate ARES over the grid fX x fstar (1-D increasing arrays) and save it to path.
+    The signal is stored as float32, which is well below the accuracy of the interpolation.
+    """
+
+    fX = np.asarray(fX, dtype=float)
+    fstar = np.asarray(fstar, dtype=float)
+    points = np.array(list(itertools.product(fX, fstar)))
+
+    dTb = simulate_points(nu, points[:, 0], points[:, 1], processes=processes)
+    dTb = dTb.reshape(len(fX), len(fstar), len(nu))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    np.savez_compressed(path, fX=fX, fstar=fstar, nu=nu, dTb=dTb.astype(np.float32))
+
+    return path
+
+
+####################################################
+##################### EMULATOR #####################
+####################################################
+class AresEmulator:
+    """
+    Interpolates the ARES signal from a grid saved by build_grid.
+    Outside the grid the interpolation is extrapolated, so the grid should cover the priors.
+    """
+
+    def __init__(self, path=DEFAULT_GRID, method='cubic', maxsize=8):
+        with np.load(path) as grid:
+            self.fX = grid['fX']
+            self.fstar = grid['fstar']
+            self.nu = grid['nu']
+            self.dTb = grid['dTb'].astype(float)
+
+        self.path = path
+        self.method = method
+        self.maxsize = maxsize          # Number of frequency grids kept in the cache
+        self._cache = OrderedDict()
+
+    def _interpolator(self, nu):
+        """
+        Interpolator over (fX, fstar) of the signal on the frequencies nu, cached per frequency grid.
+        """
+
+        nu = np.asarray(nu, dtype=float)
+        key = (nu.shape, nu.tobytes())
+
+        interpolator = self._cache.get(key)
+        if interpolator is None:
+            # Move the stored spectra onto nu once, so each call is a single interpolation in (fX, fstar)
+            dTb = np.apply_along_axis(lambda T: np.interp(nu, self.nu, T), -1, self.dTb)
+            interpolator = RegularGridInterpolator((self.fX, self.fstar), dTb, method=self.method,
+                                                   bounds_error=False, fill_value=None)
+            self._cache[key] = interpolator
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+
+        return interpolator
+
+    def signal(self, nu, fX, fstar):
+        """
+        Emulated signal of shape (n_channels,), or (n_points, n_channels) for arrays of shape (n_points,).
+        """
+
+        points = np.stack(np.broadcast_arrays(fX, fstar), axis=-1)
+
+        return self._interpolator(nu)(points)
+
+    def validate(self, n_test=20, seed=None, processes=None):
+        """
+        Error of the emulator against n_test ARES simulations at random points inside the grid.
+        Returns a dict with the RMS and maximum absolute error [mK] of each test point.
+        """
+
+        rng = np.random.default_rng(seed)
+        fX = rng.uniform(self.fX[0], self.fX[-1], n_test)
+        fstar = rng.uniform(self.fstar[0], self.fstar[-1], n_test)
+
+        exact = simulate_points(self.nu, fX, fstar, processes=processes)
+        error = self.signal(self.nu, fX, fstar) - exact
+
+        return {'fX': fX.tolist(), 'fstar': fstar.tolist(),
+                'rms_error': np.sqrt(np.mean(error**2, axis=-1)).tolist(),
+                'max_abs_error': np.max(np.abs(error), axis=-1).tolist()}
+
+
+####################################################
+##################### MODELS #######################
+####################################################
+_emulator = None
+
+def default_emulator():
+    """
+    Emulator loaded from DEFAULT_GRID on first use.
+    """
+
+    global _emulator
+    if _emulator is None:
+        _emulator = AresEmulator(DEFAULT_GRID)
+
+    return _emulator
+
+
+def signal_ares_emulated(nu, fX, fstar):
+    '''
+    Emulated drop-in for ares_sim.signal_ares.
+    '''
+
+    return default_emulator().signal(nu, fX, fstar)
+
+
+def model_ares_emulated(nu, fX, fstar, a0, a1, a2, a3, a4):
+    '''
+    Emulated drop-in for ares_sim.model_ares.
+    '''
+
+    T21 = signal_ares_emulated(nu, fX, fstar)
+    Tfg = models.linearised_foreground(nu, a0, a1, a2, a3, a4)
+
+    # Combined signal
+    Tsky = T21 + Tfg
+
+    return Tsky
+
+
+####################################################
+################## BUILD & VALIDATE ################
+####################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and validate the ARES emulator grid.')
+    parser.add_argument('--fX', nargs=3, type=float, default=[0.0, 1.0, 21], metavar=('MIN', 'MAX', 'N'))
+    parser.add_argument('--fstar', nargs=3, type=float, default=[0.0, 1.0, 21], metavar=('MIN', 'MAX', 'N'))
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes (default: all cores)')
+    parser.add_argument('--validate', type=int, default=20, help='Number of held-out test simulations')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', default=DEFAULT_GRID)
+    args = parser.parse_args()
+
+    fX = np.linspace(args.fX[0], args.fX[1], int(args.fX[2]))
+    fstar = np.linspace(args.fstar[0], args.fstar[1], int(args.fstar[2]))
+    build_grid(fX, fstar, processes=args.processes, path=args.output)
+    print('Saved {} x {} grid to {}'.format(len(fX), len(fstar), args.output))
+
+    if args.validate > 0:
+        errors = AresEmulator(args.output).validate(args.validate, seed=args.seed, processes=args.processes)
+        with open(args.output.replace('.npz', '_validation.json'), 'w') as f:
+            json.dump(errors, f, indent=2)
+        print('Emulator RMS error: median {:.3g} mK, worst {:.3g} mK; max abs error {:.3g} mK'.format(
+              np.median(errors['rms_error']), np.max(errors['rms_error']), np.max(errors['max_abs_error'])))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Pool of persistent worker processes for evaluating the ARES 21 cm signal in parallel.
+
+Each worker imports ARES once when it starts and keeps the data frequency grid, so a batch of
+parameter points costs one simulation per point and returns spectra already on that grid (signal,
+and model for the full ARES sky model). A failed import is raised from the first simulation of a
+worker rather than at start-up, where it would leave the pool respawning workers for ever.
+
+sampler.py hands the pool to the samplers that take one (dynesty, ultranest, nessai) for exact ARES
+runs with npool > 1: the workers are then also given the likelihood and priors, the points the
+sampler proposes together are evaluated across them with map, and the marginalised foreground is
+recovered with the batched signal of the posterior on a second pool (bilby closes the first). ares_emulator.py builds its grid with it.
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import numpy as np
+import multiprocessing
+import models
+
+
+####################################################
+##################### WORKERS ######################
+####################################################
+_nu = None              # Frequency grid of the worker
+_import_error = None    # ImportError of ARES at start-up, raised from the first simulation
+
+def _init_worker(nu, likelihood=None, priors=None):
+    """
+    Worker start-up: import ARES, keep the frequency grid and, for a sampler's pool, set up the
+    likelihood and priors that bilby evaluates (see mpi_pool.init_bilby_worker).
+    """
+
+    global _nu, _import_error
+    _nu = nu
+
+    try:
+        import ares         # Imported once per worker, so every call is warm
+    except ImportError as error:
+        _import_error = error
+
+    if likelihood is not None:
+        import mpi_pool
+        mpi_pool.init_bilby_worker(likelihood, priors)
+
+
+def _signal(point):
+    """
+    ARES signal on the worker's frequency grid for one (fX, fstar) point.
+    """
+
+    import ares_sim
+
+    try:
+        return ares_sim.signal_ares(_nu, point[0], point[1])
+    except ImportError:
+        raise _import_error or ImportError('ARES is not installed')
+
+
+####################################################
+####################### POOL #######################
+####################################################
+class AresPool:
+    """
+    Warm process pool returning ARES spectra on the frequency grid nu, and the pool of a sampler when
+    given its likelihood and priors. Use as a context manager, or call close() when done.
+    """
+
+    def __init__(self, nu, processes=None, likelihood=None, priors=None):
+        self.nu = np.asarray(nu, dtype=float)
+        self.processes = processes or multiprocessing.cpu_count()
+        self.size = self.processes
+        self.pool = multiprocessing.Pool(self.processes, initializer=_init_worker, initargs=(self.nu, likelihood, priors))
+
+    def _check_grid(self, nu):
+        if not np.array_equal(np.asarray(nu, dtype=float), self.nu):
+            raise ValueError('The ARES pool returns spectra on its own frequency grid only')
+
+    def signal(self, nu, fX, fstar):
+        """
+        Batched ares_sim.signal_ares: shape (n_channels,), or (n_points, n_channels) for arrays of
+        shape (n_points,). nu must be the frequency grid of the pool.
+        """
+
+        self._check_grid(nu)
+        points = np.stack(np.broadcast_arrays(fX, fstar), axis=-1)
+        if points.ndim == 1:
+            return self.pool.apply(_signal, (points,))
+
+        chunksize = max(1, len(points) // (4 * self.processes))
+
+        return np.array(self.pool.map(_signal, points, chunksize=chunksize))
+
+    def model(self, nu, fX, fstar, a0, a1, a2, a3, a4):
+        '''
+        Batched ares_sim.model_ares, with the signals evaluated across the pool.
+        nu must be the frequency grid of the pool.
+        '''
+
+        T21 = self.signal(nu, fX, fstar)
+        Tfg = models.linearised_foreground(self.nu, a0, a1, a2, a3, a4)
+
+        # Combined signal
+        Tsky = T21 + Tfg
+
+        return Tsky
+
+    def map(self, func, iterable, chunksize=None):
+        """
+        [func(x) for x in iterable] across the workers (the pool interface of the samplers).
+        """
+
+        return self.pool.map(func, iterable, chunksize=chunksize)
+
+    def close(self):
+        """
+        Stop the workers once their work is done. Safe to call more than once (bilby closes the pools it is given).
+        """
+
+        self.pool.close()
+        self.pool.join()
+
+    def join(self):
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
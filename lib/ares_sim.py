@@ -13,11 +13,8 @@ Contact: yi.lim17@imperial.ac.uk
 ####################################################
 import os
 import numpy as np
-import math as m
-import matplotlib.pyplot as plt
-import ares
-import bilby
 import models
+import ares_cache
 from scipy.interpolate import interp1d
 
 ####################################################
@@ -29,10 +26,9 @@ BASE_DIR = os.path.dirname(PROJECT_ROOT)                    # Parent directory o
 ####################################################
 ##################### MODELS #######################
 ####################################################
-model_call_counter = 0
+def _run_ares(fX, fstar):
+    import ares                 # Imported on the first simulation, so cache hits never load ARES
 
-
-def simulation_ares(fX, fstar):
     # Directory and file name
     # outdir = '{}/samples/ares'.format(BASE_DIR)
     # label = 'simulation'
@@ -49,23 +45,37 @@ def simulation_ares(fX, fstar):
     return nu_sim, T21_sim
 
 
+def simulation_ares(fX, fstar):
+    '''
+    ARES 21 cm global signal (nu, dTb), read from the on-disk cache when it has been simulated before.
+    '''
+
+    return ares_cache.cached(dict(fX=fX, fstar=fstar), _run_ares)
+
 
-def model_ares(nu, fX, fstar, a0, a1, a2, a3, a4):
+
+def signal_ares(nu, fX, fstar):
     '''
-    Functional form of 21cm Global signal should go here.
+    ARES 21 cm global signal interpolated onto the frequencies nu.
+    Arrays of points of shape (n_points,) are simulated one by one, giving shape (n_points, n_channels).
     '''
-    global model_call_counter
-    model_call_counter += 1
-    print(f"i={model_call_counter}\t fX={fX}\t fstar={fstar}\t a0={a0}\t a1={a1}\t a2={a2}\t a3={a3}\t a4={a4}")
 
-    sim = ares.simulations.Global21cm(fX=fX, fstar=fstar, verbose=False)
-    sim.run()
+    if np.ndim(fX) or np.ndim(fstar):
+        return np.array([signal_ares(nu, x, s) for x, s in zip(*np.broadcast_arrays(fX, fstar))])
 
-    nu_mod = sim.history['nu']
-    T21_mod = sim.history['dTb']
+    nu_mod, T21_mod = simulation_ares(fX, fstar)
 
     f = interp1d(nu_mod, T21_mod, fill_value="extrapolate") # Create function
     T21_model_new = f(nu)   # Create new data points from function
+
+    return T21_model_new
+
+
+def model_ares(nu, fX, fstar, a0, a1, a2, a3, a4):
+    '''
+    Functional form of 21cm Global signal should go here.
+    '''
+    T21_model_new = signal_ares(nu, fX, fstar)
     Tfg_model_new = models.linearised_foreground(nu, a0, a1, a2, a3, a4)
 
     # Combined signal
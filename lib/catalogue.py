@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+"""
+Queryable catalogue of the sampling runs in samples/.
+
+Each run directory samples/<case>_<data>/<label> is indexed into a SQLite file with its set-up
+(case, data, sampler, livepoints, ...), evidence, sampling time, likelihood-call count and the
+posterior median and 68% interval of every parameter, so runs can be filtered and compared without
+loading any posterior. update() only re-reads directories whose result files have changed.
+
+    python catalogue.py update
+    python catalogue.py list --case systematic_model --data edges --sort log_evidence
+    python catalogue.py best --case systematic_model --data edges
+    python catalogue.py compare --case linearised_model --data edges --parameters A nu0 w tau
+    python catalogue.py show systematic_model_edges_pymultinest_500
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import numpy as np
+import result_store
+import summary
+
+####################################################
+###################### PATH ########################
+####################################################
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))   # Directory of catalogue.py (should be lib)
+BASE_DIR = os.path.dirname(PROJECT_ROOT)                    # Parent directory of PROJECT_ROOT (should be 21sampler)
+SAMPLES_DIR = '{}/samples'.format(BASE_DIR)
+DEFAULT_DB = '{}/catalogue.sqlite'.format(SAMPLES_DIR)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    label TEXT,
+    case_name TEXT,
+    data TEXT,
+    sampler TEXT,
+    livepoints INTEGER,
+    ares_mode TEXT,
+    marginalise INTEGER,
+    seed INTEGER,
+    warm_start INTEGER,
+    tighten REAL,
+    n_spectra INTEGER,
+    log_evidence REAL,
+    log_evidence_err REAL,
+    sampling_time REAL,
+    wall_time REAL,
+    likelihood_calls INTEGER,
+    n_samples INTEGER,
+    signature TEXT,
+    indexed_at REAL
+);
+CREATE TABLE IF NOT EXISTS parameters (
+    run_id INTEGER REFERENCES runs(id) ON DELETE CASCADE,
+    name TEXT,
+    median REAL,
+    lower REAL,
+    upper REAL,
+    PRIMARY KEY (run_id, name)
+);
+'''
+
+RUN_COLUMNS = ('path', 'label', 'case_name', 'data', 'sampler', 'livepoints', 'ares_mode', 'marginalise', 'seed',
+               'warm_start', 'tighten', 'n_spectra', 'log_evidence', 'log_evidence_err', 'sampling_time', 'wall_time', 'likelihood_calls', 'n_samples')
+
+# Columns of runs added since the first version of the catalogue, with their types
+ADDED_COLUMNS = {'warm_start': 'INTEGER', 'tighten': 'REAL', 'n_spectra': 'INTEGER'}
+
+# Data of sampler.py, which end the group directory names <case>_<data> (longest first, so 'mock_joint' is not read as 'mock')
+DATA_NAMES = ('mock_joint', 'edges', 'mock', 'ares')
+
+# Files whose changes trigger a rescan of a run directory
+RESULT_SUFFIXES = ('_result.npz', '_result.json', '_timing.json', 'campaign_job.json')
+
+
+####################################################
+################### RUN PARSING ####################
+####################################################
+def parse_label(group, label):
+    """
+    Set-up of a run from its directory names, samples/<case>_<data>/<case>_<data>_<sampler>_<livepoints>[_spectra<n>]
+    [_emulated][_marginalised][_seed<n>][_tight<n>][_warm<n>] (see sampler.output_label).
+    """
+
+    data = next((d for d in DATA_NAMES if group.endswith('_' + d)), None)
+    case = group[:-len(data) - 1] if data else None
+    if data is None:
+        case, _, data = group.rpartition('_')
+    setup = dict(case_name=case or None, data=data or None, sampler=None, livepoints=None,
+                 ares_mode='exact', marginalise=0, seed=None, warm_start=None, tighten=None, n_spectra=None)
+
+    rest = label[len(group) + 1:].split('_') if label.startswith(group + '_') else label.split('_')
+    if len(rest) >= 2 and rest[1].isdigit():
+        setup['sampler'], setup['livepoints'] = rest[0], int(rest[1])
+    for token in rest[2:]:
+        if token == 'emulated':
+            setup['ares_mode'] = 'emulated'
+        elif token == 'marginalised':
+            setup['marginalise'] = 1
+        elif re.fullmatch(r'seed\d+', token):
+            setup['seed'] = int(token[4:])
+        elif re.fullmatch(r'warm\d+', token):
+            setup['warm_start'] = int(token[4:])
+        elif re.fullmatch(r'spectra\d+', token):
+            setup['n_spectra'] = int(token[7:])
+        elif re.fullmatch(r'tight[0-9.e+-]+', token):
+            setup['tighten'] = float(token[5:])
+
+    return setup
+
+
+def _signature(outdir):
+    """
+    Hash of the names, sizes and mtimes of the result files in outdir (and of the MultiNest directories).
+    """
+
+    entries = []
+    for entry in os.scandir(outdir):
+        if entry.name.endswith(RESULT_SUFFIXES) or (entry.is_dir() and entry.name.startswith('pm_')):
+            st = entry.stat()
+            entries.append((entry.name, st.st_size, st.st_mtime_ns))
+
+    return hashlib.sha1(json.dumps(sorted(entries)).encode()).hexdigest() if entries else None
+
+
+def _multinest_dir(outdir):
+    """
+    Directory holding MultiNest's stats.dat and resume.dat, or None.
+    """
+
+    for root, dirs, files in os.walk(outdir):
+        if 'stats.dat' in files and os.path.basename(root) != os.path.basename(outdir):
+            return root
+
+    return None
+
+
+def _multinest_info(outdir):
+    """
+    (log Z, error, likelihood calls, sampling time) from MultiNest's own files, each None if missing.
+    """
+
+    log_z = log_z_err = calls = sampling_time = None
+    pm = _multinest_dir(outdir)
+    if pm is None:
+        return log_z, log_z_err, calls, sampling_time
+
+    try:
+        with open(os.path.join(pm, 'stats.dat')) as f:
+            for line in f:
+                if 'Global Log-Evidence' in line and 'Importance' not in line:
+                    values = line.split(':')[1].split('+/-')
+                    log_z, log_z_err = float(values[0]), float(values[1])
+                    break
+        with open(os.path.join(pm, 'resume.dat')) as f:
+            f.readline()
+            calls = int(f.readline().split()[1])           # Iterations, likelihood calls, clusters, live points
+        with open(os.path.join(pm, 'sampling_time.dat')) as f:
+            sampling_time = float(f.read())
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return log_z, log_z_err, calls, sampling_time
+
+
+def _summarise(columns, keys):
+    if not keys:
+        return {}, None
+
+    return summary.summarise(columns, keys), len(columns[keys[0]])
+
+
+def _load_run(outdir, label):
+    """
+    (metadata dict, posterior summary of summary.summarise, number of samples) of a run, from the result
+    store or bilby's JSON result. The JSON is parsed directly, so bilby is not imported.
+    """
+
+    if os.path.exists(result_store.store_path(outdir, label)):
+        with result_store.ResultStore.open(outdir, label) as store:
+            return (store.meta,) + _summarise(store, list(store.meta.get('search_parameter_keys') or store.posterior_keys))
+
+    path = os.path.join(outdir, '{}_result.json'.format(label))
+    if os.path.exists(path):
+        with open(path) as f:
+            meta = json.load(f)
+        content = meta.pop('posterior', {}).get('content', {})
+        keys = [k for k in meta.get('search_parameter_keys') or list(content) if k in content]
+        return (meta,) + _summarise({k: np.asarray(content[k], dtype=float) for k in keys}, keys)
+
+    return {}, {}, None
+
+
+def index_run(outdir):
+    """
+    Row of the runs table and {parameter: (median, lower, upper)} for the run directory outdir.
+    """
+
+    label = os.path.basename(outdir)
+    group = os.path.basename(os.path.dirname(outdir))
+    row = dict(path=os.path.abspath(outdir), label=label, **parse_label(group, label))
+
+    # Set-up recorded by campaign.py takes precedence over the directory names
+    try:
+        with open(os.path.join(outdir, 'campaign_job.json')) as f:
+            job = json.load(f)['job']
+        for key, column in (('case', 'case_name'), ('data', 'data'), ('sampler', 'sampler'), ('livepoints', 'livepoints'),
+                            ('ares_mode', 'ares_mode'), ('marginalise', 'marginalise'), ('seed', 'seed'),
+                            ('warm_start', 'warm_start'), ('tighten', 'tighten'), ('n_spectra', 'n_spectra')):
+            if key in job:
+                row[column] = job[key]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    meta, stats, n_samples = _load_run(outdir, label)
+    log_z, log_z_err, calls, sampling_time = _multinest_info(outdir)
+
+    row['log_evidence'] = meta.get('log_evidence', log_z)
+    row['log_evidence_err'] = meta.get('log_evidence_err', log_z_err)
+    row['sampling_time'] = meta.get('sampling_time', sampling_time)
+    row['likelihood_calls'] = meta.get('num_likelihood_evaluations') or calls
+    row['wall_time'] = None
+    row['n_samples'] = n_samples
+
+    # Counters and wall time of runs made with timing=True (see instrument.py)
+    try:
+        with open(os.path.join(outdir, '{}_timing.json'.format(label))) as f:
+            timing = json.load(f)
+        row['wall_time'] = timing.get('wall_time')
+        row['likelihood_calls'] = timing['counters']['likelihood']['calls']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    # The 16% and 84% quantiles are those of the median -/+ error that plot.py and the other summaries report
+    parameters = {name: (s['median'], s['median'] - s['minus'], s['median'] + s['plus']) for name, s in stats.items()}
+
+    return row, parameters
+
+
+def find_run_dirs(root=SAMPLES_DIR):
+    """
+    Run directories samples/<case>_<data>/<label>.
+    """
+
+    dirs = []
+    for group in sorted(os.scandir(root), key=lambda e: e.name) if os.path.isdir(root) else []:
+        if group.is_dir():
+            dirs.extend(e.path for e in sorted(os.scandir(group.path), key=lambda e: e.name) if e.is_dir())
+
+    return dirs
+
+
+####################################################
+#################### CATALOGUE #####################
+####################################################
+class Catalogue:
+    """
+    SQLite index of the runs under root. Call update() to bring it up to date with the directory tree.
+    """
+
+    def __init__(self, path=DEFAULT_DB, root=SAMPLES_DIR):
+        self.path = path
+        self.root = root
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """
+        Add the columns of runs missing from a catalogue made by an older version, and clear the signatures
+        so that update() re-indexes every run to fill them in.
+        """
+
+        existing = {r['name'] for r in self.db.execute('PRAGMA table_info(runs)')}
+        missing = {k: v for k, v in ADDED_COLUMNS.items() if k not in existing}
+        with self.db:
+            for name, kind in missing.items():
+                self.db.execute('ALTER TABLE runs ADD COLUMN {} {}'.format(name, kind))
+            if missing:
+                self.db.execute('UPDATE runs SET signature = NULL')
+
+    def update(self):
+        """
+        Index new and changed run directories and drop deleted ones.
+        Returns a dict with the number of runs indexed, removed and unchanged.
+        """
+
+        known = {r['path']: r['signature'] for r in self.db.execute('SELECT path, signature FROM runs')}
+        stats = dict(indexed=0, removed=0, unchanged=0)
+
+        seen = set()
+        with self.db:
+            for outdir in find_run_dirs(self.root):
+                path = os.path.abspath(outdir)
+                signature = _signature(outdir)
+                if signature is None:               # No results yet
+                    continue
+                seen.add(path)
+                if known.get(path) == signature:
+                    stats['unchanged'] += 1
+                    continue
+
+                row, summary = index_run(outdir)
+                self.db.execute('DELETE FROM runs WHERE path = ?', (path,))
+                cursor = self.db.execute('INSERT INTO runs ({}, signature, indexed_at) VALUES ({})'.format(
+                                         ', '.join(RUN_COLUMNS), ', '.join('?' * (len(RUN_COLUMNS) + 2))),
+                                         [row[c] for c in RUN_COLUMNS] + [signature, time.time()])
+                self.db.executemany('INSERT INTO parameters VALUES (?, ?, ?, ?, ?)',
+                                    [(cursor.lastrowid, name) + values for name, values in summary.items()])
+                stats['indexed'] += 1
+
+            for path in set(known) - seen:
+                self.db.execute('DELETE FROM runs WHERE path = ?', (path,))
+                stats['removed'] += 1
+
+        return stats
+
+    def runs(self, sort=None, descending=False, limit=None, **filters):
+        """
+        Runs matching filters (column=value, e.g. case_name='systematic_model', data='edges') as a list of dicts.
+        """
+
+        where = ' AND '.join('{} = ?'.format(_column(k)) for k in filters) or '1'
+        query = 'SELECT * FROM runs WHERE {}'.format(where)
+        if sort:
+            query += ' ORDER BY {} IS NULL, {} {}'.format(_column(sort), _column(sort), 'DESC' if descending else 'ASC')
+        if limit:
+            query += ' LIMIT {:d}'.format(limit)
+
+        return [dict(r) for r in self.db.execute(query, list(filters.values()))]
+
+    def best(self, **filters):
+        """
+        Run with the highest log-evidence among those matching filters, or None.
+        """
+
+        runs = self.runs(sort='log_evidence', descending=True, limit=1, **filters)
+        return runs[0] if runs else None
+
+    def parameters(self, run_id):
+        """
+        {parameter: (median, lower, upper)} of a run.
+        """
+
+        rows = self.db.execute('SELECT name, median, lower, upper FROM parameters WHERE run_id = ? ORDER BY rowid', (run_id,))
+        return {r['name']: (r['median'], r['lower'], r['upper']) for r in rows}
+
+    def compare(self, parameters=None, sort='log_evidence', **filters):
+        """
+        Matching runs with their parameter summaries added as run['parameters'], best evidence first.
+        """
+
+        runs = self.runs(sort=sort, descending=True, **filters)
+        for run in runs:
+            summary = self.parameters(run['id'])
+            run['parameters'] = {k: v for k, v in summary.items() if parameters is None or k in parameters}
+
+        return runs
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _column(name):
+    # 'case' is accepted for the case_name column; anything else must be a column of runs
+    name = 'case_name' if name == 'case' else name
+    if name not in RUN_COLUMNS + ('id', 'indexed_at'):
+        raise ValueError('Unknown column: {}'.format(name))
+    return name
+
+
+####################################################
+####################### CLI ########################
+####################################################
+def _print_runs(runs):
+    print('{:55} {:>12} {:>8} {:>10} {:>12}'.format('label', 'logZ', 'err', 'time [s]', 'calls'))
+    for r in runs:
+        print('{:55} {:>12} {:>8} {:>10} {:>12}'.format(
+              r['label'], _fmt(r['log_evidence'], '.3f'), _fmt(r['log_evidence_err'], '.3f'),
+              _fmt(r['sampling_time'], '.1f'), _fmt(r['likelihood_calls'], 'd')))
+
+
+def _fmt(value, spec):
+    return '-' if value is None else format(value, spec)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Catalogue of the sampling runs in samples/.')
+    parser.add_argument('command', choices=['update', 'list', 'best', 'compare', 'show'])
+    parser.add_argument('label', nargs='?', help='Run label (for show)')
+    parser.add_argument('--db', default=DEFAULT_DB)
+    parser.add_argument('--root', default=SAMPLES_DIR)
+    parser.add_argument('--case')
+    parser.add_argument('--data')
+    parser.add_argument('--sampler')
+    parser.add_argument('--livepoints', type=int)
+    parser.add_argument('--warm-start', type=int)
+    parser.add_argument('--tighten', type=float)
+    parser.add_argument('--n-spectra', type=int)
+    parser.add_argument('--sort', default='log_evidence')
+    parser.add_argument('--ascending', action='store_true')
+    parser.add_argument('--parameters', nargs='+')
+    parser.add_argument('--no-update', action='store_true', help='Query the catalogue as it is, without rescanning')
+    args = parser.parse_args()
+
+    filters = {k: v for k, v in dict(case=args.case, data=args.data, sampler=args.sampler, livepoints=args.livepoints,
+                                     warm_start=args.warm_start, tighten=args.tighten,
+                                     n_spectra=args.n_spectra).items() if v is not None}
+
+    with Catalogue(args.db, args.root) as catalogue:
+        if args.command == 'update' or not args.no_update:
+            stats = catalogue.update()
+            if args.command == 'update':
+                print('{indexed} indexed, {removed} removed, {unchanged} unchanged'.format(**stats))
+
+        if args.command == 'list':
+            _print_runs(catalogue.runs(sort=args.sort, descending=not args.ascending, **filters))
+
+        elif args.command == 'best':
+            run = catalogue.best(**filters)
+            if run:
+                _print_runs([run])
+
+        elif args.command == 'compare':
+            runs = catalogue.compare(args.parameters, sort=args.sort, **filters)
+            names = args.parameters or sorted({k for r in runs for k in r['parameters']})
+            print('{:55} {:>10} '.format('label', 'logZ') + ' '.join('{:>22}'.format(n) for n in names))
+            for r in runs:
+                cells = ['{:>22}'.format('{:.4g} [{:.3g}, {:.3g}]'.format(*r['parameters'][n]) if n in r['parameters'] else '-')
+                         for n in names]
+                print('{:55} {:>10} '.format(r['label'], _fmt(r['log_evidence'], '.3f')) + ' '.join(cells))
+
+        elif args.command == 'show':
+            for run in catalogue.runs(label=args.label):
+                for k in RUN_COLUMNS:
+                    print('{:18} {}'.format(k, run[k]))
+                for name, (median, lower, upper) in catalogue.parameters(run['id']).items():
+                    print('{:18} {:.6g} (+{:.3g} / -{:.3g})'.format(name, median, upper - median, median - lower))
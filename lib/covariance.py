@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Noise covariances of a spectrum, for the correlated-noise likelihood in likelihoods.py.
+
+Each class factorises its covariance C once when it is built and then gives, for residuals r of shape
+(..., n_channels), the quadratic form chi2(r) = r^T C^-1 r and the constant log det C:
+
+    DenseCovariance       any C, Cholesky factor                        O(n^3) once, O(n^2) per call
+    BandedCovariance      C[i, j] = 0 for |i - j| > b, banded Cholesky  O(n b^2) once, O(n b) per call
+    ToeplitzCovariance    stationary noise on a uniform grid            O(n^2) once, O(n log n) per call
+    LowRankCovariance     diagonal plus rank k, Woodbury identity       O(n k^2) once, O(n k) per call
+
+For the Toeplitz covariance, the Levinson-Durbin recursion gives log det C and the first column of C^-1, from
+which the Gohberg-Semencul formula writes C^-1 as a difference of products of triangular Toeplitz matrices,
+each applied with FFTs. Stationary noise that is correlated over only b channels is also banded, and
+BandedCovariance(stationary_bands(column, n)) is then the cheaper choice.
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import numpy as np
+from scipy import fft
+from scipy.linalg import cholesky, cholesky_banded, cho_solve_banded, solve_triangular
+
+
+def _columns(r, n):
+    """
+    Residuals of shape (..., n) as columns (n, n_residuals), and the leading shape to return chi^2 in.
+    """
+
+    r = np.asarray(r, dtype=float)
+    if r.shape[-1] != n:
+        raise ValueError('Residuals of {} channels for a covariance of {}'.format(r.shape[-1], n))
+
+    return r.reshape(-1, n).T, r.shape[:-1]
+
+
+####################################################
+#################### COVARIANCES ###################
+####################################################
+class DenseCovariance:
+    """
+    Full covariance matrix C of shape (n, n), factorised as C = L L^T. chi2 is |L^-1 r|^2.
+    """
+
+    def __init__(self, C):
+        self.L = cholesky(np.asarray(C, dtype=float), lower=True)
+        self.n = len(self.L)
+        self.log_det = 2.0 * float(np.sum(np.log(np.diag(self.L))))
+
+    def chi2(self, r):
+        R, shape = _columns(r, self.n)
+        w = solve_triangular(self.L, R, lower=True, check_finite=False)
+
+        return np.sum(w**2, axis=0).reshape(shape)
+
+    def matrix(self):
+        return self.L @ self.L.T
+
+
+class BandedCovariance:
+    """
+    Covariance with bandwidth b in lower band storage, bands[i, j] = C[i + j, j] of shape (b + 1, n)
+    (as scipy.linalg.cholesky_banded), e.g. noise correlated between neighbouring channels.
+    """
+
+    def __init__(self, bands):
+        self.bands = np.asarray(bands, dtype=float)
+        self.bandwidth = len(self.bands) - 1
+        self.n = self.bands.shape[1]
+        self.factor = cholesky_banded(self.bands, lower=True)
+        self.log_det = 2.0 * float(np.sum(np.log(self.factor[0])))
+
+    def chi2(self, r):
+        R, shape = _columns(r, self.n)
+        x = cho_solve_banded((self.factor, True), R, check_finite=False)
+
+        return np.sum(R * x, axis=0).reshape(shape)
+
+    def matrix(self):
+        C = np.diag(self.bands[0])
+        for i in range(1, self.bandwidth + 1):
+            C += np.diag(self.bands[i, :self.n - i], -i) + np.diag(self.bands[i, :self.n - i], i)
+
+        return C
+
+
+def stationary_bands(column, n):
+    """
+    Lower band storage of the stationary covariance C[i, j] = column[|i - j|] on n channels, for lags
+    up to len(column) - 1 (beyond which it is zero).
+    """
+
+    return np.repeat(np.asarray(column, dtype=float)[:, np.newaxis], n, axis=1)
+
+
+def _durbin(column):
+    """
+    Levinson-Durbin recursion for the symmetric Toeplitz matrix with first column column. Returns the prediction
+    error variance E and the vector v = (1, -a_1, ..., -a_{n-1}) with C v = E e_1, and log det C.
+    """
+
+    t = np.asarray(column, dtype=float)
+    n = len(t)
+    a = np.zeros(max(n - 1, 0))
+    E = t[0]
+    log_det = np.log(E)
+
+    for k in range(1, n):
+        kappa = (t[k] - a[:k - 1] @ t[k - 1:0:-1]) / E
+        a[:k - 1] = a[:k - 1] - kappa * a[:k - 1][::-1]
+        a[k - 1] = kappa
+        E *= 1.0 - kappa**2
+        if not E > 0.0:
+            raise np.linalg.LinAlgError('The Toeplitz covariance is not positive definite')
+        log_det += np.log(E)
+
+    return E, np.concatenate([[1.0], -a]), float(log_det)
+
+
+class ToeplitzCovariance:
+    """
+    Stationary covariance on a uniform grid, C[i, j] = column[|i - j|] for n = len(column) channels.
+
+    With x = C^-1 e_1 = v / E (see _durbin), the Gohberg-Semencul formula is
+        C^-1 = (1/x_0) (L(x) L(x)^T - L(u) L(u)^T),    u = (0, x_{n-1}, ..., x_1)
+    where L(y) is the lower-triangular Toeplitz matrix with first column y, so that
+        chi2 = (|L(v)^T r|^2 - |L(Jv)^T r|^2) / E
+    with both products correlations of r done with real FFTs of length >= 2n.
+    """
+
+    def __init__(self, column):
+        self.column = np.asarray(column, dtype=float)
+        self.n = len(self.column)
+        self.E, v, self.log_det = _durbin(self.column)
+
+        u = np.zeros(self.n)
+        u[1:] = v[:0:-1]
+        self.size = fft.next_fast_len(2 * self.n, real=True)
+        self._v_hat = np.conj(fft.rfft(v, self.size))
+        self._u_hat = np.conj(fft.rfft(u, self.size))
+
+    def chi2(self, r):
+        r = np.asarray(r, dtype=float)
+        if r.shape[-1] != self.n:
+            raise ValueError('Residuals of {} channels for a covariance of {}'.format(r.shape[-1], self.n))
+
+        r_hat = fft.rfft(r, self.size, axis=-1)
+        a = fft.irfft(self._v_hat * r_hat, self.size, axis=-1)[..., :self.n]
+        b = fft.irfft(self._u_hat * r_hat, self.size, axis=-1)[..., :self.n]
+
+        return (np.sum(a**2, axis=-1) - np.sum(b**2, axis=-1)) / self.E
+
+    def matrix(self):
+        lag = np.abs(np.arange(self.n)[:, np.newaxis] - np.arange(self.n)[np.newaxis, :])
+        return self.column[lag]
+
+
+class LowRankCovariance:
+    """
+    Diagonal plus low-rank covariance C = diag(diagonal) + U U^T, with U of shape (n, k): independent channel
+    noise plus k correlated modes (e.g. calibration residuals). By the Woodbury identity, with K = I + U^T D^-1 U,
+        chi2 = r^T D^-1 r - |K^-1/2 U^T D^-1 r|^2,    log det C = log det D + log det K.
+    """
+
+    def __init__(self, diagonal, U):
+        self.U = np.asarray(U, dtype=float)
+        self.n, self.k = self.U.shape
+        self.diagonal = np.asarray(diagonal, dtype=float) * np.ones(self.n)
+
+        self._inv_diagonal = 1.0 / self.diagonal
+        self._projection = self.U * self._inv_diagonal[:, np.newaxis]         # D^-1 U
+        self._K = cholesky(np.eye(self.k) + self.U.T @ self._projection, lower=True)
+        self.log_det = float(np.sum(np.log(self.diagonal)) + 2.0 * np.sum(np.log(np.diag(self._K))))
+
+    def chi2(self, r):
+        R, shape = _columns(r, self.n)
+        z = solve_triangular(self._K, self._projection.T @ R, lower=True, check_finite=False)
+
+        return (self._inv_diagonal @ R**2 - np.sum(z**2, axis=0)).reshape(shape)
+
+    def matrix(self):
+        return np.diag(self.diagonal) + self.U @ self.U.T
+
+
+####################################################
+###################### CHECK #######################
+####################################################
+def check(n=200, seed=0):
+    """
+    Largest relative differences of chi^2 (for a batch of residuals) and of log det C of each covariance from
+    a dense solve of its matrix, for exponentially correlated noise on n channels. Returns {name: (chi2, log det)}.
+    """
+
+    rng = np.random.default_rng(seed)
+    lag = np.arange(n)
+    column = 1e-4 * np.exp(- lag / 5.0) + 1e-4 * (lag == 0)
+    bands = stationary_bands(column[:8], n)
+    bands[0] += rng.uniform(1e-5, 1e-4, n)
+    covariances = {'dense': DenseCovariance(ToeplitzCovariance(column).matrix() + np.diag(rng.uniform(1e-5, 1e-4, n))),
+                   'banded': BandedCovariance(bands),
+                   'toeplitz': ToeplitzCovariance(column),
+                   'low rank': LowRankCovariance(rng.uniform(1e-5, 1e-4, n), 1e-2 * rng.standard_normal((n, 4)))}
+
+    report = {}
+    for name, covariance in covariances.items():
+        C = covariance.matrix()
+        r = rng.multivariate_normal(np.zeros(n), C, size=3).reshape(3, n)
+        chi2 = np.einsum('pi,pi->p', r, np.linalg.solve(C, r.T).T)
+        log_det = np.linalg.slogdet(C)[1]
+        report[name] = (float(np.max(np.abs(covariance.chi2(r) - chi2) / chi2)), abs(covariance.log_det - log_det) / abs(log_det))
+
+    return report
+
+
+if __name__ == '__main__':
+    import timeit
+
+    for name, (chi2, log_det) in check().items():
+        print('{:10} chi^2 relative difference {:.1e}, log det {:.1e}'.format(name, chi2, log_det))
+
+    # Exponentially correlated noise of 0.01 K over 5 channels, on grids from the EDGES band upwards
+    for n in (123, 1000, 10000, 100000):
+        lag = np.arange(n)
+        column = 1e-4 * np.exp(- lag / 5.0)
+        r = np.random.default_rng(0).normal(0.0, 0.01, n)
+        setups = {'banded (b=50)': lambda: BandedCovariance(stationary_bands(column[:51], n)),
+                  'toeplitz': lambda: ToeplitzCovariance(column),
+                  'low rank (k=8)': lambda: LowRankCovariance(1e-4, 1e-3 * np.cos(np.outer(lag / n, np.arange(8)) * np.pi))}
+        if n <= 10000:
+            setups['dense'] = lambda: DenseCovariance(1e-4 * np.exp(- np.abs(lag[:, np.newaxis] - lag[np.newaxis, :]) / 5.0))
+        for name, build in setups.items():
+            start = timeit.default_timer()
+            covariance = build()
+            once = timeit.default_timer() - start
+            t = min(timeit.repeat(lambda: covariance.chi2(r), number=20, repeat=3)) / 20
+            print('n = {:6} {:15} factorised in {:8.3f} s, chi^2 in {:9.1f} us'.format(n, name, once, t * 1e6))
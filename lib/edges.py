@@ -18,10 +18,10 @@ Contact: yi.lim17@imperial.ac.uk
 ################### LIBRARIES ######################
 ####################################################
 import os
-import bilby
+import json
+import hashlib
+import tempfile
 import numpy as np
-import matplotlib.pyplot as plt
-import astropy.io.ascii as ascii
 
 
 ####################################################
@@ -29,6 +29,13 @@ import astropy.io.ascii as ascii
 ####################################################
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))   # Directory of edges.py (should be lib)
 BASE_DIR = os.path.dirname(PROJECT_ROOT)                    # Parent directory of PROJECT_ROOT (should be 21sampler)
+EDGES_DIR = '{}/edges2018'.format(PROJECT_ROOT)             # EDGES data releases
+
+# Binary cache of the parsed releases (EDGES_CACHE_DIR overrides the default: 21sampler/samples/edges_cache)
+CACHE_DIR = os.environ.get('EDGES_CACHE_DIR', '{}/samples/edges_cache'.format(BASE_DIR))
+
+FIGURE1 = 'figure1_plotdata.csv'        # Sky spectrum, residuals and best-fit model (Bowman 2018, figure 1)
+FIGURE2 = 'figure2_plotdata.csv'        # Best-fit 21 cm profiles of the hardware cases H1-H6 and P8 (figure 2)
 
 
 ####################################################
@@ -53,7 +60,7 @@ def thermalNoise(Tsky, epsilon = 1.0e-4, constant = True):
     return noise
 
 # Read EDGES data
-def read_edges():
+def read_edges(dstart=3, dend=-2, mask=False, filename=FIGURE1):
     """
     Read in EDGES data and return nu, signal, errors
 
@@ -70,26 +77,16 @@ def read_edges():
     column 5: Tres2 [K] - residuals to the best-fit combined foreground and 21cm model, plotted in panel (c)
     column 6: Tmodel [K] - best-fit 21cm model, plotted in panel (d)
     column 7: T21 [K] - Combined Tmodel + Tres2, plotted in panel (e)
+
+    The data set has zeros at the beginning and end, which are skipped by the rows [dstart:dend]
+    (or by mask=True, which keeps the rows with non-zero weight). The columns are read-only views
+    of the binary cache made by load_release.
     """
 
-    # Select EDGES data file directory
-    fig1file = "{}/edges2018/figure1_plotdata.csv".format(BASE_DIR)
+    data = load_release(filename, start=dstart, stop=dend, mask='Weight' if mask else None)
 
-    # Read in EDGES data (as a Table object)
-    data = ascii.read(fig1file)
-    
-    # Data set has zeros as beginning and end, so skip those
-    dstart = 3
-    dend = -2
-
-    # Assign data from Table
-    nu = np.array(data['Frequency [MHz]'][dstart:dend])
-    weight = np.array(data['Weight'][dstart:dend])
-    Tsky = np.array(data['a: Tsky [K]'][dstart:dend])
-    Tres1 = np.array(data['b: Tres1 [K]'][dstart:dend])
-    Tres2 = np.array(data['c: Tres2 [K]'][dstart:dend])
-    Tmodel = np.array(data[ 'd: Tmodel [K]'][dstart:dend])
-    T21 = np.array(data['e: T21 [K]'][dstart:dend])
+    nu, weight, Tsky = data['Frequency'], data['Weight'], data['Tsky']
+    Tres1, Tres2, Tmodel, T21 = data['Tres1'], data['Tres2'], data['Tmodel'], data['T21']
     
     # EDGES error data (NOTE: Need to find out where we can obtain this!)
     # For now, cheat and use something sensible (the function is defined above)
@@ -98,79 +95,208 @@ def read_edges():
     return nu, weight, Tsky, Tres1, Tres2, Tmodel, T21, err
 
 
+####################################################
+################## BINARY CACHE ####################
+####################################################
+def _column_key(header):
+    """
+    Column name without its unit and panel letter, e.g. 'a: Tsky [K]' -> 'Tsky', 'H1: T21 [K]' -> 'H1: T21'.
+    """
+
+    key = header.split('[')[0].strip()
+    prefix, sep, rest = key.partition(':')
+    if sep and len(prefix) == 1 and prefix.islower():
+        key = rest.strip()
+
+    return key
+
+
+def _release_path(filename):
+    """
+    Path of a release CSV: file names are looked up in EDGES_DIR, paths are used as given.
+    """
+
+    return filename if os.path.dirname(filename) else os.path.join(EDGES_DIR, filename)
+
+
+def _sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _build_cache(path, npy, meta):
+    """
+    Parse the CSV at path and store it as a column-major .npy (so each column is contiguous) with
+    a JSON sidecar of the column names and the mtime, size and hash of the CSV.
+    """
+
+    with open(path) as f:
+        columns = [_column_key(h) for h in f.readline().split(',')]
+    table = np.asfortranarray(np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2))
+
+    st = os.stat(path)
+    info = {'source': os.path.abspath(path), 'columns': columns,
+            'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'sha256': _sha256(path)}
+
+    # Write to temporary files and rename, so other processes never read a partial cache
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    for target, write in ((npy, lambda f: np.save(f, table)),
+                          (meta, lambda f: f.write(json.dumps(info, indent=2).encode()))):
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp, target)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+
+def _cached_table(path):
+    """
+    (column names, read-only memory-mapped table) of the CSV at path, rebuilding the cache if the
+    CSV has changed. A changed mtime with an unchanged hash only refreshes the sidecar.
+    """
+
+    name = '{}_{}'.format(os.path.splitext(os.path.basename(path))[0],
+                          hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:8])
+    npy = os.path.join(CACHE_DIR, name + '.npy')
+    meta = os.path.join(CACHE_DIR, name + '.json')
+
+    st = os.stat(path)
+    try:
+        with open(meta) as f:
+            info = json.load(f)
+        valid = os.path.exists(npy) and info['size'] == st.st_size and (
+                info['mtime_ns'] == st.st_mtime_ns or info['sha256'] == _sha256(path))
+    except (OSError, ValueError, KeyError):
+        valid = False
+
+    try:
+        if not valid:
+            _build_cache(path, npy, meta)
+        elif info['mtime_ns'] != st.st_mtime_ns:
+            info['mtime_ns'] = st.st_mtime_ns
+            with open(meta, 'w') as f:
+                json.dump(info, f, indent=2)
+        with open(meta) as f:
+            columns = json.load(f)['columns']
+        table = np.load(npy, mmap_mode='r')
+    except OSError:
+        # Cache directory not writable: parse into memory instead
+        with open(path) as f:
+            columns = [_column_key(h) for h in f.readline().split(',')]
+        table = np.asfortranarray(np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2))
+        table.setflags(write=False)
+
+    return columns, table
+
+
+def load_release(filename=FIGURE1, start=None, stop=None, mask=None):
+    """
+    Columns of an EDGES data release CSV (e.g. FIGURE1, FIGURE2 or the path of a later release) as
+    a dict of read-only arrays keyed by column name without units (see _column_key).
+
+    The CSV is parsed once into a binary cache in CACHE_DIR and memory-mapped from there. Rows are
+    trimmed to [start:stop], then, if mask names a weight column, to the rows where it is non-zero.
+    Columns are zero-copy views of the cache unless the masked rows are not contiguous.
+    """
+
+    columns, table = _cached_table(_release_path(filename))
+    table = table[start:stop]
+
+    if mask is not None:
+        rows = np.flatnonzero(table[:, columns.index(mask)])
+        if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+            table = table[rows[0]:rows[-1] + 1]
+        else:
+            table = table[rows]
+            table.setflags(write=False)
+
+    return {key: np.asarray(table[:, i]) for i, key in enumerate(columns)}
+
+
 ####################################################
 ############## PLOT EDGES RESULTS ##################
 ####################################################
-# Directory and file name
-outdir = '{}/edges2018/reproduced'.format(BASE_DIR)
-label = 'edges2018_plot'
-bilby.utils.check_directory_exists_and_if_not_mkdir(outdir)
-
-# Read EDGES data and results
-nu, weight, Tsky, Tres1, Tres2, Tmodel, T21, err = read_edges()
-
-# RMS of EDGES residuals
-rms_Tres1 = round(np.sqrt(np.mean(Tres1**2)), 3)
-rms_Tres2 = round(np.sqrt(np.mean(Tres2**2)), 3)
-
-# Plot EDGES results to check it looks sensible and matches plots from "EDGES Data Releases – LoCo Lab"
-fig, ax = plt.subplots(nrows=3, ncols=2, figsize=(12,7))
-plt.subplots_adjust(left=None, bottom=None, right=None, top=None, wspace=0.1, hspace=0.3)
-
-# Subplot (a) - Tsky is the integrated sky spectrum used for the model fitting
-ax[0,0].plot(nu, Tsky, '-k', linewidth=1)      
-ax[0,0].set_title('a', loc='left', fontweight='bold', fontsize=12)
-ax[0,0].set_xticks([50,60,70,80,90,100])
-ax[0,0].set_xticklabels([])
-ax[0,0].set_yticks([1000, 3000, 5000])
-ax[0,0].set_yticklabels([1000, 3000, 5000], fontsize=10)
-# ax[0,0].set_xlabel(r'Frequency, $\nu$ [MHz]', fontsize=8)
-ax[0,0].set_ylabel(r'Temperature, $T$ [K]', fontsize=12)
-
-# Subplot (b) - Tres1 is the residuals to the best-fit foreground-only (5-term physical model)
-ax[1,0].plot(nu, Tres1, '-k', linewidth=1)      
-ax[1,0].set_title('b', loc='left', fontweight='bold', fontsize=12)
-ax[1,0].set_xticks([50,60,70,80,90,100])
-ax[1,0].set_xticklabels([])
-ax[1,0].set_yticks([-0.2, -0.1, 0, 0.1, 0.2])
-ax[1,0].set_yticklabels([-0.2, -0.1, 0, 0.1, 0.2], fontsize=10)
-# ax[1,0].set_xlabel(r'Frequency, $\nu$ [MHz]', fontsize=8)
-ax[1,0].set_ylabel(r'Temperature, $T$ [K]', fontsize=12)
-ax[1,0].text(0.2, 0.1, f'r.m.s. = {rms_Tres1} K', fontsize=12, horizontalalignment='center', verticalalignment='center', transform=ax[1,0].transAxes)
-
-# Subplot (c) - Tres2 is the residuals to the best-fit combined foreground and 21cm model
-ax[1,1].plot(nu, Tres2, '-k', linewidth=1)      
-ax[1,1].set_title('c', loc='left', fontweight='bold', fontsize=12)
-ax[1,1].set_xticks([50,60,70,80,90,100])
-ax[1,1].set_xticklabels([])
-ax[1,1].set_yticks([-0.2, -0.1, 0, 0.1, 0.2])
-ax[1,1].set_yticklabels([])
-# ax[1,1].set_xlabel(r'Frequency, $\nu$ [MHz]', fontsize=8)
-# ax[1,1].set_ylabel(r'Temperature, $T$ [K]', fontsize=8)
-ax[1,1].text(0.2, 0.1, f'r.m.s. = {rms_Tres2} K', fontsize=12, horizontalalignment='center', verticalalignment='center', transform=ax[1,1].transAxes)
-
-# Subplot (d) - Tmodel is the best-fit 21cm model
-ax[2,0].plot(nu, Tmodel, '-k', linewidth=1)     
-ax[2,0].set_title('d', loc='left', fontweight='bold', fontsize=12)
-ax[2,0].set_xticks([50,60,70,80,90,100])
-ax[2,0].set_xticklabels([50,60,70,80,90,100], fontsize=12)
-ax[2,0].set_yticks([-0.6, -0.4, -0.2, 0, 0.2])
-ax[2,0].set_yticklabels([-0.6, -0.4, -0.2, 0, 0.2], fontsize=10)
-ax[2,0].set_xlabel(r'Frequency, $\nu$ [MHz]', fontsize=12)
-ax[2,0].set_ylabel(r'Temperature, $T$ [K]', fontsize=12)
-
-# Subplot (e) - T21 is the combined Tmodel + Tres2
-ax[2,1].plot(nu, T21, '-k', linewidth=1)        
-ax[2,1].set_title('e', loc='left', fontweight='bold', fontsize=12)
-ax[2,1].set_xticks([50,60,70,80,90,100])
-ax[2,1].set_xticklabels([50,60,70,80,90,100], fontsize=10)
-ax[2,1].set_yticks([-0.6, -0.4, -0.2, 0, 0.2])
-ax[2,1].set_yticklabels([])
-ax[2,1].set_xlabel(r'Frequency, $\nu$ [MHz]', fontsize=12)
-# ax[2,1].set_ylabel(r'Temperature, $T$ [K]', fontsize=7)
-
-# Delete empty subplot (for the aesthetic)
-fig.delaxes(ax[0,1])    
-
-# Save the plot
-fig.savefig('{}/{}.png'.format(outdir, label), dpi=300, bbox_inches='tight')
\ No newline at end of file
+def plot_edges(outdir='{}/reproduced'.format(EDGES_DIR), label='edges2018_plot'):
+    """
+    Reproduce the plots of Bowman (2018) from the EDGES data release and save them to outdir.
+    """
+
+    import matplotlib.pyplot as plt
+
+    os.makedirs(outdir, exist_ok=True)
+
+    # Read EDGES data and results
+    nu, weight, Tsky, Tres1, Tres2, Tmodel, T21, err = read_edges()
+
+    # RMS of EDGES residuals
+    rms_Tres1 = round(np.sqrt(np.mean(Tres1**2)), 3)
+    rms_Tres2 = round(np.sqrt(np.mean(Tres2**2)), 3)
+
+    # Plot EDGES results to check it looks sensible and matches plots from "EDGES Data Releases – LoCo Lab"
+    fig, ax = plt.subplots(nrows=3, ncols=2, figsize=(12,7))
+    plt.subplots_adjust(left=None, bottom=None, right=None, top=None, wspace=0.1, hspace=0.3)
+
+    # Subplot (a) - Tsky is the integrated sky spectrum used for the model fitting
+    ax[0,0].plot(nu, Tsky, '-k', linewidth=1)      
+    ax[0,0].set_title('a', loc='left', fontweight='bold', fontsize=12)
+    ax[0,0].set_xticks([50,60,70,80,90,100])
+    ax[0,0].set_xticklabels([])
+    ax[0,0].set_yticks([1000, 3000, 5000])
+    ax[0,0].set_yticklabels([1000, 3000, 5000], fontsize=10)
+    # ax[0,0].set_xlabel(r'Frequency, $\nu$ [MHz]', fontsize=8)
+    ax[0,0].set_ylabel(r'Temperature, $T$ [K]', fontsize=12)
+
+    # Subplot (b) - Tres1 is the residuals to the best-fit foreground-only (5-term physical model)
+    ax[1,0].plot(nu, Tres1, '-k', linewidth=1)      
+    ax[1,0].set_title('b', loc='left', fontweight='bold', fontsize=12)
+    ax[1,0].set_xticks([50,60,70,80,90,100])
+    ax[1,0].set_xticklabels([])
+    ax[1,0].set_yticks([-0.2, -0.1, 0, 0.1, 0.2])
+    ax[1,0].set_yticklabels([-0.2, -0.1, 0, 0.1, 0.2], fontsize=10)
+    # ax[1,0].set_xlabel(r'Frequency, $\nu$ [MHz]', fontsize=8)
+    ax[1,0].set_ylabel(r'Temperature, $T$ [K]', fontsize=12)
+    ax[1,0].text(0.2, 0.1, f'r.m.s. = {rms_Tres1} K', fontsize=12, horizontalalignment='center', verticalalignment='center', transform=ax[1,0].transAxes)
+
+    # Subplot (c) - Tres2 is the residuals to the best-fit combined foreground and 21cm model
+    ax[1,1].plot(nu, Tres2, '-k', linewidth=1)      
+    ax[1,1].set_title('c', loc='left', fontweight='bold', fontsize=12)
+    ax[1,1].set_xticks([50,60,70,80,90,100])
+    ax[1,1].set_xticklabels([])
+    ax[1,1].set_yticks([-0.2, -0.1, 0, 0.1, 0.2])
+    ax[1,1].set_yticklabels([])
+    # ax[1,1].set_xlabel(r'Frequency, $\nu$ [MHz]', fontsize=8)
+    # ax[1,1].set_ylabel(r'Temperature, $T$ [K]', fontsize=8)
+    ax[1,1].text(0.2, 0.1, f'r.m.s. = {rms_Tres2} K', fontsize=12, horizontalalignment='center', verticalalignment='center', transform=ax[1,1].transAxes)
+
+    # Subplot (d) - Tmodel is the best-fit 21cm model
+    ax[2,0].plot(nu, Tmodel, '-k', linewidth=1)     
+    ax[2,0].set_title('d', loc='left', fontweight='bold', fontsize=12)
+    ax[2,0].set_xticks([50,60,70,80,90,100])
+    ax[2,0].set_xticklabels([50,60,70,80,90,100], fontsize=12)
+    ax[2,0].set_yticks([-0.6, -0.4, -0.2, 0, 0.2])
+    ax[2,0].set_yticklabels([-0.6, -0.4, -0.2, 0, 0.2], fontsize=10)
+    ax[2,0].set_xlabel(r'Frequency, $\nu$ [MHz]', fontsize=12)
+    ax[2,0].set_ylabel(r'Temperature, $T$ [K]', fontsize=12)
+
+    # Subplot (e) - T21 is the combined Tmodel + Tres2
+    ax[2,1].plot(nu, T21, '-k', linewidth=1)        
+    ax[2,1].set_title('e', loc='left', fontweight='bold', fontsize=12)
+    ax[2,1].set_xticks([50,60,70,80,90,100])
+    ax[2,1].set_xticklabels([50,60,70,80,90,100], fontsize=10)
+    ax[2,1].set_yticks([-0.6, -0.4, -0.2, 0, 0.2])
+    ax[2,1].set_yticklabels([])
+    ax[2,1].set_xlabel(r'Frequency, $\nu$ [MHz]', fontsize=12)
+    # ax[2,1].set_ylabel(r'Temperature, $T$ [K]', fontsize=7)
+
+    # Delete empty subplot (for the aesthetic)
+    fig.delaxes(ax[0,1])    
+
+    # Save the plot
+    fig.savefig('{}/{}.png'.format(outdir, label), dpi=300, bbox_inches='tight')
+
+
+if __name__ == '__main__':
+    plot_edges()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Opt-in instrumentation of sampling runs.
+
+Counts model and likelihood calls with per-call latency histograms and calls per second over
+time, and splits wall time and CPU time (including child processes) by phase of the run.
+The report is written as JSON next to the result, <outdir>/<label>_timing.json.
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import os
+import sys
+import json
+import math
+import time
+import functools
+from contextlib import contextmanager
+
+# Latency histogram: 4 log-spaced bins per decade from 100 ns to 100 s
+HIST_MIN = -7
+HIST_PER_DECADE = 4
+HIST_BINS = 9 * HIST_PER_DECADE
+
+
+####################################################
+##################### COUNTERS #####################
+####################################################
+class CallCounter:
+    """
+    Number of calls, latency histogram and calls per second of one function.
+    """
+
+    def __init__(self, name, t0):
+        self.name = name
+        self.t0 = t0                    # Start of the run (time.perf_counter)
+        self.calls = 0
+        self.total_time = 0.0
+        self.histogram = [0] * HIST_BINS
+        self.per_second = []            # Calls in each second since t0
+
+    def record(self, start, stop):
+        dt = stop - start
+        self.calls += 1
+        self.total_time += dt
+
+        b = int((math.log10(dt) - HIST_MIN) * HIST_PER_DECADE) if dt > 0 else 0
+        self.histogram[min(max(b, 0), HIST_BINS - 1)] += 1
+
+        second = int(stop - self.t0)
+        if second >= len(self.per_second):
+            self.per_second.extend([0] * (second + 1 - len(self.per_second)))
+        self.per_second[second] += 1
+
+    def report(self):
+        edges = [10**(HIST_MIN + i / HIST_PER_DECADE) for i in range(HIST_BINS + 1)]
+
+        return {'calls': self.calls,
+                'total_time': self.total_time,
+                'mean_time': self.total_time / self.calls if self.calls else None,
+                'latency_histogram': {'edges': edges, 'counts': self.histogram},
+                'calls_per_second': self.per_second}
+
+
+class _Timed:
+    """
+    Callable wrapper recording each call in a CallCounter (a class, so it can be pickled).
+    """
+
+    def __init__(self, func, counter):
+        self.func = func
+        self.counter = counter
+        self.__name__ = getattr(func, '__name__', counter.name)
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            self.counter.record(start, time.perf_counter())
+
+
+def restoring(module, attribute):
+    """
+    Decorator putting module.attribute back after each call of the function, for functions that replace it
+    with a counted wrapper (see Instrumentation.wrap) for the duration of a run.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def restored(*args, **kwargs):
+            original = getattr(module, attribute)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                setattr(module, attribute, original)
+        return restored
+
+    return decorator
+
+
+####################################################
+################## INSTRUMENTATION #################
+####################################################
+class Instrumentation:
+    """
+    Call counters and phase timings of one run. When disabled, every method is a no-op.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.t0 = time.perf_counter()
+        self.counters = {}
+        self.phases = {}
+        self.extra = {}                 # Further entries of the report (e.g. per-rank throughput under MPI)
+        self.pooled_calls = None        # Likelihood calls of a run with forked pool workers (see pooled)
+
+    def wrap(self, func, name):
+        """
+        func, counting its calls under name.
+        """
+
+        if not self.enabled:
+            return func
+        counter = self.counters.setdefault(name, CallCounter(name, self.t0))
+
+        return _Timed(func, counter)
+
+    def attach(self, likelihood):
+        """
+        Count the calls of a likelihood's log_likelihood and of the model it evaluates.
+        """
+
+        if not self.enabled:
+            return likelihood
+
+        likelihood.log_likelihood = self.wrap(likelihood.log_likelihood, 'likelihood')
+
+        # The model is stored as func (bilby Analytical1DLikelihood, private in recent versions), model or signal (likelihoods.py)
+        for attr in ('_func', '_Analytical1DLikelihood__func', 'func', 'model', 'signal'):
+            if attr in vars(likelihood):
+                setattr(likelihood, attr, self.wrap(getattr(likelihood, attr), 'model'))
+                break
+
+        return likelihood
+
+    def pooled(self, npool, likelihood_calls=None):
+        """
+        Mark the counters as covering this process only, for a run whose likelihood calls were spread over
+        npool forked workers (whose counts are lost). likelihood_calls, as counted by the sampler, is then
+        reported as the number of likelihood calls, and the model calls as unknown.
+        """
+
+        if not self.enabled:
+            return
+        self.extra['pool'] = dict(npool=npool, counters='parent process only')
+        self.pooled_calls = likelihood_calls
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Record the wall time and CPU time (own and of child processes) spent in the block.
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        wall, cpu = time.perf_counter(), os.times()
+        try:
+            yield
+        finally:
+            stop = os.times()
+            record = self.phases.setdefault(name, {'wall_time': 0.0, 'cpu_time': 0.0, 'children_cpu_time': 0.0})
+            record['wall_time'] += time.perf_counter() - wall
+            record['cpu_time'] += (stop.user - cpu.user) + (stop.system - cpu.system)
+            record['children_cpu_time'] += (stop.children_user - cpu.children_user) + (stop.children_system - cpu.children_system)
+
+    def report(self):
+        counters = {name: c.report() for name, c in self.counters.items()}
+        if 'pool' in self.extra:
+            for name, counter in counters.items():
+                counter['parent_calls'] = counter['calls']
+                counter['calls'] = self.pooled_calls if name == 'likelihood' else None
+                counter['scope'] = 'parent process only'
+
+        report = {'wall_time': time.perf_counter() - self.t0,
+                  'phases': self.phases,
+                  'counters': counters}
+        report.update(self.extra)
+
+        # Hit/miss statistics of the ARES cache, if it was used
+        if 'ares_cache' in sys.modules:
+            report['ares_cache'] = dict(sys.modules['ares_cache'].stats)
+
+        return report
+
+    def save(self, path):
+        if not self.enabled:
+            return
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
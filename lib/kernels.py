@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+Compiled kernels of the models, with the NumPy functions in models.py as the fallback.
+
+With numba installed, linearised_model, systematic_model and flattened_gaussian are evaluated by
+kernels that loop once over parameter points and channels, adding the signal and the foreground
+without temporaries, using the cached design matrices of the foregrounds. This removes most of the
+per-call overhead of the single points the samplers evaluate. Calls of more than MAX_VALUES points
+x channels still go to NumPy. The kernels are compiled on first use and cached on disk, so importing
+models.py does not import numba.
+
+The flattened Gaussian is written in a stable form (shared with models.flattened_gaussian):
+    B   = 4 (nu - nu0)^2 / w^2 * log(s),    s = -log((1 + e^-tau) / 2) / tau = (log 2 - log1p(e^-tau)) / tau
+    T21 = -A * expm1(-tau e^B) / expm1(-tau)
+with s = 1/2 - tau/8 + tau^3/192 for small tau and T21 = -A e^B (a Gaussian) at tau = 0, where the
+direct form divides 0 by 0.
+
+    python kernels.py       check the kernels against the direct formulas and time them
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import math
+import importlib.util
+import numpy as np
+
+# Backend ('auto' uses numba when it is installed, 'numpy' always uses the NumPy functions in models.py)
+backend = 'auto'
+
+MAX_VALUES = 4096                # Calls of more points x channels go to NumPy, whose vectorised exp/expm1 are faster per value
+TAU_SERIES = 1e-4               # Below this tau, s(tau) is evaluated from its series
+LOG2 = math.log(2.0)
+
+
+_have_numba = None
+
+def enabled():
+    """
+    True if the models are evaluated by the compiled kernels.
+    """
+
+    global _have_numba
+    if backend == 'numpy':
+        return False
+    if _have_numba is None:
+        _have_numba = importlib.util.find_spec('numba') is not None
+
+    return _have_numba
+
+
+def use(nu, p):
+    """
+    True if a model call on nu whose first parameter is p (a scalar or an array of shape (n_points,)) goes to the kernels.
+    """
+
+    return np.size(p) * np.size(nu) <= MAX_VALUES and enabled()
+
+
+####################################################
+############### FLATTENED GAUSSIAN #################
+####################################################
+def log_flattening(tau):
+    """
+    log(-log((1 + e^-tau) / 2) / tau) of the flattened Gaussian, finite down to tau = 0. Scalars or arrays.
+    """
+
+    if np.ndim(tau) == 0:
+        tau = float(tau)
+        s = 0.5 - tau / 8.0 + tau**3 / 192.0 if tau < TAU_SERIES else (LOG2 - math.log1p(math.exp(-tau))) / tau
+        return math.log(s)
+
+    small = tau < TAU_SERIES
+    t = np.where(small, 1.0, tau)
+    s = np.where(small, 0.5 - tau / 8.0 + tau**3 / 192.0, (LOG2 - np.log1p(np.exp(-t))) / t)
+
+    return np.log(s)
+
+
+def flattening_ratio(tau, eB):
+    """
+    (1 - exp(-tau e^B)) / (1 - e^-tau) as expm1(-tau e^B) / expm1(-tau), and e^B at tau = 0.
+    """
+
+    if np.ndim(tau) == 0:
+        return eB if tau == 0.0 else np.expm1(-tau * eB) / math.expm1(-tau)
+
+    zero = tau == 0.0
+    t = np.where(zero, 1.0, tau)
+    ratio = np.expm1(-t * eB) * (1.0 / np.expm1(-t))
+
+    return np.where(zero, eB, ratio) if np.any(zero) else ratio
+
+
+def log_flattening_derivative(tau):
+    """
+    d/dtau of log_flattening, s'/s with s' = (1 / (1 + e^tau) - s) / tau (-1/8 + tau^2/64 for small tau).
+    """
+
+    tau = np.asarray(tau, dtype=float)
+    small = tau < TAU_SERIES
+    t = np.where(small, 1.0, tau)
+    s = np.where(small, 0.5 - tau / 8.0 + tau**3 / 192.0, (LOG2 - np.log1p(np.exp(-t))) / t)
+    ds = np.where(small, -0.125 + tau**2 / 64.0, (np.exp(-t) / (1.0 + np.exp(-t)) - s) / t)
+
+    return ds / s
+
+
+def flattening_ratio_derivatives(tau, eB):
+    """
+    Derivatives of R = flattening_ratio(tau, e^B) with respect to B and tau (at fixed B), finite down to tau = 0.
+    Below TAU_SERIES, dR/dtau = e^B ((1 - e^B)/2 + 2 tau (1/12 - e^B/4 + e^2B/6) - tau^2 e^B (1 - e^B)^2 / 8).
+    """
+
+    tau = np.asarray(tau, dtype=float)
+    small = tau < TAU_SERIES
+    t = np.where(tau == 0.0, 1.0, tau)
+
+    q = np.where(tau == 0.0, 1.0, t / -np.expm1(-t))                    # tau / (1 - e^-tau)
+    dR_dB = eB * np.exp(-tau * eB) * q
+
+    denominator = -np.expm1(-t)
+    exact = (eB * np.exp(-t * eB) * denominator + np.expm1(-t * eB) * np.exp(-t)) / denominator**2
+    series = eB * ((1.0 - eB) / 2.0 + 2.0 * tau * (1.0 / 12.0 - eB / 4.0 + eB**2 / 6.0)
+                   - tau**2 * eB * (1.0 - eB)**2 / 8.0)
+    dR_dtau = np.where(small, series, exact)
+
+    return dR_dB, dR_dtau
+
+
+####################################################
+##################### KERNELS ######################
+####################################################
+# Plain Python, compiled with numba.njit by _compiled()
+def _flattened_gaussian_kernel(nu, points, out):
+    """
+    out[p, j] = flattened Gaussian of points[p] = (A, nu0, w, tau) at nu[j].
+    """
+
+    for p in range(points.shape[0]):
+        A, nu0, w, tau = points[p, 0], points[p, 1], points[p, 2], points[p, 3]
+        if tau < TAU_SERIES:
+            s = 0.5 - tau / 8.0 + tau**3 / 192.0
+        else:
+            s = (LOG2 - math.log1p(math.exp(-tau))) / tau
+        scale = 4.0 * math.log(s) / w**2
+        if tau == 0.0:
+            for j in range(nu.shape[0]):
+                out[p, j] = -A * math.exp(scale * (nu[j] - nu0)**2)
+        else:
+            c = -A / math.expm1(-tau)
+            for j in range(nu.shape[0]):
+                out[p, j] = c * math.expm1(-tau * math.exp(scale * (nu[j] - nu0)**2))
+
+
+def _linearised_kernel(nu, design, points, out):
+    """
+    out[p, j] = linearised model of points[p] = (A, nu0, w, tau, a0...a4): flattened Gaussian + design[j] . a.
+    """
+
+    m, k = design.shape
+    for p in range(points.shape[0]):
+        for j in range(m):
+            Tfg = 0.0
+            for i in range(k):
+                Tfg += points[p, 4 + i] * design[j, i]
+            out[p, j] = Tfg
+
+        A, nu0, w, tau = points[p, 0], points[p, 1], points[p, 2], points[p, 3]
+        if tau < TAU_SERIES:
+            s = 0.5 - tau / 8.0 + tau**3 / 192.0
+        else:
+            s = (LOG2 - math.log1p(math.exp(-tau))) / tau
+        scale = 4.0 * math.log(s) / w**2
+        if tau == 0.0:
+            for j in range(m):
+                out[p, j] -= A * math.exp(scale * (nu[j] - nu0)**2)
+        else:
+            c = -A / math.expm1(-tau)
+            for j in range(m):
+                out[p, j] += c * math.expm1(-tau * math.exp(scale * (nu[j] - nu0)**2))
+
+
+def _systematic_kernel(nu, design, points, out):
+    """
+    out[p, j] = systematic model of points[p] = (A, phi, l, a0...a5): sinusoid + design[j] . a.
+    """
+
+    m, k = design.shape
+    for p in range(points.shape[0]):
+        A, phi, l = points[p, 0], points[p, 1], points[p, 2]
+        for j in range(m):
+            Tfg = 0.0
+            for i in range(k):
+                Tfg += points[p, 3 + i] * design[j, i]
+            out[p, j] = A * math.sin(2.0 * math.pi * nu[j] / l + phi) + Tfg
+
+
+_jit = {}
+
+def _compiled(name):
+    """
+    numba-compiled kernel name (compiled on first use, cached in __pycache__).
+    """
+
+    if name not in _jit:
+        import numba
+        _jit[name] = numba.njit(cache=True)(globals()[name])
+
+    return _jit[name]
+
+
+####################################################
+###################### MODELS ######################
+####################################################
+def _points(params):
+    """
+    (points of shape (n_points, n_params), batched): scalar parameters give one point, arrays of shape (n_points,) n points.
+    """
+
+    try:
+        a = np.array(params, dtype=float)                       # (n_params,) or (n_params, n_points)
+    except ValueError:
+        a = np.array(np.broadcast_arrays(*params), dtype=float)         # Mixed scalars and arrays
+
+    if a.ndim == 1:
+        return a[np.newaxis, :], False
+
+    return np.ascontiguousarray(a.T), True
+
+
+def _evaluate(name, nu, params, *args):
+    nu = np.ascontiguousarray(nu, dtype=float)
+    points, batched = _points(params)
+    out = np.empty((len(points), len(nu)))
+    _compiled(name)(nu, *args, points, out)
+
+    return out if batched else out[0]
+
+
+def flattened_gaussian(nu, A, nu0, w, tau):
+    return _evaluate('_flattened_gaussian_kernel', nu, (A, nu0, w, tau))
+
+
+def linearised_model(nu, A, nu0, w, tau, a0, a1, a2, a3, a4, design):
+    """
+    Linearised model, with design the design matrix (n_channels, 5) of the linearised foreground on nu.
+    """
+
+    return _evaluate('_linearised_kernel', nu, (A, nu0, w, tau, a0, a1, a2, a3, a4), design)
+
+
+def systematic_model(nu, A, phi, l, a0, a1, a2, a3, a4, a5, design):
+    """
+    Systematic model, with design the design matrix (n_channels, 6) of the 5-term polynomial on nu.
+    """
+
+    return _evaluate('_systematic_kernel', nu, (A, phi, l, a0, a1, a2, a3, a4, a5), design)
+
+
+####################################################
+###################### CHECK #######################
+####################################################
+def _direct_flattened_gaussian(nu, A, nu0, w, tau):
+    """
+    The flattened Gaussian exactly as in Bowman (2018) equations (5) and (6), for checking.
+    """
+
+    A, nu0, w, tau = [np.asarray(p)[:, np.newaxis] for p in (A, nu0, w, tau)]
+    B = (4.0 * np.power((nu - nu0), 2.0) / np.power(w, 2.0)) * np.log(-np.log((1.0 + np.exp(-tau))/2.0) / tau)
+
+    return - A * (1.0 - np.exp(-tau * np.exp(B))) / (1.0 - np.exp(-tau))
+
+
+def check(n_points=10000, seed=0, tau_min=1e-3):
+    """
+    Largest differences of the stable and compiled models from the direct formulas, over n_points draws
+    from the priors (with extra points at tau <= 1e-2 and tau = 0). Differences are relative to |A| + |model|
+    and taken wherever the direct formulas are finite, and for the flattened Gaussian at tau >= tau_min, below
+    which the direct form itself loses precision (1 - exp(-tau e^B) cancels). Returns
+    {name: (largest difference, values compared, non-finite values of the new form)}.
+    """
+
+    import models
+
+    rng = np.random.default_rng(seed)
+    nu = np.linspace(50.0, 100.0, 123)
+    A, nu0, w = rng.uniform(0.0, 20.0, n_points), rng.uniform(60.0, 90.0, n_points), rng.uniform(1.0, 40.0, n_points)
+    tau = np.concatenate([rng.uniform(0.0, 100.0, n_points - 200), 10.0**rng.uniform(-12, -2, 190), np.zeros(10)])
+    a = [rng.uniform(-1e4, 1e4, n_points) for i in range(6)]
+    phi, l = rng.uniform(0.0, 2.0 * np.pi, n_points), rng.uniform(10.0, 20.0, n_points)
+
+    def worst(x, reference, where=True):
+        compare = np.isfinite(reference) & where
+        difference = np.abs(x - reference) / np.maximum(np.abs(A[:, np.newaxis]) + np.abs(reference), 1e-300)
+        return float(np.max(difference[compare])), int(np.sum(compare)), int(np.sum(~np.isfinite(x)))
+
+    current = models.kernels.backend
+    try:
+        models.kernels.backend = 'numpy'
+        with np.errstate(all='ignore'):
+            direct = _direct_flattened_gaussian(nu, A, nu0, w, tau) + 0.0 * nu
+        conditioned = (tau >= tau_min)[:, np.newaxis]
+        numpy_signal = models.flattened_gaussian(nu, A, nu0, w, tau)
+        numpy_systematic = models.systematic_model(nu, A, phi, l, *a)
+        report = {'numpy flattened_gaussian': worst(numpy_signal, direct, conditioned)}
+    finally:
+        models.kernels.backend = current
+
+    if enabled():
+        fg = models.LINEARISED_BASIS(nu, *a[:5])
+        linear, polynomial = models.LINEARISED_BASIS.design_matrix(nu), models.POLYNOMIAL_BASIS.design_matrix(nu)
+        report['compiled flattened_gaussian'] = worst(flattened_gaussian(nu, A, nu0, w, tau), direct, conditioned)
+        report['compiled vs numpy, all tau'] = worst(flattened_gaussian(nu, A, nu0, w, tau), numpy_signal)
+        report['compiled linearised_model'] = worst(linearised_model(nu, A, nu0, w, tau, *a[:5], linear), direct + fg, conditioned)
+        report['compiled systematic_model'] = worst(systematic_model(nu, A, phi, l, *a, polynomial), numpy_systematic)
+
+    return report
+
+
+if __name__ == '__main__':
+    import timeit
+    import models
+    import kernels              # The module models uses (this file runs as __main__)
+
+    print('Compiled kernels: {}'.format('numba' if enabled() else 'not available (numba is not installed)'))
+    for name, (difference, compared, non_finite) in kernels.check().items():
+        print('{:30} largest difference {:.1e} over {} values, {} non-finite'.format(name, difference, compared, non_finite))
+
+    nu = np.linspace(50.0, 100.0, 123)
+    theta = dict(A=0.553, nu0=78.31, w=18.74, tau=6.78, a0=-10111.419, a1=-5673.739, a2=-1831.621, a3=150.673, a4=11711.500)
+    batch = {k: np.full(16, v) for k, v in theta.items()}
+    for name in (['numpy', 'auto'] if enabled() else ['numpy']):
+        kernels.backend = name
+        for label, call in (('linearised_model, 1 point', lambda: models.linearised_model(nu, **theta)),
+                            ('linearised_model, 16 points', lambda: models.linearised_model(nu, **batch))):
+            t = min(timeit.repeat(call, number=100, repeat=5)) / 100
+            print('{:6} {:30} {:9.1f} us'.format('numba' if name == 'auto' else name, label, t * 1e6))
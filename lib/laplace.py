@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Fisher-matrix (Laplace) forecast of a model fit: the best fit within the priors, and a Gaussian
+approximation to the posterior around it, built from the analytic Jacobians in models.py.
+
+For the Jacobian J of the model at the best fit and errors err, F = J^T diag(1/err^2) J is the inverse
+covariance of the Gaussian approximation. With uniform priors of total volume V the evidence is
+    log Z = log L_max + (k/2) log(2 pi) - (1/2) log det F - log V + sum_i log P_i
+where P_i is the Gaussian mass of parameter i inside its prior range. This corrects for priors that
+cut into the Gaussian, and is exact for uncorrelated parameters. A 'sigma' parameter, which replaces
+err as in likelihoods.py, is set to the mode of its marginal posterior with the k other parameters
+integrated out, sqrt(chi2 / (n - k)), with Fisher information 2(n - k) / sigma^2.
+
+For the linearised and systematic models this takes well under a second. It is a first look before
+a nested-sampling run and a check of one (see compare). Models without an analytic Jacobian (ARES)
+fall back to central differences.
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import time
+import inspect
+import numpy as np
+from scipy.special import ndtr
+from scipy.optimize import least_squares
+
+import models
+
+# Random starting points of the fit drawn from the priors, besides the injection parameters
+STARTS = 8
+
+# Fraction of each prior range between the starting points and the prior bounds
+START_MARGIN = 1e-3
+
+# Gaussian mass of a parameter within its prior range below which the prior is taken to cut off likelihood mass
+CUT_OFF_MASS = 0.999
+
+
+####################################################
+##################### BEST FIT #####################
+####################################################
+def jacobian_function(model):
+    """
+    Jacobian of model, from models.JACOBIANS, else by central differences.
+    """
+
+    analytic = models.JACOBIANS.get(model)
+    if analytic is not None:
+        return analytic
+
+    return lambda nu, **params: models.numerical_jacobian(model, nu, params)
+
+
+def best_fit(model, nu, Tsky, whitening, bounds, start=None, starts=STARTS, seed=None):
+    """
+    Bounded least-squares fit of model to Tsky, with residuals multiplied by whitening (1/err), from start
+    (clipped into the bounds) and starts random points within bounds {key: (min, max)}.
+    Returns the best parameters (in the argument order of the model) and their chi^2.
+    """
+
+    keys = [k for k in list(inspect.signature(model).parameters)[1:] if k in bounds]
+    lower = np.array([bounds[k][0] for k in keys], dtype=float)
+    upper = np.array([bounds[k][1] for k in keys], dtype=float)
+    jacobian = jacobian_function(model)
+
+    def residual(x):
+        return (Tsky - model(nu, **dict(zip(keys, x)))) * whitening
+
+    def residual_jacobian(x):
+        return - jacobian(nu, **dict(zip(keys, x))) * whitening[:, np.newaxis]
+
+    margin = START_MARGIN * (upper - lower)
+    rng = np.random.default_rng(seed)
+    points = [] if start is None else [np.clip([start[k] for k in keys], lower + margin, upper - margin)]
+    points += list(rng.uniform(lower + margin, upper - margin, (starts, len(keys))))
+
+    best = None
+    for x0 in points:
+        fit = least_squares(residual, x0, jac=residual_jacobian, bounds=(lower, upper), x_scale='jac')
+        if best is None or fit.cost < best.cost:
+            best = fit
+
+    return dict(zip(keys, best.x.tolist())), 2.0 * best.cost
+
+
+####################################################
+##################### FORECAST #####################
+####################################################
+def _invert(F):
+    """
+    (covariance, log det F) of a Fisher matrix, inverted after scaling it to unit diagonal since the
+    foreground coefficients are constrained ~10^4 times less tightly than the signal parameters.
+    """
+
+    scale = 1.0 / np.sqrt(np.diag(F))
+    values, vectors = np.linalg.eigh(F * np.outer(scale, scale))
+    if values[0] <= 0.0:
+        raise np.linalg.LinAlgError('The Fisher matrix is singular: some combination of parameters is unconstrained')
+
+    covariance = (vectors / values) @ vectors.T * np.outer(scale, scale)
+    return covariance, np.sum(np.log(values)) - 2.0 * np.sum(np.log(scale))
+
+
+def forecast(model, nu, Tsky, err, bounds, weight=None, start=None, starts=STARTS, seed=None):
+    """
+    Best fit and Laplace approximation of the posterior of model for uniform priors bounds {key: (min, max)}
+    (which may include 'sigma'). Channels with zero weight are dropped, as in likelihoods.py. Returns
+    {parameters, best_fit, std, covariance, correlation, prior_mass, chi2, n_channels, log_likelihood_max,
+    log_evidence, log_evidence_untruncated, time}, with dicts keyed by parameter and matrices in the order of parameters.
+    """
+
+    begin = time.perf_counter()
+
+    mask = np.ones(len(nu), dtype=bool) if weight is None else np.asarray(weight) > 0
+    nu = np.asarray(nu, dtype=float)[mask]
+    Tsky = np.asarray(Tsky, dtype=float)[mask]
+    err = (err * np.ones(len(mask)))[mask]
+    n = len(nu)
+
+    noise = 'sigma' in bounds
+    whitening = np.ones(n) if noise else 1.0 / err
+    fit, chi2 = best_fit(model, nu, Tsky, whitening, {k: v for k, v in bounds.items() if k != 'sigma'}, start, starts, seed)
+    J = jacobian_function(model)(nu, **fit) * whitening[:, np.newaxis]
+
+    # sigma at the mode of its marginal posterior, with the k fitted parameters integrated out: chi2 / (n - k)
+    # (the maximum likelihood chi2 / n is biased low by the degrees of freedom the fit absorbs)
+    if noise:
+        dof = max(n - len(fit), 1)
+        sigma = float(np.clip(np.sqrt(chi2 / dof), max(bounds['sigma'][0], 1e-300), bounds['sigma'][1]))
+        F = np.zeros((len(fit) + 1, len(fit) + 1))
+        F[:-1, :-1] = J.T @ J / sigma**2
+        F[-1, -1] = 2.0 * dof / sigma**2
+        fit['sigma'] = sigma
+        log_l = - chi2 / sigma**2 / 2.0 - n * np.log(2.0 * np.pi * sigma**2) / 2.0
+    else:
+        F = J.T @ J
+        log_l = - chi2 / 2.0 - np.sum(np.log(2.0 * np.pi * np.power(err, 2.0))) / 2.0
+
+    keys = list(fit)
+    covariance, log_det = _invert(F)
+    std = np.sqrt(np.diag(covariance))
+    mean = np.array([fit[k] for k in keys])
+    lower, upper = np.array([bounds[k][0] for k in keys]), np.array([bounds[k][1] for k in keys])
+    mass = ndtr((upper - mean) / std) - ndtr((lower - mean) / std)
+
+    log_z = float(log_l + len(keys) / 2.0 * np.log(2.0 * np.pi) - log_det / 2.0 - np.sum(np.log(upper - lower)))
+
+    return {'parameters': keys,
+            'best_fit': fit,
+            'std': dict(zip(keys, std.tolist())),
+            'covariance': covariance.tolist(),
+            'correlation': (covariance / np.outer(std, std)).tolist(),
+            'prior_mass': dict(zip(keys, mass.tolist())),
+            'chi2': float(chi2),
+            'n_channels': n,
+            'log_likelihood_max': float(log_l),
+            'log_evidence': log_z + float(np.sum(np.log(mass))),
+            'log_evidence_untruncated': log_z,
+            'time': time.perf_counter() - begin}
+
+
+####################################################
+###################### PRIORS ######################
+####################################################
+def proposed_ranges(report, n_sigma):
+    """
+    Data-driven prior ranges {key: (min, max)}, the best fit +/- n_sigma forecast standard deviations.
+    """
+
+    return {k: (report['best_fit'][k] - n_sigma * report['std'][k], report['best_fit'][k] + n_sigma * report['std'][k])
+            for k in report['parameters']}
+
+
+def cut_off(report, bounds, mass=CUT_OFF_MASS):
+    """
+    Parameters whose prior range in bounds cuts off likelihood mass: the best fit is on a bound, or less
+    than mass of the Gaussian marginal lies within the range.
+    """
+
+    keys = []
+    for k in report['parameters']:
+        lower, upper = bounds[k]
+        edge = 1e-6 * (upper - lower)
+        x = report['best_fit'][k]
+        if report['prior_mass'][k] < mass or x - lower < edge or upper - x < edge:
+            keys.append(k)
+
+    return keys
+
+
+####################################################
+##################### COMPARE ######################
+####################################################
+def compare(report, posterior, log_evidence=None):
+    """
+    Check a sampled posterior (columns by parameter) against a forecast: for each parameter, the shift of
+    the posterior median from the best fit in forecast standard deviations and the ratio of the posterior
+    to the forecast standard deviation, and the difference of the log-evidences.
+    """
+
+    comparison = {'parameters': {}}
+    for k in report['parameters']:
+        if k not in posterior:
+            continue
+        x = np.asarray(posterior[k])
+        comparison['parameters'][k] = {'shift': (float(np.median(x)) - report['best_fit'][k]) / report['std'][k],
+                                       'width_ratio': float(np.std(x)) / report['std'][k]}
+    if log_evidence is not None:
+        comparison['log_evidence_difference'] = float(log_evidence) - report['log_evidence']
+
+    return comparison
+
+
+def print_forecast(report, comparison=None):
+    """
+    Table of the best fit and marginal widths (and, given a comparison, how a sampled posterior differs).
+    """
+
+    header = '{:8} {:>14} {:>12} {:>12}'.format('', 'best fit', 'std', 'prior mass')
+    if comparison:
+        header += ' {:>12} {:>12}'.format('run shift', 'run width')
+    print(header)
+    for k in report['parameters']:
+        row = '{:8} {:>14.6g} {:>12.4g} {:>12.3f}'.format(k, report['best_fit'][k], report['std'][k], report['prior_mass'][k])
+        if comparison and k in comparison['parameters']:
+            row += ' {:>10.2f} s {:>11.2f}x'.format(comparison['parameters'][k]['shift'], comparison['parameters'][k]['width_ratio'])
+        print(row)
+
+    print('chi^2 = {:.2f} over {} channels, log L_max = {:.3f}'.format(report['chi2'], report['n_channels'], report['log_likelihood_max']))
+    print('Laplace log Z = {:.3f} ({:.3f} without the prior truncation), in {:.3f} s'.format(
+        report['log_evidence'], report['log_evidence_untruncated'], report['time']))
+    if comparison and 'log_evidence_difference' in comparison:
+        print('Sampled log Z - Laplace log Z = {:.3f}'.format(comparison['log_evidence_difference']))
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+Likelihoods for fitting the 21 cm signal models to sky spectra.
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import bilby
+import numpy as np
+from operator import itemgetter
+from scipy.linalg import solve_triangular
+
+
+####################################################
+################## LIKELIHOODS #####################
+####################################################
+# Batched Gaussian Likelihood
+def batch_log_likelihood(model, nu, Tsky, err, **params):
+    """
+    Gaussian log-likelihood of the same form as bilby.likelihood.GaussianLikelihood,
+    evaluated for a whole batch of parameter points in one pass.
+
+    Each parameter may be a scalar or an array of shape (n_points,), in which case the
+    model must return a (n_points, n_channels) block (see models.py) and the result has
+    shape (n_points,). As in bilby, a 'sigma' parameter replaces the errors err.
+    """
+
+    if 'sigma' in params:
+        sigma = np.asarray(params.pop('sigma'))[..., np.newaxis]
+    else:
+        sigma = err
+
+    residual = Tsky - model(nu, **params)
+    log_l = np.sum(- (residual / sigma)**2 / 2.0 - np.log(2.0 * np.pi * sigma**2) / 2.0, axis=-1)
+
+    return log_l
+
+
+# Gaussian Likelihood of a Sky Spectrum
+class SpectrumLikelihood(bilby.Likelihood):
+    """
+    Gaussian likelihood of a sky spectrum, equal to bilby.likelihood.GaussianLikelihood on the
+    channels with non-zero weight but cheaper per call.
+
+    The inverse variances and the log-normalisation are precomputed for the errors err and the
+    model is called with positional arguments. A 'sigma' parameter replaces err as in bilby, in
+    which case only the n log(2 pi sigma^2) / 2 normalisation is recomputed.
+    Parameters may be arrays of shape (n_points,) for models that return a (n_points, n_channels) block.
+    """
+
+    def __init__(self, nu, Tsky, model, err, weight=None):
+        """
+        weight is the EDGES weight column (0 or 1 per channel): channels with zero weight are dropped.
+        """
+
+        mask = np.ones(len(nu), dtype=bool) if weight is None else np.asarray(weight) > 0
+
+        self.nu = np.asarray(nu, dtype=float)[mask]
+        self.Tsky = np.asarray(Tsky, dtype=float)[mask]
+        self.err = (err * np.ones(len(nu)))[mask]
+        self.n = len(self.nu)
+
+        self.model = model
+        self.model_keys = bilby.core.utils.infer_parameters_from_function(model)
+        self._model_args = itemgetter(*self.model_keys)
+
+        self._inv_var = 1.0 / np.power(self.err, 2.0)
+        self._log_norm = - np.sum(np.log(2.0 * np.pi * np.power(self.err, 2.0))) / 2.0
+
+        super(SpectrumLikelihood, self).__init__(parameters=dict.fromkeys(self.model_keys))
+
+    def residual(self, parameters):
+        args = self._model_args(parameters)
+        if len(self.model_keys) == 1:
+            args = (args,)
+
+        return self.Tsky - self.model(self.nu, *args)
+
+    def log_likelihood(self, parameters=None):
+        if parameters is None:
+            parameters = self.parameters
+
+        r2 = np.power(self.residual(parameters), 2.0)
+
+        if 'sigma' in parameters:
+            sigma2 = np.power(parameters['sigma'], 2.0)
+            return - np.sum(r2, axis=-1) / sigma2 / 2.0 - self.n * np.log(2.0 * np.pi * sigma2) / 2.0
+
+        return - (r2 @ self._inv_var) / 2.0 + self._log_norm
+
+
+# Gaussian Likelihood of a Sky Spectrum with Correlated Noise
+class CorrelatedNoiseLikelihood(SpectrumLikelihood):
+    """
+    Gaussian likelihood of a sky spectrum whose channel noise is correlated, with covariance one of the
+    classes of covariance.py (dense, banded, Toeplitz or low-rank plus diagonal):
+        log L = - chi2(r) / 2 - log det C / 2 - n log(2 pi) / 2
+    Each covariance is factorised once, so a call costs a chi^2 of O(n) to O(n log n) for the structured
+    covariances, and stays fast for grids of 10^4 - 10^5 channels. A 'sigma' parameter scales the
+    covariance, C = sigma^2 C0, as it replaces the errors of SpectrumLikelihood.
+    Parameters may be arrays of shape (n_points,) for models that return a (n_points, n_channels) block.
+    """
+
+    def __init__(self, nu, Tsky, model, covariance, weight=None):
+        """
+        covariance is of the channels with non-zero weight, which are the ones kept as in SpectrumLikelihood.
+        """
+
+        super(CorrelatedNoiseLikelihood, self).__init__(nu, Tsky, model, 1.0, weight=weight)
+        if covariance.n != self.n:
+            raise ValueError('The covariance is of {} channels and the data have {}'.format(covariance.n, self.n))
+
+        self.covariance = covariance
+        self._log_norm = - (self.n * np.log(2.0 * np.pi) + covariance.log_det) / 2.0
+
+    def log_likelihood(self, parameters=None):
+        if parameters is None:
+            parameters = self.parameters
+
+        chi2 = self.covariance.chi2(self.residual(parameters))
+
+        if 'sigma' in parameters:
+            sigma2 = np.power(parameters['sigma'], 2.0)
+            return - chi2 / sigma2 / 2.0 + self._log_norm - self.n * np.log(sigma2) / 2.0
+
+        return - chi2 / 2.0 + self._log_norm
+
+
+# Gaussian Likelihood with Marginalised Linear Foreground
+class MarginalisedForegroundLikelihood(bilby.Likelihood):
+    """
+    Gaussian likelihood with the linear foreground coefficients marginalised analytically,
+    so that only the parameters of the 21 cm signal are sampled.
+
+    For the residual r = Tsky - T21, design matrix D of the foreground basis and weights
+    W = diag(1/sigma^2), the coefficients have the generalised least-squares solution
+    a = F^-1 D^T W r with F = D^T W D. Integrating the Gaussian over a with a uniform prior of
+    volume V (large enough to contain the likelihood mass) gives
+        log L = log L(a) + (k/2) log(2 pi) - (1/2) log det F - log V
+    so the evidence is comparable with a run that samples the coefficients.
+    The least-squares problem is solved with a QR factorisation of the whitened design matrix,
+    since the foreground is ~10^4 times larger than the errors.
+    """
+
+    def __init__(self, nu, Tsky, signal, basis, err, foreground_keys=None, prior_volume=1.0, weight=None):
+        """
+        signal is a 21 cm model such as models.flattened_gaussian and basis a models.ForegroundBasis.
+        prior_volume is the product of the widths of the uniform priors on the coefficients.
+        Channels with zero weight are dropped, as in SpectrumLikelihood.
+        """
+
+        mask = np.ones(len(nu), dtype=bool) if weight is None else np.asarray(weight) > 0
+
+        self.nu = np.asarray(nu, dtype=float)[mask]
+        self.Tsky = np.asarray(Tsky, dtype=float)[mask]
+        self.signal = signal
+        self.signal_keys = bilby.core.utils.infer_parameters_from_function(signal)
+        self.err = (err * np.ones(len(nu)))[mask]
+        self.prior_volume = prior_volume
+
+        self.D = basis.design_matrix(self.nu)
+        self.k = self.D.shape[1]
+        self.foreground_keys = foreground_keys or ['a{}'.format(i) for i in range(self.k)]
+
+        # Precompute the least-squares system for the errors err, and for unit errors (used with 'sigma')
+        self._err_system = self._system(1.0 / self.err)
+        self._unit_system = self._system(np.ones(len(self.nu)))
+        self._log_norm = - np.sum(np.log(2.0 * np.pi * np.power(self.err, 2.0))) / 2.0
+
+        super(MarginalisedForegroundLikelihood, self).__init__(parameters=dict())
+
+    def _system(self, whitening):
+        """
+        (whitening, Q, R, log det F) for the whitened design matrix diag(whitening) D = Q R.
+        """
+
+        Q, R = np.linalg.qr(self.D * whitening[:, np.newaxis])
+        log_det = 2.0 * np.sum(np.log(np.abs(np.diag(R))))
+
+        return whitening, Q, R, log_det
+
+    def _solve(self, parameters):
+        """
+        Whitened chi^2 at the best-fit coefficients, projected data c = Q^T r, the system used and
+        the noise scale (sigma, or 1 when the errors err are used).
+        Signal parameters may be arrays of shape (n_points,).
+        """
+
+        r = self.Tsky - self.signal(self.nu, **{key: parameters[key] for key in self.signal_keys})
+
+        if 'sigma' in parameters:
+            system = self._unit_system
+            sigma = np.asarray(parameters['sigma'], dtype=float)
+        else:
+            system = self._err_system
+            sigma = 1.0
+
+        whitening, Q, R, log_det = system
+        r = r * whitening
+        c = r @ Q
+        chi2 = np.sum(np.power(r - c @ Q.T, 2.0), axis=-1) / np.power(sigma, 2.0)
+
+        return chi2, c, system, sigma
+
+    def log_likelihood(self, parameters=None):
+        """
+        Marginal log-likelihood of the signal parameters. Also accepts batches of parameter arrays.
+        """
+
+        if parameters is None:
+            parameters = self.parameters
+
+        chi2, c, system, sigma = self._solve(parameters)
+
+        if 'sigma' in parameters:
+            log_norm = - len(self.nu) * np.log(2.0 * np.pi * np.power(sigma, 2.0)) / 2.0
+            log_det = system[3] - 2.0 * self.k * np.log(sigma)
+        else:
+            log_norm = self._log_norm
+            log_det = system[3]
+
+        log_l = - chi2 / 2.0 + log_norm + self.k * np.log(2.0 * np.pi) / 2.0 - log_det / 2.0 - np.log(self.prior_volume)
+
+        return log_l
+
+    def sample_foreground(self, posterior, rng=None):
+        """
+        Recover the foreground coefficients for posterior samples of the signal parameters.
+        Each coefficient vector is drawn from its conditional Gaussian N(F^-1 D^T W r, F^-1).
+        Returns a dict of arrays keyed by foreground_keys.
+        """
+
+        rng = np.random.default_rng(rng)
+        parameters = {key: np.asarray(posterior[key], dtype=float) for key in self.signal_keys}
+        if 'sigma' in posterior:
+            parameters['sigma'] = np.asarray(posterior['sigma'], dtype=float)
+
+        chi2, c, system, sigma = self._solve(parameters)
+        R = system[2]
+
+        # F = R^T R / sigma^2, so a = R^-1 (c + sigma e) with e ~ N(0, 1)
+        e = rng.standard_normal(c.shape) * np.asarray(sigma)[..., np.newaxis]
+        a = solve_triangular(R, (c + e).T).T
+
+        return {key: a[..., i] for i, key in enumerate(self.foreground_keys)}
+
+
+####################################################
+################# JOINT LIKELIHOODS ################
+####################################################
+def spectrum_key(key, i):
+    """
+    Name of foreground parameter key of spectrum i in a joint fit, e.g. 'a0_3'.
+    """
+
+    return '{}_{}'.format(key, i)
+
+
+def stack_spectra(nu, Tsky, err, weight=None):
+    """
+    Spectra on a shared frequency grid nu as arrays of shape (n_spectra, n_channels): Tsky, err (a scalar or
+    broadcastable to Tsky) and the 0/1 mask of channels with non-zero weight in each spectrum (weight is None,
+    per channel, or per spectrum and channel). Channels with zero weight in every spectrum are dropped.
+    """
+
+    Tsky = np.atleast_2d(np.asarray(Tsky, dtype=float))
+    valid = np.ones(Tsky.shape, dtype=bool) if weight is None else np.broadcast_to(np.asarray(weight) > 0, Tsky.shape)
+    keep = valid.any(axis=0)
+    err = np.broadcast_to(np.asarray(err, dtype=float), Tsky.shape)
+
+    return np.asarray(nu, dtype=float)[keep], Tsky[:, keep], err[:, keep], valid[:, keep].astype(float)
+
+
+# Gaussian Likelihood of Spectra with a Shared Signal
+class JointSpectrumLikelihood(bilby.Likelihood):
+    """
+    Gaussian likelihood of n_spectra spectra on a shared frequency grid (time bins, antennas or releases)
+    with a shared 21 cm signal and a linear foreground per spectrum, whose coefficients are the parameters
+    spectrum_key(key, i) for each foreground key and spectrum i.
+
+    The foregrounds of all spectra are one product of the (n_spectra, n_terms) coefficients with the design
+    matrix, so a call costs about as much as for a single spectrum of n_spectra times as many channels.
+    Channels with zero weight in a spectrum are left out of its likelihood. A 'sigma' parameter replaces
+    err as in SpectrumLikelihood. Signal parameters and coefficients may be arrays of shape (n_points,).
+    """
+
+    def __init__(self, nu, Tsky, signal, basis, err, foreground_keys=None, weight=None):
+        """
+        Tsky is (n_spectra, n_channels) on the frequencies nu, and err and weight are as in stack_spectra.
+        signal is a 21 cm model such as models.flattened_gaussian and basis a models.ForegroundBasis.
+        """
+
+        self.nu, self.Tsky, self.err, self.mask = stack_spectra(nu, Tsky, err, weight)
+        self.n_spectra = len(self.Tsky)
+        self.signal = signal
+        self.signal_keys = bilby.core.utils.infer_parameters_from_function(signal)
+
+        self.D = basis.design_matrix(self.nu)
+        self.k = self.D.shape[1]
+        self.foreground_keys = foreground_keys or ['a{}'.format(i) for i in range(self.k)]
+        self.spectrum_keys = [spectrum_key(key, i) for i in range(self.n_spectra) for key in self.foreground_keys]
+        self._coefficients = itemgetter(*self.spectrum_keys)
+
+        valid = self.mask > 0
+        self._inv_var = np.where(valid, 1.0 / np.where(valid, self.err, 1.0)**2, 0.0)
+        self._log_norm = - np.sum(np.where(valid, np.log(2.0 * np.pi * np.where(valid, self.err, 1.0)**2), 0.0)) / 2.0
+        self.n = int(np.sum(valid))
+
+        super(JointSpectrumLikelihood, self).__init__(parameters=dict.fromkeys(self.signal_keys + self.spectrum_keys))
+
+    def foreground(self, parameters):
+        """
+        Foregrounds of all spectra, (n_spectra, n_channels) or (n_points, n_spectra, n_channels).
+        """
+
+        coeffs = self._coefficients(parameters)
+        try:
+            a = np.array(coeffs, dtype=float)                           # (n_spectra * n_terms,) or (..., n_points)
+        except ValueError:
+            a = np.array(np.broadcast_arrays(*coeffs), dtype=float)     # Mixed scalars and arrays
+        a = a.reshape((self.n_spectra, self.k) + a.shape[1:])
+        if a.ndim == 3:
+            a = np.moveaxis(a, -1, 0)
+
+        return a @ self.D.T
+
+    def residual(self, parameters):
+        T21 = self.signal(self.nu, **{key: parameters[key] for key in self.signal_keys})
+
+        return self.Tsky - np.asarray(T21)[..., np.newaxis, :] - self.foreground(parameters)
+
+    def log_likelihood(self, parameters=None):
+        if parameters is None:
+            parameters = self.parameters
+
+        r2 = np.power(self.residual(parameters), 2.0)
+
+        if 'sigma' in parameters:
+            sigma2 = np.power(parameters['sigma'], 2.0)
+            return - np.sum(r2 * self.mask, axis=(-2, -1)) / sigma2 / 2.0 - self.n * np.log(2.0 * np.pi * sigma2) / 2.0
+
+        return - np.sum(r2 * self._inv_var, axis=(-2, -1)) / 2.0 + self._log_norm
+
+
+# Gaussian Likelihood of Spectra with a Shared Signal and Marginalised Foregrounds
+class JointMarginalisedLikelihood(bilby.Likelihood):
+    """
+    JointSpectrumLikelihood with the foreground coefficients of every spectrum marginalised analytically
+    as in MarginalisedForegroundLikelihood, so only the shared signal parameters are sampled however many
+    spectra are fitted.
+
+    The whitened design matrices of all spectra are factorised once in a batched QR decomposition (one per
+    spectrum, as their weights and errors may differ), and each call projects all residuals at once.
+    The log-likelihood is the sum over spectra of the marginal log-likelihood of each, with prior_volume
+    the volume of the coefficient priors of one spectrum.
+    """
+
+    def __init__(self, nu, Tsky, signal, basis, err, foreground_keys=None, prior_volume=1.0, weight=None):
+        """
+        Tsky is (n_spectra, n_channels) on the frequencies nu, and err and weight are as in stack_spectra.
+        Each spectrum needs at least as many channels with non-zero weight as the basis has terms.
+        """
+
+        self.nu, self.Tsky, self.err, self.mask = stack_spectra(nu, Tsky, err, weight)
+        self.n_spectra = len(self.Tsky)
+        self.signal = signal
+        self.signal_keys = bilby.core.utils.infer_parameters_from_function(signal)
+        self.prior_volume = prior_volume
+
+        self.D = basis.design_matrix(self.nu)
+        self.k = self.D.shape[1]
+        self.foreground_keys = foreground_keys or ['a{}'.format(i) for i in range(self.k)]
+
+        valid = self.mask > 0
+        self._err_system = self._system(np.where(valid, 1.0 / np.where(valid, self.err, 1.0), 0.0))
+        self._unit_system = self._system(self.mask)
+        self._log_norm = - np.sum(np.where(valid, np.log(2.0 * np.pi * np.where(valid, self.err, 1.0)**2), 0.0)) / 2.0
+        self.n = int(np.sum(valid))
+
+        super(JointMarginalisedLikelihood, self).__init__(parameters=dict())
+
+    def _system(self, whitening):
+        """
+        (whitening, Q, R, log det F) for the whitened design matrices diag(whitening_i) D = Q_i R_i of all
+        spectra, with Q (n_spectra, n_channels, n_terms), R (n_spectra, n_terms, n_terms) and log det F
+        summed over spectra.
+        """
+
+        Q, R = np.linalg.qr(self.D[np.newaxis] * whitening[..., np.newaxis])
+        log_det = 2.0 * np.sum(np.log(np.abs(np.diagonal(R, axis1=-2, axis2=-1))))
+
+        return whitening, Q, R, log_det
+
+    def _solve(self, parameters):
+        """
+        Whitened chi^2 summed over spectra at the best-fit coefficients, projected data c_i = Q_i^T r_i of shape
+        (..., n_spectra, n_terms), the system used and the noise scale, as in MarginalisedForegroundLikelihood.
+        """
+
+        T21 = self.signal(self.nu, **{key: parameters[key] for key in self.signal_keys})
+        r = self.Tsky - np.asarray(T21)[..., np.newaxis, :]
+
+        if 'sigma' in parameters:
+            system = self._unit_system
+            sigma = np.asarray(parameters['sigma'], dtype=float)
+        else:
+            system = self._err_system
+            sigma = 1.0
+
+        whitening, Q, R, log_det = system
+        r = r * whitening
+        c = (r[..., np.newaxis, :] @ Q)[..., 0, :]
+        projection = (c[..., np.newaxis, :] @ np.swapaxes(Q, -1, -2))[..., 0, :]
+        chi2 = np.sum(np.power(r - projection, 2.0), axis=(-2, -1)) / np.power(sigma, 2.0)
+
+        return chi2, c, system, sigma
+
+    def log_likelihood(self, parameters=None):
+        """
+        Marginal log-likelihood of the shared signal parameters. Also accepts batches of parameter arrays.
+        """
+
+        if parameters is None:
+            parameters = self.parameters
+
+        chi2, c, system, sigma = self._solve(parameters)
+        n_coeffs = self.n_spectra * self.k
+
+        if 'sigma' in parameters:
+            log_norm = - self.n * np.log(2.0 * np.pi * np.power(sigma, 2.0)) / 2.0
+            log_det = system[3] - 2.0 * n_coeffs * np.log(sigma)
+        else:
+            log_norm = self._log_norm
+            log_det = system[3]
+
+        log_l = (- chi2 / 2.0 + log_norm + n_coeffs * np.log(2.0 * np.pi) / 2.0 - log_det / 2.0
+                 - self.n_spectra * np.log(self.prior_volume))
+
+        return log_l
+
+    def sample_foreground(self, posterior, rng=None):
+        """
+        Recover the foreground coefficients of every spectrum for posterior samples of the signal parameters,
+        as in MarginalisedForegroundLikelihood. Returns a dict of arrays keyed by spectrum_key(key, i).
+        """
+
+        rng = np.random.default_rng(rng)
+        parameters = {key: np.asarray(posterior[key], dtype=float) for key in self.signal_keys}
+        if 'sigma' in posterior:
+            parameters['sigma'] = np.asarray(posterior['sigma'], dtype=float)
+
+        chi2, c, system, sigma = self._solve(parameters)
+        R = system[2]
+
+        # a_i = R_i^-1 (c_i + sigma e_i) with e_i ~ N(0, 1), for all spectra at once
+        e = rng.standard_normal(c.shape) * np.asarray(sigma)[..., np.newaxis, np.newaxis]
+        a = np.linalg.solve(R, (c + e)[..., np.newaxis])[..., 0]
+
+        return {spectrum_key(key, i): a[..., i, j] for i in range(self.n_spectra) for j, key in enumerate(self.foreground_keys)}
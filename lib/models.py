@@ -3,6 +3,11 @@
 Different 21 cm signal and foreground models.
 Each function defines a different model.
 
+Every model accepts either scalar parameters, returning a spectrum of shape (n_channels,),
+or parameter arrays of shape (n_points,), returning a block of shape (n_points, n_channels).
+When numba is installed, flattened_gaussian, linearised_model and systematic_model evaluate single
+points and small batches with the compiled kernels in kernels.py (kernels.backend = 'numpy' turns them off).
+
 Code built upon work by: Dr Jonathan R. Pritchard, Researcher in Cosmology and Astrostatistics at Imperial College London
 Contact: j.pritchard@imperial.ac.uk
 
@@ -17,12 +22,86 @@ Contact: yi.lim17@imperial.ac.uk
 #################### LIBRARIES #####################
 ####################################################
 import numpy as np
+from collections import OrderedDict
+
+import kernels                  # Compiled kernels (numba) of the combined models and the flattened Gaussian
 
 
 ####################################################
 ##################### MODELS #######################
 ####################################################
-model_call_counter = 0
+# Batched parameters
+def _batch(*params):
+    """
+    Reshape parameter sequences of shape (n_points,) (arrays or lists) to (n_points, 1) so they broadcast
+    against nu. Scalars (and arrays that are already column vectors) are passed through as arrays.
+    """
+    return [p[:, np.newaxis] if p.ndim == 1 else p for p in map(np.asarray, params)]
+
+# Linear Foreground Basis
+class ForegroundBasis:
+    """
+    Foreground that is linear in its coefficients, Tfg = sum_i a_i * f_i(nu / nuc).
+
+    The design matrix of shape (n_channels, n_terms) is built once per frequency grid and
+    kept in a small least-recently-used cache, so evaluating the foreground is a single
+    matrix product per call.
+    """
+
+    def __init__(self, terms, nuc=75.0, maxsize=8):
+        self.terms = terms              # Function of x = nu / nuc returning the list of basis terms
+        self.nuc = nuc                  # Foreground central frequency
+        self.maxsize = maxsize          # Number of frequency grids kept in the cache
+        self._cache = OrderedDict()
+
+    def design_matrix(self, nu):
+        """
+        Design matrix (n_channels, n_terms) for the frequency grid nu. Read-only, as it is shared.
+        """
+
+        nu = np.asarray(nu, dtype=float)
+        key = (nu.shape, nu.tobytes())
+
+        D = self._cache.get(key)
+        if D is None:
+            D = np.stack(self.terms(nu / self.nuc), axis=-1)
+            D.setflags(write=False)
+            self._cache[key] = D
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+
+        return D
+
+    def __call__(self, nu, *coeffs):
+        """
+        Foreground of shape (n_channels,) for scalar coefficients,
+        or (n_points, n_channels) for coefficient arrays of shape (n_points,).
+        """
+
+        D = self.design_matrix(nu)
+
+        try:
+            a = np.array(coeffs, dtype=float)                   # (n_terms,) or (n_terms, n_points)
+        except ValueError:
+            a = np.array(np.broadcast_arrays(*coeffs), dtype=float)     # Mixed scalars and arrays
+
+        if a.ndim == 1:
+            return D @ a
+
+        return (D @ a.reshape(len(coeffs), -1)).T
+
+    def jacobian(self, nu, *coeffs):
+        """
+        Derivatives with respect to the coefficients, the design matrix: (n_channels, n_terms) for scalar
+        coefficients, or (n_points, n_channels, n_terms) for coefficient arrays of shape (n_points,).
+        """
+
+        D = self.design_matrix(nu)
+        n_points = max(np.size(c) if np.ndim(c) else 0 for c in coeffs)
+
+        return np.broadcast_to(D, (n_points,) + D.shape) if n_points else D
 
 ########################################################################
 # BOWMAN (2018) - Linearised Foreground with Flattened Gaussian Signal #
@@ -33,10 +112,16 @@ def flattened_gaussian(nu, A, nu0, w, tau):
     Flattened Gaussian.
     As in Bowman (2018) equations (5) and (6).
     As in Hills (2018) equations (2) and (3).
+    Written with log1p/expm1 so that it stays finite as tau -> 0, where it becomes a Gaussian.
     """
 
-    B = (4.0 * np.power((nu - nu0), 2.0) / np.power(w, 2.0)) * np.log(-np.log((1.0 + np.exp(-tau))/2.0) / tau)
-    T21 = - A * (1.0 - np.exp(-tau * np.exp(B))) / (1.0 - np.exp(-tau))
+    if kernels.use(nu, A):
+        return kernels.flattened_gaussian(nu, A, nu0, w, tau)
+
+    A, nu0, w, tau = _batch(A, nu0, w, tau)
+
+    B = (4.0 * np.power((nu - nu0), 2.0) / np.power(w, 2.0)) * kernels.log_flattening(tau)
+    T21 = - A * kernels.flattening_ratio(tau, np.exp(B))
 
     return T21
 
@@ -48,16 +133,19 @@ def linearised_foreground(nu, a0, a1, a2, a3, a4):
     As in Hills (2018) equation (8).
     """
 
-    nuc = 75.0          # Foreground central frequency as specified in paper
-    x = nu / nuc        # Normalised frequency terms
+    return LINEARISED_BASIS(nu, a0, a1, a2, a3, a4)
+
+def _linearised_terms(x):
+    """
+    Basis terms of the linearised foreground, in the order a0...a4.
+    """
+
+    logx = np.log(x)
+    x25 = np.power(x, -2.5)
 
-    Tfg = a0 * np.power(x, -2.5)
-    Tfg += a1 * np.power(x, -2.5) * np.log(x)
-    Tfg += a2 * np.power(x, -2.5) * np.power(np.log(x), 2.0)
-    Tfg += a3 * np.power(x, -4.5)
-    Tfg += a4 * np.power(x, -2.0)
+    return [x25, x25 * logx, x25 * np.power(logx, 2.0), np.power(x, -4.5), np.power(x, -2.0)]
 
-    return Tfg
+LINEARISED_BASIS = ForegroundBasis(_linearised_terms, nuc=75.0)     # Central frequency as specified in paper
 
 # Combined Model
 def linearised_model(nu, A, nu0, w, tau, a0, a1, a2, a3, a4):
@@ -65,9 +153,8 @@ def linearised_model(nu, A, nu0, w, tau, a0, a1, a2, a3, a4):
     Bowman (2018) and Hills (2018) Linearised Model with Flattened Gaussian
     """
 
-    # global model_call_counter
-    # model_call_counter += 1
-    # print(f"i={model_call_counter}\t A={A}\t nu0={nu0}\t w={w}\t tau={tau}\t a0={a0}\t a1={a1}\t a2={a2}\t a3={a3}\t a4={a4}")
+    if kernels.use(nu, A):
+        return kernels.linearised_model(nu, A, nu0, w, tau, a0, a1, a2, a3, a4, LINEARISED_BASIS.design_matrix(nu))
 
     T21 = flattened_gaussian(nu, A, nu0, w, tau)
     Tfg = linearised_foreground(nu, a0, a1, a2, a3, a4)
@@ -87,6 +174,8 @@ def sinusoidal(nu, A, phi, l):
     Sine Wave. Table 1 in Hills (2018).
     """
 
+    A, phi, l = _batch(A, phi, l)
+
     y = ((2.0 * np.pi * nu)/l) + phi 
     T21 = A * np.sin(y)
 
@@ -97,18 +186,17 @@ def five_polynomial(nu, a0, a1, a2, a3, a4, a5):
     """
     5-term Polynomial Foreground as in Hills (2018) equation (10).
     """
-    
-    nuc = 75.0          # Foreground central frequency as specified in Hills (2018)
-    x = nu / nuc        # Normalised frequency terms
 
-    Tfg =  a0 * np.power(x, -2.5)
-    Tfg += a1 * np.power(x, -1.5)        
-    Tfg += a2 * np.power(x, -0.5)
-    Tfg += a3 * np.power(x,  0.5) 
-    Tfg += a4 * np.power(x,  1.5)
-    Tfg += a5 * np.power(x,  2.5)
+    return POLYNOMIAL_BASIS(nu, a0, a1, a2, a3, a4, a5)
+
+def _polynomial_terms(x):
+    """
+    Basis terms of the 5-term polynomial foreground, in the order a0...a5.
+    """
+
+    return [np.power(x, p) for p in (-2.5, -1.5, -0.5, 0.5, 1.5, 2.5)]
 
-    return Tfg
+POLYNOMIAL_BASIS = ForegroundBasis(_polynomial_terms, nuc=75.0)     # Central frequency as specified in Hills (2018)
 
 # Combined Model
 def systematic_model(nu, A, phi, l, a0, a1, a2, a3, a4, a5):
@@ -116,9 +204,8 @@ def systematic_model(nu, A, phi, l, a0, a1, a2, a3, a4, a5):
     Hills (2018) 5-term Polynomial Foreground with Sinusoidal Signal
     """
 
-    # global model_call_counter
-    # model_call_counter += 1
-    # print(f"i={model_call_counter}\t A={A}\t phi={phi}\t l={l}\t a0={a0}\t a1={a1}\t a2={a2}\t a3={a3}\t a4={a4}\t a5={a5}")
+    if kernels.use(nu, A):
+        return kernels.systematic_model(nu, A, phi, l, a0, a1, a2, a3, a4, a5, POLYNOMIAL_BASIS.design_matrix(nu))
 
     T21 = sinusoidal(nu, A, phi, l)
     Tfg = five_polynomial(nu, a0, a1, a2, a3, a4, a5)
@@ -126,4 +213,144 @@ def systematic_model(nu, A, phi, l, a0, a1, a2, a3, a4, a5):
     # Combined signal
     Tsky = T21 + Tfg
     
-    return Tsky
\ No newline at end of file
+    return Tsky
+
+####################################################
+#################### JACOBIANS #####################
+####################################################
+# Derivatives of each model with respect to its parameters, in the order of its arguments:
+# (n_channels, n_params) for scalar parameters, or (n_points, n_channels, n_params) for arrays of shape (n_points,)
+def _stack(*columns):
+    """
+    Stack derivative columns (broadcast against each other) along a last axis.
+    """
+
+    shape = np.broadcast_shapes(*[np.shape(c) for c in columns])
+    return np.stack([np.broadcast_to(c, shape) for c in columns], axis=-1)
+
+def _concatenate(*jacobians):
+    """
+    Join the Jacobians of the signal and foreground of a combined model along the parameter axis.
+    """
+
+    shape = np.broadcast_shapes(*[j.shape[:-1] for j in jacobians])
+    return np.concatenate([np.broadcast_to(j, shape + j.shape[-1:]) for j in jacobians], axis=-1)
+
+def flattened_gaussian_jacobian(nu, A, nu0, w, tau):
+    """
+    Derivatives of the flattened Gaussian T21 = -A R(tau, B), B = 4 (nu - nu0)^2 / w^2 log(s(tau)),
+    with respect to A, nu0, w and tau (finite down to tau = 0, see kernels.py).
+    """
+
+    A, nu0, w, tau = _batch(A, nu0, w, tau)
+
+    x2 = 4.0 * np.power((nu - nu0), 2.0) / np.power(w, 2.0)
+    L = kernels.log_flattening(tau)
+    B = x2 * L
+    eB = np.exp(B)
+    dR_dB, dR_dtau = kernels.flattening_ratio_derivatives(tau, eB)
+
+    dA = - kernels.flattening_ratio(tau, eB)
+    dnu0 = A * dR_dB * 8.0 * (nu - nu0) / np.power(w, 2.0) * L
+    dw = A * dR_dB * 2.0 * B / w
+    dtau = - A * (dR_dtau + dR_dB * x2 * kernels.log_flattening_derivative(tau))
+
+    return _stack(dA, dnu0, dw, dtau)
+
+def linearised_foreground_jacobian(nu, a0, a1, a2, a3, a4):
+    return LINEARISED_BASIS.jacobian(nu, a0, a1, a2, a3, a4)
+
+def linearised_model_jacobian(nu, A, nu0, w, tau, a0, a1, a2, a3, a4):
+    return _concatenate(flattened_gaussian_jacobian(nu, A, nu0, w, tau), linearised_foreground_jacobian(nu, a0, a1, a2, a3, a4))
+
+def sinusoidal_jacobian(nu, A, phi, l):
+    """
+    Derivatives of the sine wave with respect to A, phi and l.
+    """
+
+    A, phi, l = _batch(A, phi, l)
+
+    y = ((2.0 * np.pi * nu)/l) + phi
+    cos_y = np.cos(y)
+
+    return _stack(np.sin(y), A * cos_y, - A * cos_y * 2.0 * np.pi * nu / np.power(l, 2.0))
+
+def five_polynomial_jacobian(nu, a0, a1, a2, a3, a4, a5):
+    return POLYNOMIAL_BASIS.jacobian(nu, a0, a1, a2, a3, a4, a5)
+
+def systematic_model_jacobian(nu, A, phi, l, a0, a1, a2, a3, a4, a5):
+    return _concatenate(sinusoidal_jacobian(nu, A, phi, l), five_polynomial_jacobian(nu, a0, a1, a2, a3, a4, a5))
+
+# Jacobian of each model
+JACOBIANS = {flattened_gaussian: flattened_gaussian_jacobian,
+             linearised_foreground: linearised_foreground_jacobian,
+             linearised_model: linearised_model_jacobian,
+             sinusoidal: sinusoidal_jacobian,
+             five_polynomial: five_polynomial_jacobian,
+             systematic_model: systematic_model_jacobian}
+
+
+####################################################
+###################### CHECK #######################
+####################################################
+def numerical_jacobian(model, nu, params, step=6e-6):
+    """
+    Central-difference Jacobian (n_channels, n_params) of model at the scalar parameters params (a dict in
+    argument order), with steps of step * max(|p|, 1) (second-order one-sided at p = 0, the lower bound of tau and A).
+    The default step, about the cube root of the machine epsilon, balances truncation and rounding errors.
+    """
+
+    columns = []
+    for k, p in params.items():
+        h = step * max(abs(p), 1.0)
+        if p == 0.0:
+            f0, f1, f2 = [model(nu, **dict(params, **{k: p + i * h})) for i in range(3)]
+            columns.append((- 3.0 * f0 + 4.0 * f1 - f2) / (2.0 * h))
+        else:
+            columns.append((model(nu, **dict(params, **{k: p + h})) - model(nu, **dict(params, **{k: p - h}))) / (2.0 * h))
+
+    return np.stack(columns, axis=-1)
+
+def check_jacobians(n_points=200, seed=0):
+    """
+    Largest difference of each analytic Jacobian from central differences over n_points random parameter
+    points (including tau = 0 and the small-tau series), relative to the largest derivative in its column.
+    The foreground coefficients are drawn from [-10, 10] rather than ~1e4 as in the data: the foreground is
+    linear, so its size does not change the derivatives, but at ~1e4 rounding swamps the differences of the signal.
+    """
+
+    import inspect
+
+    rng = np.random.default_rng(seed)
+    nu = np.linspace(50.0, 100.0, 123)
+    ranges = dict(A=(0.0, 20.0), nu0=(60.0, 90.0), w=(1.0, 40.0), phi=(1.5 * np.pi, 2.5 * np.pi), l=(11.0, 14.0))
+
+    def draw(keys, i):
+        params = {k: rng.uniform(*ranges[k]) if k in ranges else rng.uniform(-10.0, 10.0) for k in keys}
+        if 'tau' in params:
+            params['tau'] = (0.0, 1e-7)[i] if i < 2 else 10.0**rng.uniform(-3, 2)
+        return params
+
+    report = {}
+    for model, jacobian in JACOBIANS.items():
+        keys = list(inspect.signature(model).parameters)[1:]
+        worst = 0.0
+        for i in range(n_points):
+            params = draw(keys, i)
+            analytic, numerical = jacobian(nu, **params), numerical_jacobian(model, nu, params)
+            scale = np.maximum(np.max(np.abs(numerical), axis=0), 1e-12)
+            worst = max(worst, float(np.max(np.abs(analytic - numerical) / scale)))
+
+        # Batched parameters give the Jacobian of each point
+        batch = {k: np.array([draw(keys, 5)[k] for i in range(3)]) for k in keys}
+        single = np.array([jacobian(nu, **{k: v[i] for k, v in batch.items()}) for i in range(3)])
+        batched = np.max(np.abs(jacobian(nu, **batch) - single)) <= 1e-12 * np.max(np.abs(single))
+        report[model.__name__] = (worst, bool(batched))
+
+    return report
+
+
+if __name__ == '__main__':
+    for name, (difference, batched) in check_jacobians().items():
+        print('{:25} largest difference from central differences {:.1e}, batched {}'.format(
+            name + '_jacobian', difference, 'matches' if batched else 'DIFFERS'))
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+MPI support for sampler.py: the communicator, broadcasting from rank 0, a pool of MPI ranks for
+the samplers that take a pool (dynesty, ultranest, nessai, ...) and per-rank likelihood throughput.
+
+mpi4py is imported only when the script was started by mpirun/mpiexec (or MPI is asked for), so
+single-process runs need neither mpi4py nor an MPI installation.
+
+    mpirun -n 4 python sampler.py
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import os
+import sys
+import socket
+import traceback
+
+# Environment variables set by the common MPI launchers (Open MPI, MPICH/Intel MPI, PMIx, Slurm's srun)
+LAUNCHER_VARIABLES = ('OMPI_COMM_WORLD_SIZE', 'PMI_SIZE', 'PMIX_RANK', 'MPI_LOCALNRANKS')
+
+# Message tags of the pool
+TASK, RESULT, STOP = 1, 2, 3
+
+
+####################################################
+################### COMMUNICATOR ###################
+####################################################
+def launched():
+    """
+    True if this process was started by an MPI launcher.
+    """
+
+    return any(v in os.environ for v in LAUNCHER_VARIABLES)
+
+
+def communicator():
+    """
+    MPI.COMM_WORLD, or None when there is only one rank. Called only under an MPI launcher or when MPI
+    is asked for, so a missing mpi4py is an error rather than a silent fall back to one process per rank.
+    """
+
+    try:
+        from mpi4py import MPI
+    except ImportError as error:
+        raise ImportError('mpi4py is needed to run under an MPI launcher or with mpi=True') from error
+
+    comm = MPI.COMM_WORLD
+    return comm if comm.Get_size() > 1 else None
+
+
+def rank(comm):
+    return 0 if comm is None else comm.Get_rank()
+
+
+def broadcast(comm, func, *args):
+    """
+    func(*args) evaluated on rank 0 only and sent to every rank (just func(*args) without MPI).
+    """
+
+    if comm is None:
+        return func(*args)
+
+    value = func(*args) if comm.Get_rank() == 0 else None
+    return comm.bcast(value, root=0)
+
+
+def barrier(comm):
+    if comm is not None:
+        comm.Barrier()
+
+
+def abort(comm):
+    """
+    Print the exception being handled and abort every rank, which would otherwise wait for ever on
+    rank 0 (in a collective such as the gather of throughput). No-op without MPI.
+    """
+
+    if comm is None:
+        return
+    traceback.print_exc()
+    sys.stderr.flush()
+    comm.Abort(1)
+
+
+####################################################
+####################### POOL #######################
+####################################################
+class MPIPool:
+    """
+    Pool of MPI ranks with the map interface the samplers use. Rank 0 hands out tasks one at a time
+    to whichever rank is free, and the other ranks evaluate them in wait() until rank 0 closes the pool.
+    """
+
+    def __init__(self, comm):
+        self.comm = comm
+        self.workers = list(range(1, comm.Get_size()))
+        self.size = len(self.workers)
+        self._closed = False
+
+    def is_master(self):
+        return self.comm.Get_rank() == 0
+
+    def wait(self):
+        """
+        Worker loop: evaluate tasks from rank 0 until it closes the pool.
+        """
+
+        from mpi4py import MPI
+
+        status = MPI.Status()
+        while True:
+            task = self.comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+            if status.Get_tag() == STOP:
+                return
+            index, func, arg = task
+            self.comm.send((index, func(arg)), dest=0, tag=RESULT)
+
+    def map(self, func, iterable, chunksize=None):
+        """
+        [func(x) for x in iterable], evaluated on the worker ranks.
+        """
+
+        from mpi4py import MPI
+
+        tasks = list(iterable)
+        results = [None] * len(tasks)
+        free, pending, sent = list(self.workers), 0, 0
+        status = MPI.Status()
+
+        while sent < len(tasks) or pending:
+            while free and sent < len(tasks):
+                self.comm.send((sent, func, tasks[sent]), dest=free.pop(), tag=TASK)
+                sent += 1
+                pending += 1
+            index, value = self.comm.recv(source=MPI.ANY_SOURCE, tag=RESULT, status=status)
+            results[index] = value
+            free.append(status.Get_source())
+            pending -= 1
+
+        return results
+
+    def close(self):
+        """
+        Release the workers from wait(). Safe to call more than once (bilby closes the pools it is given).
+        """
+
+        if self.is_master() and not self._closed:
+            for worker in self.workers:
+                self.comm.send(None, dest=worker, tag=STOP)
+        self._closed = True
+
+    def join(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def init_bilby_worker(likelihood, priors):
+    """
+    Give a worker rank the likelihood and priors that bilby's sampler wrappers evaluate. bilby sets
+    these itself for the multiprocessing pools it creates, but not for a pool it is handed.
+    """
+
+    import bilby
+    from bilby.core.sampler.base_sampler import _initialize_global_variables
+
+    priors = bilby.core.prior.PriorDict(dict(priors))
+    keys = [k for k, p in priors.items() if not isinstance(p, (bilby.core.prior.DeltaFunction, float, int))]
+    _initialize_global_variables(likelihood=likelihood, priors=priors, search_parameter_keys=keys,
+                                 use_ratio=False, parameters={k: None for k in keys})
+
+
+####################################################
+#################### THROUGHPUT ####################
+####################################################
+def throughput(comm, timer, phase='sampling'):
+    """
+    Likelihood calls of every rank during phase, gathered on rank 0 (None on the other ranks):
+    [{rank, host, calls, busy_time, wall_time, calls_per_second}], where calls_per_second is over the
+    wall time of the phase.
+    """
+
+    counter = timer.counters.get('likelihood')
+    calls = counter.calls if counter is not None else 0
+    busy = counter.total_time if counter is not None else 0.0
+    wall = timer.phases.get(phase, {}).get('wall_time', 0.0)
+    mine = dict(rank=rank(comm), host=socket.gethostname(), calls=calls, busy_time=busy, wall_time=wall,
+                calls_per_second=calls / wall if wall > 0 else None)
+
+    return [mine] if comm is None else comm.gather(mine, root=0)
@@ -15,13 +15,11 @@ Contact: yi.lim17@imperial.ac.uk
 ####################################################
 #################### LIBRARIES #####################
 ####################################################
-import bilby
-import corner
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
 import edges
-import models
+import summary
+import predictive
+import result_store
 import os
 import sys
 
@@ -41,7 +39,7 @@ directory = '{}/samples'.format(BASE_DIR)                           # Directory
 # Sampler (pymultinest, dynesty, ultranest, nestle, cpnest, pypolychord) 
 sampler = 'pymultinest'
 
-# Model (linearised_model, systematic_model, ares_model)
+# Model (linearised_model, systematic_model, ares_model_linearised)
 case = 'linearised_model'
 
 # Data ('edges', 'mock', 'ares')
@@ -50,100 +48,98 @@ data = 'edges'
 # Livepoints
 livepoints = 7500
 
-
-####################################################
-################## OUTPUT FORMAT ###################
-####################################################
-label = '{}_{}_{}_{}'.format(case, data, sampler, livepoints)
-outdir = directory + '/{}_{}/'.format(case, data) + label
-bilby.utils.check_directory_exists_and_if_not_mkdir(outdir)
-print(outdir)
-
-if os.path.exists(outdir) == False:
-    print("This directory doesn't exist. Run sampler.py with the chosen set-up first to create the data.")
-    sys.exit()
-
-####################################################
-############### IMPORT SAMPLE DATA #################
-####################################################
-# Read in sampelr data (as a dataframe object)
-# result = "{}/{}_result.json".format(outdir, label)
-result = bilby.result.read_in_result(outdir=outdir, label=label)
-#print(result.posterior.loc[result.posterior['log_likelihood'] == np.amax(result.posterior['log_likelihood'].values)])
-#print(result.parameter_labels)
-
-max_post_param = []
-
-for param in result.search_parameter_keys:
-    print(f'{param} median is:', result.get_one_dimensional_median_and_error_bar(key=[f'{param}']).median)
-    print(f'{param} minus error is:', result.get_one_dimensional_median_and_error_bar(key=[f'{param}']).minus)
-    print(f'{param} plus error is:', result.get_one_dimensional_median_and_error_bar(key=[f'{param}']).plus)
-    max_post_param.append(result.get_one_dimensional_median_and_error_bar(key=[f'{param}']).median)
-
-print(max_post_param)
-
-####################################################
-################# MODEL SELECTION ##################
-####################################################
-if case == 'linearised_model':
-    model = models.linearised_model
-
-elif case == 'systematic_model':
-    model = models.systematic_model
-
-elif case == 'ares_model':
-    model = ares_sim.model_test
-
-
-####################################################
-###################### DATA ######################## 
-####################################################
-# Edges data
-if data == 'edges':
-    nu, weight, Tsky, Tres1, Tres2, Tmodel, T21, err = edges.read_edges()
-
-# Simulate data with a normal distribution of errors
-elif data == 'mock':
-    nu = np.linspace(50.0, 100.0)          
-    N = len(nu)
-    err = 0.01 * np.ones(N)           
-    Tsky = model(nu, **theta) + np.random.normal(0.0, err, N)
-
-# Simulate 21cm from ARES
-elif data == 'ares':
-    nu, T21 = ares_sim.simulation_test(**theta)
-    N = len(nu)
-    err = 0.01 * np.ones(N)
-    Tsky = T21 + np.random.normal(0.0, err, N)
-
-####################################################
-####################### PLOT #######################
-####################################################
-
-# Plot 1: Corner
-# samples = result.samples
-# labels = result.parameter_labels
-# fig = corner.corner(samples, labels=labels)
-# result.plot_corner()
-A, nu0, w, tau, a0, a1, a2, a3, a4, sigma = max_post_param
-print(sigma)
-# Plot 2: Residuals
-Tsky_post = model(nu, A, nu0, w, tau, a0, a1, a2, a3, a4)          # Model using maximum posterior parameter values
-Tres = Tsky - Tsky_post                         # Residuals = [simulated or real sky data] - [maximum posterior model]
-rms_Tres = round(np.sqrt(np.mean(Tres**2)), 3)  # RMS of our residuals
-print(rms_Tres)
-rms_Tres2 = round(np.sqrt(np.mean(Tres2**2)), 3)   # RMS of Bowman2018 residuals
-
-fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(12,5))
-ax.tick_params(axis='both', which='major', labelsize=12) 
-ax.axhline(y=sigma, linestyle=':', color='grey', linewidth=1, label='Error bars')
-ax.axhline(y=-sigma, linestyle=':', color='grey', linewidth=1)
-ax.plot(nu, Tres, linestyle='-', color='black', linewidth=1, label=f'Our residuals (RMS = {rms_Tres} K)')
-ax.plot(nu, Tres2, linestyle='--', color='dimgrey', linewidth=1, label=f'Bowman et al. 2018 residuals (RMS = {rms_Tres2} K)')
-ax.grid(False)
-ax.set_xlabel(r'Frequency, $\nu$ [MHz]', fontsize=12)
-ax.set_ylabel(r'Temperature, $T$ [K]', fontsize=12)
-# ax.text(0.5, 0.05, f'RMS = {rms_Tres} K', fontsize=12, horizontalalignment='center', verticalalignment='center', transform=ax.transAxes)
-ax.legend(loc='lower right', fontsize=12)
-
-fig.savefig('{}/{}_residuals.png'.format(outdir, label), dpi=300, bbox_inches='tight')
+# Seed of the run (None for an unseeded run), which also regenerates the same mock noise
+seed = None
+
+# Parameter point the residuals are plotted for ('median', 'mean', 'max_likelihood', 'max_posterior')
+statistic = 'median'
+
+# Posterior samples the predictive residual bands are drawn from (None for all of them)
+predictive_samples = None
+
+
+def plot_residuals(sampler=sampler, case=case, data=data, livepoints=livepoints, seed=seed, statistic=statistic,
+                   predictive_samples=predictive_samples):
+    """
+    Print the posterior summary of a finished run and plot its residuals, with their 68% and 95%
+    posterior-predictive bands, against those of Bowman (2018). Mock and ARES data are regenerated
+    as sampler.py made them for the run, so with its seed they are the very spectrum that was fitted.
+    """
+
+    import matplotlib.pyplot as plt
+    import sampler as sampling          # bin/sampler.py (sampler is the name of the sampler here)
+
+    # Output format
+    label = sampling.output_label(case, data, sampler, livepoints, seed=seed)[0]
+    outdir = directory + '/{}_{}/'.format(case, data) + label
+    print(outdir)
+
+    if os.path.exists(outdir) == False:
+        print("This directory doesn't exist. Run sampler.py with the chosen set-up first to create the data.")
+        sys.exit()
+
+    # Medians, errors, credible intervals and maximum-likelihood/posterior points of all parameters in one pass,
+    # from the result store if there is one, as its columns load lazily
+    if os.path.exists(result_store.store_path(outdir, label)):
+        with result_store.ResultStore.open(outdir, label) as store:
+            keys, theta = store.search_parameter_keys, store.injection_parameters
+            stats = summary.summarise(store, keys)
+    else:
+        result = result_store.read_result(outdir=outdir, label=label)
+        keys, theta = result.search_parameter_keys, result.injection_parameters
+        stats = summary.summarise(result.posterior, keys)
+
+    for param in keys:
+        print(f'{param} median is:', stats[param]['median'])
+        print(f'{param} minus error is:', stats[param]['minus'])
+        print(f'{param} plus error is:', stats[param]['plus'])
+
+    params = summary.point(stats, statistic)
+    print(params)
+
+    # Model selection (any model in models.py, or the ARES model)
+    model = predictive.model_functions(case)[0]
+    model_keys = predictive.function_keys(model)
+
+    # Data of the run: EDGES, or the mock/ARES data simulated from the injection with the run's seed
+    nu, Tsky, err, weight = sampling.load_data(data, model, theta, seed)
+    if data == 'edges':
+        Tres2 = edges.read_edges()[4]
+
+    # Plot 1: Corner
+    # samples = result.samples
+    # labels = result.parameter_labels
+    # fig = corner.corner(samples, labels=labels)
+    # result.plot_corner()
+    sigma = params.get('sigma', np.median(err))      # Noise parameter if it was sampled, else the data errors
+    print(sigma)
+    # Plot 2: Residuals
+    Tsky_post = model(nu, **{k: params[k] for k in model_keys})     # Model using the summary point parameter values
+    Tres = Tsky - Tsky_post                         # Residuals = [simulated or real sky data] - [summary point model]
+    rms_Tres = round(np.sqrt(np.mean(Tres**2)), 3)  # RMS of our residuals
+    print(rms_Tres)
+
+    # Posterior-predictive residual bands (cached next to the run, see predictive.py)
+    bands = predictive.run_bands(outdir, label, case, nu, Tsky, n_samples=predictive_samples)
+
+    fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(12,5))
+    ax.tick_params(axis='both', which='major', labelsize=12) 
+    ax.axhline(y=sigma, linestyle=':', color='grey', linewidth=1, label='Error bars')
+    ax.axhline(y=-sigma, linestyle=':', color='grey', linewidth=1)
+    ax.fill_between(nu, *predictive.band(bands, 'residual', 0.95), color='lightsteelblue', linewidth=0, label='95% predictive band')
+    ax.fill_between(nu, *predictive.band(bands, 'residual', 0.68), color='cornflowerblue', linewidth=0, label='68% predictive band')
+    ax.plot(nu, Tres, linestyle='-', color='black', linewidth=1, label=f'Our residuals (RMS = {rms_Tres} K)')
+    if data == 'edges':
+        rms_Tres2 = round(np.sqrt(np.mean(Tres2**2)), 3)   # RMS of Bowman2018 residuals
+        ax.plot(nu, Tres2, linestyle='--', color='dimgrey', linewidth=1, label=f'Bowman et al. 2018 residuals (RMS = {rms_Tres2} K)')
+    ax.grid(False)
+    ax.set_xlabel(r'Frequency, $\nu$ [MHz]', fontsize=12)
+    ax.set_ylabel(r'Temperature, $T$ [K]', fontsize=12)
+    # ax.text(0.5, 0.05, f'RMS = {rms_Tres} K', fontsize=12, horizontalalignment='center', verticalalignment='center', transform=ax.transAxes)
+    ax.legend(loc='lower right', fontsize=12)
+
+    fig.savefig('{}/{}_residuals.png'.format(outdir, label), dpi=300, bbox_inches='tight')
+
+
+if __name__ == '__main__':
+    plot_residuals()
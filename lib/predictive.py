@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Posterior-predictive bands of the sky spectrum, the 21 cm signal and the residuals.
+
+The model is evaluated for every posterior sample (or a weighted subsample of them) in chunks of
+chunk_size samples and blocks of channel_block channels, each a single batched model call (see models.py),
+and only per-channel quantiles are kept: memory is bounded by the chunk and block sizes however long the
+posterior and however fine the frequency grid. The bands of a run are cached as <outdir>/<label>_predictive.npz and reused
+until the run, the data or the settings change.
+
+    python predictive.py                    bands of the run selected in plot.py
+    python predictive.py --samples 2000     from a weighted subsample of 2000 posterior samples
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import os
+import json
+import inspect
+import hashlib
+import argparse
+import numpy as np
+import models
+import summary
+import result_store
+
+QUANTILES = (0.025, 0.16, 0.5, 0.84, 0.975)     # Quantiles of the bands (95% and 68% intervals and the median)
+CHUNK_SIZE = 4096                               # Posterior samples evaluated per model call
+BINS = 2**11                                    # Histogram bins per channel when streaming
+CHANNEL_BLOCK = 512                             # Channels per pass (histograms of 3 x 512 x BINS floats, 25 MB)
+
+
+####################################################
+###################### MODELS ######################
+####################################################
+def model_functions(case):
+    """
+    (model, signal) functions of a case: any model in models.py, or the ARES model.
+    """
+
+    if case == 'linearised_model':
+        return models.linearised_model, models.flattened_gaussian
+    if case == 'systematic_model':
+        return models.systematic_model, models.sinusoidal
+    if case == 'ares_model_linearised':
+        import ares_sim
+        return ares_sim.model_ares, ares_sim.signal_ares
+
+    return getattr(models, case), None
+
+
+def function_keys(function):
+    """
+    Parameter names of a model or signal function (all arguments after nu).
+    """
+
+    return list(inspect.signature(function).parameters)[1:]
+
+
+def _evaluate(function, nu, params, m):
+    """
+    function for m parameter points at once, shape (m, n_channels). Models that do not accept
+    parameter arrays (e.g. the exact ARES model) are called once per point.
+    """
+
+    try:
+        out = np.asarray(function(nu, **params), dtype=float)
+        if out.shape == (m, len(nu)):
+            return out
+    except (TypeError, ValueError):
+        pass
+
+    return np.array([function(nu, **{k: v[i] for k, v in params.items()}) for i in range(m)], dtype=float)
+
+
+####################################################
+###################### BANDS #######################
+####################################################
+def subsample(n, n_samples, weights=None, seed=None):
+    """
+    Indices of n_samples of n samples drawn with probability proportional to weights (without
+    replacement when the weights are equal), sorted so columns are read in order.
+    """
+
+    rng = np.random.default_rng(seed)
+    if weights is None:
+        return np.sort(rng.choice(n, size=min(n_samples, n), replace=False))
+
+    p = np.asarray(weights, dtype=float)
+    return np.sort(rng.choice(n, size=n_samples, replace=True, p=p / p.sum()))
+
+
+def bands(model, nu, posterior, signal=None, data=None, weights=None, n_samples=None, quantiles=QUANTILES,
+          chunk_size=CHUNK_SIZE, bins=BINS, channel_block=CHANNEL_BLOCK, seed=None):
+    """
+    Posterior-predictive quantiles of the sky model, the 21 cm signal alone (if signal is given)
+    and the residuals data - model (if data is given), each of shape (len(quantiles), n_channels).
+
+    posterior maps parameter names to sample columns (a bilby posterior, a result_store.ResultStore
+    or a dict). weights are sample weights (None for an equally weighted posterior). With
+    n_samples, a subsample of that many samples drawn in proportion to the weights is used instead.
+    Posteriors longer than chunk_size are streamed twice (ranges, then histograms of bins bins per
+    channel), so each chunk is evaluated twice. Grids of more than channel_block channels are done a
+    block at a time (the models are evaluated channel by channel, so on a block of nu as on all of it).
+    """
+
+    nu = np.asarray(nu, dtype=float)
+    model_keys = function_keys(model)
+    signal_keys = function_keys(signal) if signal is not None else []
+    data = None if data is None else np.asarray(data, dtype=float)
+
+    n = len(posterior[model_keys[0]])
+    rows = np.arange(n)
+    if n_samples is not None and n_samples < n:
+        rows, weights = subsample(n, n_samples, weights, seed), None
+    elif weights is not None:
+        weights = np.asarray(weights, dtype=float)
+
+    names = ['Tsky'] + (['T21'] if signal is not None else []) + (['residual'] if data is not None else [])
+    out = dict(nu=nu, quantiles=np.asarray(quantiles, dtype=float))
+    for name in names:
+        out[name] = np.empty((len(quantiles), len(nu)))
+
+    for block in (slice(start, start + channel_block) for start in range(0, len(nu), channel_block)):
+        nu_block = nu[block]
+        data_block = None if data is None else data[block]
+
+        def chunks():
+            for start in range(0, len(rows), chunk_size):
+                index = rows[start:start + chunk_size]
+                column = {k: np.asarray(posterior[k], dtype=float)[index] for k in set(model_keys + signal_keys)}
+
+                Tsky = _evaluate(model, nu_block, {k: column[k] for k in model_keys}, len(index))
+                x = [Tsky]
+                if signal is not None:
+                    x.append(_evaluate(signal, nu_block, {k: column[k] for k in signal_keys}, len(index)))
+                if data is not None:
+                    x.append(data_block - Tsky)
+
+                yield np.hstack(x), None if weights is None else weights[index]
+
+        if len(rows) <= chunk_size:
+            x, w = next(chunks())
+            q = summary.weighted_quantiles(x, quantiles, w)
+        else:
+            q = summary.streaming_quantiles(chunks, quantiles, bins)
+
+        for i, name in enumerate(names):
+            out[name][:, block] = q[:, i * len(nu_block):(i + 1) * len(nu_block)]
+
+    return out
+
+
+def band(result, name, level):
+    """
+    (lower, upper) of the central interval at credible level of one band, e.g. band(b, 'residual', 0.68).
+    """
+
+    q = list(np.round(result['quantiles'], 6))
+    return (result[name][q.index(round((1.0 - level) / 2.0, 6))],
+            result[name][q.index(round((1.0 + level) / 2.0, 6))])
+
+
+####################################################
+###################### CACHE #######################
+####################################################
+def predictive_path(outdir, label):
+    return os.path.join(outdir, '{}_predictive.npz'.format(label))
+
+
+def result_file(outdir, label):
+    """
+    Result file of a run: the result store if there is one, else bilby's JSON result.
+    """
+
+    path = result_store.store_path(outdir, label)
+    if os.path.exists(path):
+        return path
+
+    return os.path.join(outdir, '{}_result.json'.format(label))
+
+
+def _cache_key(source, case, nu, data, n_samples, quantiles, seed):
+    """
+    Hash of everything the bands depend on: the result file (size and modification time), the
+    model, the frequencies and data, and the settings.
+    """
+
+    stat = os.stat(source)
+    h = hashlib.sha256(json.dumps(dict(source=os.path.basename(source), size=stat.st_size, mtime=stat.st_mtime_ns,
+                                       case=case, n_samples=n_samples, quantiles=list(quantiles), seed=seed)).encode())
+    h.update(np.ascontiguousarray(nu, dtype=float).tobytes())
+    if data is not None:
+        h.update(np.ascontiguousarray(data, dtype=float).tobytes())
+
+    return h.hexdigest()
+
+
+def run_bands(outdir, label, case, nu, data=None, n_samples=None, quantiles=QUANTILES, seed=0, refresh=False):
+    """
+    bands of a finished run, read from <outdir>/<label>_predictive.npz when it is up to date and
+    computed and cached otherwise.
+    """
+
+    source = result_file(outdir, label)
+    key = _cache_key(source, case, nu, data, n_samples, quantiles, seed)
+    path = predictive_path(outdir, label)
+
+    if not refresh and os.path.exists(path):
+        with np.load(path) as cached:
+            if str(cached['key']) == key:
+                return {k: cached[k] for k in cached.files if k != 'key'}
+
+    model, signal = model_functions(case)
+    if source.endswith('.npz'):
+        with result_store.ResultStore(source) as store:
+            out = bands(model, nu, store, signal, data, n_samples=n_samples, quantiles=quantiles, seed=seed)
+    else:
+        posterior = result_store.read_result(outdir, label).posterior
+        out = bands(model, nu, posterior, signal, data, n_samples=n_samples, quantiles=quantiles, seed=seed)
+
+    # Write to a temporary file and rename, so a cache is never read half-written
+    tmp = path[:-4] + '.tmp.npz'
+    np.savez(tmp, key=key, **out)
+    os.replace(tmp, path)
+
+    return out
+
+
+if __name__ == '__main__':
+    import edges
+    import plot
+
+    parser = argparse.ArgumentParser(description='Posterior-predictive bands of a finished run.')
+    parser.add_argument('--sampler', default=plot.sampler)
+    parser.add_argument('--case', default=plot.case)
+    parser.add_argument('--livepoints', type=int, default=plot.livepoints)
+    parser.add_argument('--samples', type=int, default=None, help='Weighted subsample of the posterior to use')
+    parser.add_argument('--refresh', action='store_true', help='Recompute the bands even if they are cached')
+    args = parser.parse_args()
+
+    # EDGES runs only: the mock and ARES data of a run are not stored with it
+    label = '{}_edges_{}_{}'.format(args.case, args.sampler, args.livepoints)
+    outdir = '{}/{}_edges/{}'.format(plot.directory, args.case, label)
+    nu, weight, Tsky, Tres1, Tres2, Tmodel, T21, err = edges.read_edges()
+
+    result = run_bands(outdir, label, args.case, nu, Tsky, n_samples=args.samples, refresh=args.refresh)
+    lower, upper = band(result, 'residual', 0.95)
+    print(predictive_path(outdir, label))
+    print('Median residual RMS: {:.4f} K'.format(np.sqrt(np.mean(result['residual'][len(QUANTILES) // 2]**2))))
+    print('Mean width of the 95% residual band: {:.4f} K'.format(np.mean(upper - lower)))
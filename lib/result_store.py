@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Compact columnar store for sampling results.
+
+A run is stored as <outdir>/<label>_result.npz: a zip archive with one .npy member per column
+(posterior samples, log-likelihood and log-prior, and the weighted nested samples when the sampler
+kept them) and a JSON member with the evidence and run metadata. It can be read with np.load, but
+ResultStore reads each column only when it is first used and memory-maps uncompressed columns
+straight out of the archive.
+
+    python result_store.py ../samples                 convert every run with a bilby result file
+    python result_store.py ../samples --compress      deflate the columns (smaller, not memory-mapped)
+    python result_store.py ../samples --prune         also delete the sampler's own output files once converted
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import os
+import glob
+import json
+import shutil
+import zipfile
+import argparse
+import tempfile
+import numpy as np
+
+META = 'meta.json'                  # Archive member holding the evidence and run metadata
+NESTED = 'nested/'                  # Prefix of the weighted nested sample columns
+
+# Result attributes kept in the metadata
+META_KEYS = ('label', 'sampler', 'log_evidence', 'log_evidence_err', 'log_noise_evidence', 'log_bayes_factor',
+             'sampling_time', 'search_parameter_keys', 'fixed_parameter_keys', 'parameter_labels',
+             'injection_parameters', 'num_likelihood_evaluations', 'meta_data', 'version')
+
+
+####################################################
+###################### WRITE #######################
+####################################################
+def store_path(outdir, label):
+    return os.path.join(outdir, '{}_result.npz'.format(label))
+
+
+def _multinest_nested_samples(outdir, label, keys):
+    """
+    Weighted nested samples from MultiNest's <basename>.txt (weight, -2 log L, parameters), or None.
+    """
+
+    for name in ('.txt', '{}.txt'.format(label)):
+        for path in glob.glob(os.path.join(outdir, 'pm_*', '**', name), recursive=True):
+            table = np.loadtxt(path, ndmin=2)
+            if table.shape[1] == len(keys) + 2:
+                columns = dict(weights=table[:, 0], log_likelihood=-table[:, 1] / 2.0)
+                columns.update({k: table[:, i + 2] for i, k in enumerate(keys)})
+                return columns
+
+    return None
+
+
+def _attribute(result, key):
+    # Result properties raise ValueError when bilby has nothing stored for them
+    try:
+        return getattr(result, key, None)
+    except ValueError:
+        return None
+
+
+def _json_safe(value):
+    return json.loads(json.dumps(value, default=str))
+
+
+def write(result, outdir=None, label=None, compress=False):
+    """
+    Store a bilby result as <outdir>/<label>_result.npz and return the path.
+    Columns are deflated with compress=True, and otherwise stored as they are so they can be memory-mapped.
+    """
+
+    outdir = outdir or result.outdir
+    label = label or result.label
+
+    columns = {k: np.asarray(result.posterior[k]) for k in result.posterior.columns}
+
+    try:
+        nested = result.nested_samples
+        nested = {k: np.asarray(nested[k]) for k in nested.columns}
+    except (AttributeError, ValueError, TypeError):
+        nested = _multinest_nested_samples(outdir, label, result.search_parameter_keys)
+    for k, v in (nested or {}).items():
+        columns[NESTED + k] = v
+
+    meta = {k: _attribute(result, k) for k in META_KEYS}
+    meta['priors'] = {k: repr(v) for k, v in (result.priors or {}).items()}
+    meta['sampler_kwargs'] = result.sampler_kwargs
+    meta['columns'] = list(columns)
+    meta = _json_safe(meta)
+
+    # Write to a temporary file and rename, so readers never see a partial archive
+    path = store_path(outdir, label)
+    fd, tmp = tempfile.mkstemp(dir=outdir, suffix='.tmp')
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED) as zf:
+            for name, values in columns.items():
+                array = np.ascontiguousarray(values)
+                if array.dtype == object:
+                    array = array.astype(float)
+                with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, array, allow_pickle=False)
+            zf.writestr(META, json.dumps(meta, indent=2))
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+    return path
+
+
+####################################################
+###################### READ ########################
+####################################################
+class ResultStore:
+    """
+    Lazy reader of a result archive: store[name] loads (or memory-maps) one column on first use.
+    Posterior columns are named as in the bilby posterior; nested sample columns are prefixed 'nested/'.
+    """
+
+    def __init__(self, path, mmap=True):
+        self.path = path
+        self.mmap = mmap
+        self._columns = {}
+
+        self._zip = zipfile.ZipFile(path)
+        self._members = {info.filename[:-4]: info for info in self._zip.infolist() if info.filename.endswith('.npy')}
+        self.meta = json.loads(self._zip.read(META))
+
+    @classmethod
+    def open(cls, outdir, label, mmap=True):
+        return cls(store_path(outdir, label), mmap=mmap)
+
+    def __getattr__(self, name):
+        # Evidence and metadata as attributes, e.g. store.log_evidence
+        meta = self.__dict__.get('meta', {})
+        if name in meta:
+            return meta[name]
+        raise AttributeError(name)
+
+    @property
+    def columns(self):
+        return list(self._members)
+
+    @property
+    def posterior_keys(self):
+        return [k for k in self._members if not k.startswith(NESTED)]
+
+    def __contains__(self, name):
+        return name in self._members
+
+    def __getitem__(self, name):
+        if name not in self._columns:
+            info = self._members[name]
+            if self.mmap and info.compress_type == zipfile.ZIP_STORED:
+                self._columns[name] = self._memmap(info)
+            else:
+                with self._zip.open(info) as f:
+                    self._columns[name] = np.lib.format.read_array(f, allow_pickle=False)
+
+        return self._columns[name]
+
+    def _memmap(self, info):
+        """
+        Read-only memory map of an uncompressed member, found from its local zip header and .npy header.
+        """
+
+        with open(self.path, 'rb') as f:
+            f.seek(info.header_offset)
+            local = f.read(30)
+            name_length = int.from_bytes(local[26:28], 'little')
+            extra_length = int.from_bytes(local[28:30], 'little')
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+
+            if np.lib.format.read_magic(f) == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+
+        if not np.prod(shape):
+            return np.empty(shape, dtype=dtype)
+
+        return np.asarray(np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=shape,
+                                    order='F' if fortran_order else 'C'))
+
+    def posterior(self, keys=None):
+        """
+        Dict of posterior columns (all of them, or keys).
+        """
+
+        return {k: self[k] for k in (keys or self.posterior_keys)}
+
+    def nested_samples(self):
+        """
+        Dict of weighted nested sample columns ('weights', 'log_likelihood' and the parameters), empty if none were kept.
+        """
+
+        return {k[len(NESTED):]: self[k] for k in self._members if k.startswith(NESTED)}
+
+    def to_bilby(self):
+        """
+        The run as a bilby Result, without reading the bilby result file.
+        """
+
+        import bilby
+        import pandas as pd
+
+        meta = {k: self.meta.get(k) for k in META_KEYS}
+        priors = bilby.core.prior.PriorDict(dict(self.meta.get('priors') or {}))
+
+        return bilby.result.Result(posterior=pd.DataFrame(self.posterior()), priors=priors,
+                                   sampler_kwargs=self.meta.get('sampler_kwargs'), **meta)
+
+    def close(self):
+        # Memory-mapped columns each hold the file open until they are released
+        self._zip.close()
+        self._columns.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_result(outdir, label):
+    """
+    bilby Result of a run, from the result store when there is one and from bilby's result file otherwise.
+    """
+
+    if os.path.exists(store_path(outdir, label)):
+        with ResultStore.open(outdir, label) as store:
+            return store.to_bilby()
+
+    import bilby
+    return bilby.result.read_in_result(outdir=outdir, label=label)
+
+
+####################################################
+##################### CONVERT ######################
+####################################################
+def sampler_files(outdir, label):
+    """
+    Output files the samplers leave in outdir besides the result (pm_*, cpnest_*, dynesty resume files, ...).
+    """
+
+    patterns = ['pm_*', 'cpnest_*', 'ultra_*', 'nessai_*', '{}_resume.pickle'.format(label),
+                '{}_checkpoint_*.png'.format(label), '{}_dynesty.pickle'.format(label), '*.old']
+
+    return sorted({p for pattern in patterns for p in glob.glob(os.path.join(outdir, pattern))})
+
+
+def convert(outdir, label, compress=False, prune=False):
+    """
+    Write the result store of a run from its bilby result file. With prune=True, delete the
+    sampler's output files and the bilby result file once the store has been read back.
+    """
+
+    import bilby
+
+    result = bilby.result.read_in_result(outdir=outdir, label=label)
+    path = write(result, outdir, label, compress=compress)
+
+    if prune:
+        with ResultStore(path) as store:
+            for k in result.posterior.columns:
+                if not np.array_equal(store[k], np.asarray(result.posterior[k], dtype=store[k].dtype), equal_nan=True):
+                    raise ValueError('{}: column {} does not match the bilby result, nothing deleted'.format(path, k))
+        for p in sampler_files(outdir, label) + glob.glob(os.path.join(outdir, '{}_result.json'.format(label))):
+            shutil.rmtree(p) if os.path.isdir(p) else os.remove(p)
+
+    return path
+
+
+def find_runs(directory):
+    """
+    (outdir, label) of every run under directory with a bilby result file.
+    """
+
+    runs = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            for ext in ('json', 'hdf5', 'pkl'):
+                if name.endswith('_result.' + ext):
+                    runs.append((root, name[:-len('_result.' + ext)]))
+
+    return sorted(set(runs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert sampling results to the columnar result store.')
+    parser.add_argument('directory', help='Directory searched for bilby result files (e.g. samples)')
+    parser.add_argument('--compress', action='store_true', help='Deflate the columns')
+    parser.add_argument('--prune', action='store_true', help="Delete the sampler's output files and the bilby result after converting")
+    args = parser.parse_args()
+
+    for outdir, label in find_runs(args.directory):
+        before = sum(os.path.getsize(os.path.join(r, f)) for r, d, fs in os.walk(outdir) for f in fs)
+        path = convert(outdir, label, compress=args.compress, prune=args.prune)
+        print('{}: {:.1f} kB ({:.1f} kB in the run directory before)'.format(path, os.path.getsize(path) / 1e3, before / 1e3))
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Single-pass summaries of posterior samples.
+
+Weighted quantiles, credible intervals, mean and standard deviation of every parameter, and the
+maximum-likelihood and maximum-posterior samples, computed for all parameters at once from a
+(n_samples, n_parameters) array. Works with any mapping of columns: a bilby posterior DataFrame, a
+result_store.ResultStore or a dict of arrays, for any model. Posteriors longer than chunk_size are
+streamed in row chunks (e.g. from memory-mapped result store columns), with quantiles read off
+a fine weighted histogram instead of a full sort.
+
+@author: Jesse Cross, MSci Physics at Imperial College London
+Contact: jesse.cross17@imperial.ac.uk
+@author: Ivan Lim, MSci Physics at Imperial College London
+Contact: yi.lim17@imperial.ac.uk
+"""
+
+####################################################
+#################### LIBRARIES #####################
+####################################################
+import numpy as np
+
+LEVELS = (0.68, 0.95)               # Credible levels of the central intervals
+CHUNK_SIZE = 2**20                  # Posteriors with more samples than this are streamed
+BINS = 2**14                        # Histogram bins per parameter when streaming
+
+
+####################################################
+##################### QUANTILES ####################
+####################################################
+def weighted_quantiles(samples, q, weights=None):
+    """
+    Quantiles q of each column of samples (n_samples, n_parameters) with sample weights, shape (len(q), n_parameters).
+    For equal weights this is np.quantile with linear interpolation.
+    """
+
+    samples = np.asarray(samples, dtype=float)
+    if samples.ndim == 1:
+        samples = samples[:, np.newaxis]
+    q = np.atleast_1d(q)
+    n = len(samples)
+    if n == 1:
+        return np.repeat(samples, len(q), axis=0)
+
+    order = np.argsort(samples, axis=0)
+    x = np.take_along_axis(samples, order, axis=0)
+    w = np.ones_like(x) if weights is None else np.asarray(weights, dtype=float)[order]
+
+    # Position of each sorted sample on [0, 1]: (S_i - w_i) / (S_n - w_n), i.e. i / (n - 1) for equal weights
+    s = np.cumsum(w, axis=0)
+    p = (s - w) / (s[-1] - w[-1])
+
+    out = np.empty((len(q), samples.shape[1]))
+    columns = np.arange(samples.shape[1])
+    for i, qi in enumerate(q):
+        j = np.clip(np.sum(p <= qi, axis=0) - 1, 0, n - 2)
+        p0, p1 = p[j, columns], p[j + 1, columns]
+        t = np.where(p1 > p0, (qi - p0) / np.where(p1 > p0, p1 - p0, 1.0), 0.0)
+        out[i] = x[j, columns] + np.clip(t, 0.0, 1.0) * (x[j + 1, columns] - x[j, columns])
+
+    return out
+
+
+def _interval_quantiles(levels):
+    q = [0.5, 0.16, 0.84]
+    for level in levels:
+        q += [(1.0 - level) / 2.0, (1.0 + level) / 2.0]
+
+    return np.array(q)
+
+
+####################################################
+###################### SUMMARY #####################
+####################################################
+def _column(columns, key, start=None, stop=None):
+    return np.asarray(columns[key][start:stop], dtype=float)
+
+
+def _length(columns, keys):
+    return len(columns[keys[0]])
+
+
+def _summary(keys, quantiles, levels, mean, std, ml, mp):
+    """
+    {parameter: {median, minus, plus, lower_<level>, upper_<level>, mean, std, max_likelihood, max_posterior}}.
+    minus and plus are the distances from the median to the 16% and 84% quantiles, as in bilby.
+    """
+
+    summary = {}
+    for i, key in enumerate(keys):
+        median = quantiles[0, i]
+        entry = dict(median=median, minus=median - quantiles[1, i], plus=quantiles[2, i] - median)
+        for l, level in enumerate(levels):
+            tag = '{:g}'.format(100 * level)
+            entry['lower_' + tag] = quantiles[3 + 2 * l, i]
+            entry['upper_' + tag] = quantiles[4 + 2 * l, i]
+        entry.update(mean=mean[i], std=std[i],
+                     max_likelihood=None if ml is None else ml[i],
+                     max_posterior=None if mp is None else mp[i])
+        summary[key] = {k: (None if v is None else float(v)) for k, v in entry.items()}
+
+    return summary
+
+
+def summarise(columns, keys, weights=None, levels=LEVELS, chunk_size=CHUNK_SIZE, bins=BINS):
+    """
+    Summary of the parameters keys of a posterior, see _summary.
+
+    columns maps names to 1-D arrays and must hold keys, and may hold 'log_likelihood' and
+    'log_prior' for the maximum-likelihood and maximum-posterior samples. weights is the name of
+    a weight column or an array (None for equally weighted samples, as in a bilby posterior).
+    """
+
+    keys = list(keys)
+    n = _length(columns, keys)
+    if n > chunk_size:
+        return _summarise_streaming(columns, keys, weights, levels, chunk_size, bins)
+
+    samples = np.column_stack([_column(columns, k) for k in keys])
+    w = _weights(columns, weights, None, None)
+
+    quantiles = weighted_quantiles(samples, _interval_quantiles(levels), w)
+    wn = np.ones(n) / n if w is None else w / np.sum(w)
+    mean = wn @ samples
+    std = np.sqrt(wn @ (samples - mean)**2)
+
+    ml = mp = None
+    if 'log_likelihood' in columns:
+        log_l = _column(columns, 'log_likelihood')
+        ml = samples[np.argmax(log_l)]
+        if 'log_prior' in columns:
+            mp = samples[np.argmax(log_l + _column(columns, 'log_prior'))]
+
+    return _summary(keys, quantiles, levels, mean, std, ml, mp)
+
+
+def _weights(columns, weights, start, stop):
+    if weights is None:
+        return None
+    if isinstance(weights, str):
+        return _column(columns, weights, start, stop)
+
+    return np.asarray(weights[start:stop], dtype=float)
+
+
+def streaming_quantiles(chunks, q, bins=BINS, lo=None, hi=None):
+    """
+    Quantiles q of each column of a stream of (x, w) chunks, x of shape (n_rows, n_columns) and w
+    the row weights (or None), shape (len(q), n_columns). chunks is called once per pass and must
+    return a fresh iterator each time. Quantiles are interpolated from weighted histograms of all
+    columns at once (one bincount per chunk) and are accurate to about (hi - lo) / bins. The range
+    of each column is found in a first pass unless lo and hi are given.
+    """
+
+    if lo is None or hi is None:
+        lo, hi = None, None
+        for x, w in chunks():
+            lo = x.min(axis=0) if lo is None else np.minimum(lo, x.min(axis=0))
+            hi = x.max(axis=0) if hi is None else np.maximum(hi, x.max(axis=0))
+
+    d = len(lo)
+    width = np.where(hi > lo, (hi - lo) / bins, 1.0)
+    offset = np.arange(d) * bins
+    counts = np.zeros(d * bins)
+    for x, w in chunks():
+        w = np.ones(len(x)) if w is None else w
+        b = np.clip(((x - lo) / width).astype(int), 0, bins - 1) + offset
+        counts += np.bincount(b.ravel(), weights=np.repeat(w, d), minlength=d * bins)
+
+    counts = counts.reshape(d, bins)
+    cdf = np.cumsum(counts, axis=1) / counts.sum(axis=1, keepdims=True)
+    edges = lo[:, np.newaxis] + width[:, np.newaxis] * np.arange(1, bins + 1)
+
+    quantiles = np.empty((len(q), d))
+    for i in range(d):
+        quantiles[:, i] = np.interp(q, np.concatenate([[0.0], cdf[i]]), np.concatenate([[lo[i]], edges[i]]))
+
+    return quantiles
+
+
+def _summarise_streaming(columns, keys, weights, levels, chunk_size, bins):
+    """
+    summarise over row chunks: ranges, moments and maxima in a first pass, then the quantiles from
+    streaming_quantiles.
+    """
+
+    n = _length(columns, keys)
+    d = len(keys)
+    has_l, has_p = 'log_likelihood' in columns, 'log_prior' in columns
+
+    def chunks():
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            yield (np.column_stack([_column(columns, k, start, stop) for k in keys]),
+                   _weights(columns, weights, start, stop))
+
+    lo, hi = np.full(d, np.inf), np.full(d, -np.inf)
+    total, mean, m2 = 0.0, np.zeros(d), np.zeros(d)
+    best_l, best_p, ml, mp = -np.inf, -np.inf, None, None
+
+    for start, (x, w) in zip(range(0, n, chunk_size), chunks()):
+        stop = start + len(x)
+        w = np.ones(len(x)) if w is None else w
+
+        lo, hi = np.minimum(lo, x.min(axis=0)), np.maximum(hi, x.max(axis=0))
+        # Weighted mean and sum of squared deviations of the chunk, merged with Chan et al.'s parallel update
+        # (stable where E[x^2] - mean^2 cancels, for a spread small next to the mean)
+        w_chunk = w.sum()
+        if w_chunk > 0:
+            mean_chunk = (w @ x) / w_chunk
+            delta = mean_chunk - mean
+            m2 += w @ (x - mean_chunk)**2 + delta**2 * total * w_chunk / (total + w_chunk)
+            mean = mean + delta * w_chunk / (total + w_chunk)
+            total += w_chunk
+
+        if has_l:
+            log_l = _column(columns, 'log_likelihood', start, stop)
+            i = np.argmax(log_l)
+            if log_l[i] > best_l:
+                best_l, ml = log_l[i], x[i]
+            if has_p:
+                log_post = log_l + _column(columns, 'log_prior', start, stop)
+                i = np.argmax(log_post)
+                if log_post[i] > best_p:
+                    best_p, mp = log_post[i], x[i]
+
+    std = np.sqrt(m2 / total)
+    quantiles = streaming_quantiles(chunks, _interval_quantiles(levels), bins, lo, hi)
+
+    return _summary(keys, quantiles, levels, mean, std, ml, mp)
+
+
+def point(summary, statistic='median'):
+    """
+    Parameter point {parameter: value} of one statistic of a summary (median, mean, max_likelihood, max_posterior).
+    """
+
+    return {key: entry[statistic] for key, entry in summary.items()}